@@ -0,0 +1,95 @@
+"""Directory scanning cost of finding an animal's raw files
+(`TrodesAnimalInfo`).
+
+Builds a synthetic raw directory in a temporary directory: `--days` day
+directories with `--epochs` epochs of 6 raw files each (.rec, .h264,
+position tracking, video timestamps, camera frame counts and comments),
+plus a .trodesconf and one subdirectory per day. Then counts the
+os.scandir and os.stat/os.lstat calls made while constructing
+`TrodesAnimalInfo`, and times it (best of `--repeat`).
+
+The trodes version is given, so no rec headers are read and only the
+directory scan is measured. To compare with another revision, run the
+script with that checkout first on PYTHONPATH:
+
+    PYTHONPATH=<checkout> python benchmarks/bench_day_scan.py
+"""
+
+import argparse
+import collections
+import functools
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from rec_to_binaries.trodes_data import TrodesAnimalInfo
+
+ANIMAL = 'anim'
+
+EPOCH_FILE_EXTENSIONS = ['rec', '1.h264', '1.videoPositionTracking', '1.videoTimeStamps',
+                         '1.videoTimeStamps.cameraHWFrameCount', 'trodesComments']
+
+
+def make_raw_data(base_dir, num_days, num_epochs):
+    """Writes empty raw files of `num_days` days to
+    `<base_dir>/<ANIMAL>/raw`."""
+    for day in range(num_days):
+        date = '2020{:02d}{:02d}'.format(day // 28 + 1, day % 28 + 1)
+        day_dir = os.path.join(base_dir, ANIMAL, 'raw', date)
+        os.makedirs(os.path.join(day_dir, 'notes'))
+        open(os.path.join(day_dir, '{}.trodesconf'.format(date)), 'w').close()
+        for epoch in range(1, num_epochs + 1):
+            for extension in EPOCH_FILE_EXTENSIONS:
+                open(os.path.join(day_dir, '{}_{}_{:02d}_r{}.{}'.format(
+                    date, ANIMAL, epoch, epoch, extension)), 'w').close()
+
+
+def _counted(counts, name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        counts[name] += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def count_calls(base_dir):
+    """(os.scandir calls, os.stat + os.lstat calls) of one construction."""
+    counts = collections.Counter()
+    originals = {name: getattr(os, name) for name in ('scandir', 'stat', 'lstat')}
+    for name, func in originals.items():
+        setattr(os, name, _counted(counts, name, func))
+    try:
+        TrodesAnimalInfo(base_dir, ANIMAL, trodes_version=2)
+    finally:
+        for name, func in originals.items():
+            setattr(os, name, func)
+    return counts['scandir'], counts['stat'] + counts['lstat']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    base_dir = tempfile.mkdtemp(prefix='bench_day_scan_')
+    try:
+        make_raw_data(base_dir, args.days, args.epochs)
+        num_scandir, num_stat = count_calls(base_dir)
+        elapsed = []
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            TrodesAnimalInfo(base_dir, ANIMAL, trodes_version=2)
+            elapsed.append(time.perf_counter() - start_time)
+        print('{} days x {} epochs: scandir {}, stat/lstat {}, best of {} {:.1f} ms'.format(
+            args.days, args.epochs, num_scandir, num_stat, args.repeat, min(elapsed) * 1e3))
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
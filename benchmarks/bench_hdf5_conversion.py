@@ -0,0 +1,171 @@
+"""Throughput, file size and partial read time of the HDF5 conversion
+(`TrodesPreprocessingToAnalysis`) for each datatype and a few compression /
+storage format settings.
+
+Runs on a synthetic preprocessing directory written to a temporary
+directory: one day with 2 epochs, 4 tetrodes of LFP, spikes, 2 DIO channels
+and online position. Throughput is the size of the extracted binaries
+converted per second. The partial read is 10k LFP rows (of 4 channels with
+the 'arrays' LFP layout), or 1k rows of a spike, position or DIO frame.
+
+    python benchmarks/bench_hdf5_conversion.py [--num-samples N]
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from rec_to_binaries import trodes_data as td
+from rec_to_binaries.trodes_data import TrodesPreprocessingToAnalysis
+
+ANIMAL = 'anim'
+DATE = '20200101'
+
+CONFIGS = [
+    ('none/fixed', {}),
+    ('none/table', dict(hdf_format='table')),
+    ('zlib 5/fixed', dict(complib='zlib', complevel=5)),
+    ('blosc:lz4 5/table', dict(complib='blosc:lz4', complevel=5, hdf_format='table')),
+    ('blosc:zstd 5/table', dict(complib='blosc:zstd', complevel=5, hdf_format='table')),
+    ('blosc:lz4 5/arrays', dict(complib='blosc:lz4', complevel=5, lfp_layout='arrays')),
+]
+
+# datatype, conversion method, analysis file extension, preprocessing paths
+DATATYPES = [
+    ('LFP', 'convert_lfp_day', 'lfp', 'preproc_LFP_paths'),
+    ('spikes', 'convert_spike_day', 'spikewaves', 'preproc_spike_paths'),
+    ('pos', 'convert_pos_day', 'rawpos', 'preproc_pos_paths'),
+    ('DIO', 'convert_dio_day', 'dio', 'preproc_dio_paths'),
+]
+
+
+def _write_binary(path, header, records):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(b'<Start settings>\n')
+        for key, value in header.items():
+            file.write('{}: {}\n'.format(key, value).encode())
+        file.write(b'<End settings>\n')
+        records.tofile(file)
+
+
+def make_preprocessing_data(base_dir, num_samples, seed=1):
+    """Writes extracted binaries of one synthetic day to
+    `<base_dir>/<ANIMAL>/preprocessing/<DATE>`."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(base_dir, ANIMAL, 'raw', DATE), exist_ok=True)
+    date_dir = os.path.join(base_dir, ANIMAL, 'preprocessing', DATE)
+    spike_dtype = np.dtype([('time', '<u4')] + [('waveformCh{}'.format(channel), '<i2', (40,))
+                                                 for channel in range(1, 5)])
+    dio_dtype = np.dtype([('time', '<u4'), ('state', 'u1')])
+    pos_dtype = np.dtype([('time', '<u4'), ('xloc', '<u2'), ('yloc', '<u2')])
+
+    for epoch in (1, 2):
+        base = '{}_{}_{:02d}_r{}'.format(DATE, ANIMAL, epoch, epoch)
+
+        def path(extension, name):
+            return os.path.join(date_dir, '{}.{}'.format(base, extension),
+                                '{}.{}.dat'.format(base, name))
+
+        timestamps = np.arange(num_samples, dtype=np.uint32) * 20 + epoch * 1000000
+        _write_binary(path('LFP', 'timestamps'), {'Fields': '<time uint32>'}, timestamps)
+        for ntrode in range(1, 5):
+            for channel in range(1, 5):
+                lfp = np.cumsum(rng.integers(-20, 21, num_samples)) % 4000 - 2000
+                _write_binary(path('LFP', 'LFP_nt{}ch{}'.format(ntrode, channel)),
+                              {'nTrode_ID': ntrode, 'nTrode_channel': channel,
+                               'Fields': '<voltage int16>'},
+                              lfp.astype(np.int16))
+
+            spikes = np.zeros(num_samples // 40, dtype=spike_dtype)
+            spikes['time'] = np.sort(rng.integers(0, num_samples * 20, len(spikes)))
+            for channel in range(1, 5):
+                spikes['waveformCh{}'.format(channel)] = (
+                    (np.sin(np.arange(40) / 4) * 300).astype(int) +
+                    rng.integers(-30, 30, (len(spikes), 40)))
+            _write_binary(path('spikes', 'spikes_nt{}'.format(ntrode)),
+                          {'num_channels': 4,
+                           'Fields': '<time uint32>' + ''.join(
+                               '<waveformCh{} 40*int16>'.format(channel)
+                               for channel in range(1, 5))},
+                          spikes)
+
+        for channel in (1, 2):
+            dio = np.zeros(num_samples // 100, dtype=dio_dtype)
+            dio['time'] = np.arange(len(dio)) * 100
+            dio['state'] = np.arange(len(dio)) % 2
+            _write_binary(path('DIO', 'dio_Din{}'.format(channel)),
+                          {'Fields': '<time uint32><state uint8>'}, dio)
+
+        pos = np.zeros(num_samples // 20, dtype=pos_dtype)
+        pos['time'] = np.arange(len(pos)) * 600
+        pos['xloc'] = np.cumsum(rng.integers(-1, 2, len(pos))) % 500
+        _write_binary(path('pos', '1.pos_online'),
+                      {'Fields': '<time uint32><xloc uint16><yloc uint16>'}, pos)
+        _write_binary(path('pos', '1.pos_timestamps'), {'Fields': '<time uint32>'},
+                      pos['time'].copy())
+
+
+def partial_read_ms(datatype, path):
+    """Milliseconds to read a block of rows of the first epoch."""
+    with pd.HDFStore(path, 'r') as hdf_store:
+        start_time = time.perf_counter()
+        if datatype == 'LFP':
+            key, start = 'preprocessing/LFP/e01/data', 100000
+            stop = start + 10000
+        else:
+            key = [key for key in hdf_store.keys() if '/e01' in key][0]
+            start, stop = 1000, 2000
+        if hdf_store.get_node('preprocessing/LFP/e01/channels') is not None:
+            hdf_store.get_node(key)[start:stop, :4]
+        elif hdf_store.get_storer(key).is_table:
+            hdf_store.select(key, start=start, stop=stop)
+        else:
+            hdf_store[key].iloc[start:stop]
+        return (time.perf_counter() - start_time) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--num-samples', type=int, default=600000,
+                        help='LFP samples per epoch')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    base_dir = tempfile.mkdtemp(prefix='bench_hdf5_')
+    try:
+        make_preprocessing_data(base_dir, args.num_samples)
+        anim = td.TrodesAnimalInfo(base_dir, ANIMAL, dates=[DATE])
+        complibs = td.available_hdf_complibs()
+
+        print('{:8} {:20} {:>9} {:>6} {:>16} {:>16}'.format(
+            'datatype', 'config', 'convert s', 'MB/s', 'size MB (raw)', 'partial read ms'))
+        for datatype, convert_method, extension, paths_attr in DATATYPES:
+            paths = getattr(anim, paths_attr)
+            raw_mb = paths[paths.date == DATE].path.map(os.path.getsize).sum() / 1e6
+            for name, kwargs in CONFIGS:
+                if kwargs.get('complib', 'zlib') not in complibs or (
+                        'lfp_layout' in kwargs and datatype != 'LFP'):
+                    continue
+                shutil.rmtree(anim.get_analysis_dir(), ignore_errors=True)
+                converter = TrodesPreprocessingToAnalysis(anim, **kwargs)
+                start_time = time.perf_counter()
+                getattr(converter, convert_method)(DATE)
+                elapsed = time.perf_counter() - start_time
+                path = os.path.join(anim.get_analysis_dir(),
+                                    '{}_{}_{}.h5'.format(DATE, ANIMAL, extension))
+                print('{:8} {:20} {:9.2f} {:6.0f} {:>16} {:16.1f}'.format(
+                    datatype, name, elapsed, raw_mb / elapsed,
+                    '{:.1f} ({:.1f})'.format(os.path.getsize(path) / 1e6, raw_mb),
+                    partial_read_ms(datatype, path)))
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,17 +6,32 @@ fairly sporadic, we can recover the correspondence between trodestime
 and system (wall) time.
 """
 
+import contextlib
+import functools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
 from logging import getLogger
 
 import numpy as np
-import pandas as pd
-from rec_to_binaries.create_system_time import infer_systime
+from rec_to_binaries.create_system_time import create_systime, infer_systime
 from rec_to_binaries.read_binaries import (readTrodesExtractedDataFile,
-                                           write_trodes_extracted_datafile)
+                                           write_trodes_extracted_datafile,
+                                           write_trodes_extracted_header)
 from scipy.stats import linregress
 
 logger = getLogger(__name__)
 
+NANOSECONDS_TO_SECONDS = 1E9
+
+# header keys of the compact layout (see `_fix_timestamp_lag_compact`)
+_COMPACT_HEADER_KEYS = ('time_chunk_starts', 'time_chunk_first_label',
+                        'adjusted_systime_model', 'adjusted_systime_slope',
+                        'adjusted_systime_intercept')
+
 
 def _label_time_chunks(trodestime):
     """Labels each consecutive chunk of time with an integer.
@@ -53,20 +68,45 @@ def _regress_timestamps(trodestime, systime):
         Unix time
 
     """
-    NANOSECONDS_TO_SECONDS = 1E9
-
     # Convert
     systime_seconds = np.asarray(systime).astype(
         np.float64) / NANOSECONDS_TO_SECONDS
     trodestime_index = np.asarray(trodestime).astype(np.float64)
 
+    if trodestime_index.size == 0 or np.ptp(trodestime_index) == 0:
+        # nothing to regress on (e.g. a one-record file), keep systime
+        return np.asarray(systime).astype(np.int64)
     slope, intercept, r_value, p_value, std_err = linregress(
         trodestime_index, systime_seconds)
     adjusted_timestamps = intercept + slope * trodestime_index
     return (adjusted_timestamps * NANOSECONDS_TO_SECONDS).astype(np.int64)
 
 
-def _insert_new_data(data_file, df):
+def _adjusted_dtype(data_dtype):
+    """Record layout of an adjusted continuoustime file: the original fields
+    (with `systime` added if missing) followed by `time_chunk_label` and
+    `adjusted_systime`.
+
+    Parameters
+    ----------
+    data_dtype : numpy.dtype
+        Record layout of the original file
+
+    Returns
+    -------
+    adjusted_dtype : numpy.dtype
+
+    """
+    fields = [(name, data_dtype[name]) for name in data_dtype.names
+              if name not in ('time_chunk_label', 'adjusted_systime')]
+    if 'systime' not in data_dtype.names:
+        fields.append(('systime', np.dtype(np.int64)))
+    fields += [('time_chunk_label', np.dtype(np.int64)),
+               ('adjusted_systime', np.dtype(np.int64))]
+    return np.dtype(fields)
+
+
+def _insert_new_data(data_file, new_data):
     """
     Replaces the `data` in the extracted data file with a new one.
 
@@ -74,8 +114,8 @@ def _insert_new_data(data_file, df):
     ----------
     data_file : dict
         Original data file as read in by `readTrodesExtractedDataFile`
-    df : pandas.DataFrame
-        New data
+    new_data : numpy.ndarray
+        New data, structured array
 
     Returns
     -------
@@ -83,8 +123,9 @@ def _insert_new_data(data_file, df):
         Updated data file
 
     """
-    new_data_file = data_file.copy()
-    new_data_file['data'] = np.asarray(df.to_records(index=False))
+    new_data_file = {key: value for key, value in data_file.items()
+                     if key not in _COMPACT_HEADER_KEYS}
+    new_data_file['data'] = new_data
     new_data_file['fields'] = ''.join(
         [f'<{name} {dtype}>'
          for name, (dtype, _) in new_data_file['data'].dtype.fields.items()])
@@ -92,7 +133,8 @@ def _insert_new_data(data_file, df):
     return new_data_file
 
 
-def fix_timestamp_lag(continuoustime_filename):
+def fix_timestamp_lag(continuoustime_filename, chunk_size=None,
+                      compact=False):
     """
     Fix the correspondence between trodestime
     and system (wall) time.
@@ -108,22 +150,428 @@ def fix_timestamp_lag(continuoustime_filename):
     ----------
     continuoustime_filename : str
         Path to .continuoustime.dat file
+    chunk_size : int, optional
+        If given, process the file in chunks of this many samples so that
+        memory use does not grow with the recording length (see
+        `_fix_timestamp_lag_chunked`).
+    compact : bool, optional
+        If True, store the time chunk boundaries and the adjusted time model
+        in the header instead of adding per-sample `time_chunk_label` and
+        `adjusted_systime` columns (see `_fix_timestamp_lag_compact`). Read
+        such files with `ContinuousTimeFile`.
 
     """
+    if compact:
+        _fix_timestamp_lag_compact(continuoustime_filename, chunk_size)
+        return
+    if chunk_size is not None:
+        _fix_timestamp_lag_chunked(continuoustime_filename, chunk_size)
+        return
+
     data_file = readTrodesExtractedDataFile(continuoustime_filename)
 
-    if 'systime' not in data_file['data'].dtype.names:
-        logger.warn("No `systime`. Inferring from `system_time_at_creation` timestamp"
-                    " as a function of the `clockrate` and `trodestime`")
+    data = data_file['data']
+    if 'systime' not in data.dtype.names:
+        logger.warning("No `systime`. Inferring from `system_time_at_creation` timestamp"
+                       " as a function of the `clockrate` and `trodestime`")
         new_data = infer_systime(data_file)
     else:
-        new_data = (
-            pd.DataFrame(data_file['data'])
-            .assign(
-                time_chunk_label=lambda df: _label_time_chunks(df.trodestime))
-            .assign(
-                adjusted_systime=lambda df: _regress_timestamps(df.trodestime,
-                                                                df.systime)))
+        new_data = np.empty(data.shape, dtype=_adjusted_dtype(data.dtype))
+        for name in data.dtype.names:
+            if name in new_data.dtype.names:
+                new_data[name] = data[name]
+        new_data['time_chunk_label'] = _label_time_chunks(data['trodestime'])
+        new_data['adjusted_systime'] = _regress_timestamps(data['trodestime'],
+                                                           data['systime'])
 
     new_data_file = _insert_new_data(data_file, new_data)
     write_trodes_extracted_datafile(continuoustime_filename, new_data_file)
+
+
+def _update_regression_stats(stats, trodestime, systime):
+    """Merges a chunk into running regression statistics.
+
+    Chunks are combined with centered sums (Chan et al.'s pairwise update)
+    rather than raw sums of squares, which would lose all precision for
+    timestamps of this magnitude.
+
+    Parameters
+    ----------
+    stats : tuple
+        (n, mean_x, mean_y, sum_xx, sum_xy) of the chunks so far, sums
+        centered on the means
+    trodestime : array_like
+    systime : array_like, int64
+        Unix time in nanoseconds
+
+    Returns
+    -------
+    stats : tuple
+
+    """
+    x = np.asarray(trodestime).astype(np.float64)
+    y = np.asarray(systime).astype(np.float64) / NANOSECONDS_TO_SECONDS
+    n_b = x.shape[0]
+    if n_b == 0:
+        return stats
+    mean_x_b, mean_y_b = x.mean(), y.mean()
+    sum_xx_b = np.sum((x - mean_x_b) ** 2)
+    sum_xy_b = np.sum((x - mean_x_b) * (y - mean_y_b))
+
+    n_a, mean_x_a, mean_y_a, sum_xx_a, sum_xy_a = stats
+    n = n_a + n_b
+    delta_x = mean_x_b - mean_x_a
+    delta_y = mean_y_b - mean_y_a
+    return (n,
+            mean_x_a + delta_x * n_b / n,
+            mean_y_a + delta_y * n_b / n,
+            sum_xx_a + sum_xx_b + delta_x ** 2 * n_a * n_b / n,
+            sum_xy_a + sum_xy_b + delta_x * delta_y * n_a * n_b / n)
+
+
+def _regression_line(stats):
+    """Slope and intercept of the regression of systime (in seconds) on
+    trodestime from `_update_regression_stats` statistics.
+
+    Without any spread in trodestime (an empty or one-record file) the line
+    is flat at the mean systime, which keeps systime as it is.
+
+    Parameters
+    ----------
+    stats : tuple
+        (n, mean_x, mean_y, sum_xx, sum_xy)
+
+    Returns
+    -------
+    slope, intercept : float
+
+    """
+    n, mean_x, mean_y, sum_xx, sum_xy = stats
+    if n == 0 or sum_xx == 0:
+        return 0.0, mean_y
+    slope = sum_xy / sum_xx
+    return slope, mean_y - slope * mean_x
+
+
+def _fix_timestamp_lag_chunked(continuoustime_filename, chunk_size):
+    """Bounded-memory version of `fix_timestamp_lag`.
+
+    A first pass over the memory-mapped file accumulates the statistics of
+    the regression of systime on trodestime. A second pass writes the
+    original fields plus `time_chunk_label` and `adjusted_systime` chunk by
+    chunk to a temporary file, which then replaces the original.
+
+    Parameters
+    ----------
+    continuoustime_filename : str
+        Path to .continuoustime.dat file
+    chunk_size : int
+        Number of samples per chunk
+
+    """
+    data_file = readTrodesExtractedDataFile(continuoustime_filename,
+                                            mmap=True)
+    data = data_file.pop('data')
+    for key in _COMPACT_HEADER_KEYS:
+        data_file.pop(key, None)
+    n_time = data.shape[0]
+    has_systime = 'systime' in data.dtype.names
+    if not has_systime:
+        logger.warning("No `systime`. Inferring from `system_time_at_creation` timestamp"
+                       " as a function of the `clockrate` and `trodestime`")
+
+    out_dtype = _adjusted_dtype(data.dtype)
+    data_file['fields'] = ''.join(
+        [f'<{name} {dtype}>'
+         for name, (dtype, _) in out_dtype.fields.items()])
+
+    chunk_starts = range(0, n_time, chunk_size)
+
+    if has_systime:
+        stats = (0, 0.0, 0.0, 0.0, 0.0)
+        for start in chunk_starts:
+            chunk = data[start:start + chunk_size]
+            stats = _update_regression_stats(
+                stats, chunk['trodestime'], chunk['systime'])
+        slope, intercept = _regression_line(stats)
+
+    out_dir = os.path.dirname(os.path.abspath(continuoustime_filename))
+    with tempfile.NamedTemporaryFile(dir=out_dir, delete=False) as out_file:
+        try:
+            write_trodes_extracted_header(out_file, data_file)
+            out_chunk = np.empty(min(chunk_size, n_time), dtype=out_dtype)
+            previous_trodestime = None
+            time_chunk_label = 0
+            for start in chunk_starts:
+                chunk = data[start:start + chunk_size]
+                out = out_chunk[:chunk.shape[0]]
+                for name in data.dtype.names:
+                    if name in out_dtype.names:
+                        out[name] = chunk[name]
+
+                if has_systime:
+                    trodestime = chunk['trodestime']
+                    if previous_trodestime is None:
+                        is_gap = np.insert(np.diff(trodestime) > 1, 0, False)
+                    else:
+                        is_gap = np.diff(trodestime, prepend=previous_trodestime) > 1
+                    np.cumsum(is_gap, out=out['time_chunk_label'])
+                    out['time_chunk_label'] += time_chunk_label
+                    time_chunk_label = out['time_chunk_label'][-1]
+                    previous_trodestime = trodestime[-1]
+                    out['adjusted_systime'] = (
+                        (intercept + slope * trodestime.astype(np.float64)) *
+                        NANOSECONDS_TO_SECONDS)
+                else:
+                    out['systime'] = create_systime(
+                        data_file['clockrate'], chunk,
+                        data_file['system_time_at_creation'],
+                        start_index=start)
+                    out['time_chunk_label'] = 1
+                    out['adjusted_systime'] = out['systime']
+
+                out.tofile(out_file)
+        except BaseException:
+            os.remove(out_file.name)
+            raise
+
+    del data
+    # temporary files are created private, keep the original permissions
+    shutil.copymode(continuoustime_filename, out_file.name)
+    os.replace(out_file.name, continuoustime_filename)
+
+
+def _fix_timestamp_lag_compact(continuoustime_filename, chunk_size=None):
+    """Compact version of `fix_timestamp_lag`.
+
+    Instead of adding per-sample `time_chunk_label` and `adjusted_systime`
+    columns, the header stores what they are computed from: the sample
+    index at which each time chunk starts and the linear model of
+    adjusted_systime. The records themselves are left as exported. Read
+    the file with `ContinuousTimeFile` to get the labels and adjusted time
+    of any index range.
+
+    Header keys written:
+
+    time_chunk_starts : comma separated sample indices, first is always 0
+    time_chunk_first_label : label of the first chunk
+    adjusted_systime_model : `trodestime` (regression of systime on
+        trodestime) or `clockrate` (extrapolated from
+        system_time_at_creation, for files without `systime`)
+    adjusted_systime_slope, adjusted_systime_intercept : regression
+        coefficients in seconds, for the `trodestime` model
+
+    Parameters
+    ----------
+    continuoustime_filename : str
+        Path to .continuoustime.dat file
+    chunk_size : int, optional
+        Number of samples read at a time. Defaults to the whole file.
+
+    """
+    data_file = readTrodesExtractedDataFile(continuoustime_filename,
+                                            mmap=True)
+    data = data_file.pop('data')
+    for key in _COMPACT_HEADER_KEYS:
+        data_file.pop(key, None)
+    n_time = data.shape[0]
+    if chunk_size is None:
+        chunk_size = max(n_time, 1)
+    chunk_starts = range(0, n_time, chunk_size)
+
+    # drop columns left by an earlier non-compact adjustment
+    out_dtype = np.dtype([(name, data.dtype[name])
+                          for name in data.dtype.names
+                          if name not in ('time_chunk_label',
+                                          'adjusted_systime')])
+    data_file['fields'] = ''.join(
+        [f'<{name} {dtype}>'
+         for name, (dtype, _) in out_dtype.fields.items()])
+
+    if 'systime' in data.dtype.names:
+        stats = (0, 0.0, 0.0, 0.0, 0.0)
+        time_chunk_starts = [0]
+        previous_trodestime = None
+        for start in chunk_starts:
+            trodestime = data['trodestime'][start:start + chunk_size]
+            stats = _update_regression_stats(
+                stats, trodestime,
+                data['systime'][start:start + chunk_size])
+            if previous_trodestime is None:
+                is_gap = np.diff(trodestime) > 1
+                offset = start + 1
+            else:
+                is_gap = np.diff(trodestime, prepend=previous_trodestime) > 1
+                offset = start
+            time_chunk_starts.extend((np.flatnonzero(is_gap) + offset).tolist())
+            previous_trodestime = trodestime[-1]
+        slope, intercept = _regression_line(stats)
+        data_file['time_chunk_starts'] = ','.join(map(str, time_chunk_starts))
+        data_file['time_chunk_first_label'] = 0
+        data_file['adjusted_systime_model'] = 'trodestime'
+        data_file['adjusted_systime_slope'] = repr(float(slope))
+        data_file['adjusted_systime_intercept'] = repr(float(intercept))
+    else:
+        logger.warning("No `systime`. Inferring from `system_time_at_creation` timestamp"
+                       " as a function of the `clockrate` and `trodestime`")
+        data_file['time_chunk_starts'] = '0'
+        data_file['time_chunk_first_label'] = 1
+        data_file['adjusted_systime_model'] = 'clockrate'
+
+    out_dir = os.path.dirname(os.path.abspath(continuoustime_filename))
+    with tempfile.NamedTemporaryFile(dir=out_dir, delete=False) as out_file:
+        try:
+            write_trodes_extracted_header(out_file, data_file)
+            out_file.flush()
+            for start in chunk_starts:
+                chunk = data[start:start + chunk_size]
+                if out_dtype == data.dtype:
+                    chunk.tofile(out_file)
+                else:
+                    out = np.empty(chunk.shape, dtype=out_dtype)
+                    for name in out_dtype.names:
+                        out[name] = chunk[name]
+                    out.tofile(out_file)
+        except BaseException:
+            os.remove(out_file.name)
+            raise
+
+    del data
+    shutil.copymode(continuoustime_filename, out_file.name)
+    os.replace(out_file.name, continuoustime_filename)
+
+
+class ContinuousTimeFile:
+    """Reads a continuoustime file adjusted by `fix_timestamp_lag`, in either
+    the full or the compact layout.
+
+    `trodestime`, `systime`, `time_chunk_label` and `adjusted_systime` take
+    a sample index range and only read or compute that range, so the cost
+    is proportional to the range rather than to the file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to .continuoustime.dat file
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.header = readTrodesExtractedDataFile(filename, mmap=True)
+        self.data = self.header.pop('data')
+        self.is_compact = 'adjusted_systime_model' in self.header
+        if self.is_compact:
+            self.time_chunk_starts = np.array(
+                self.header['time_chunk_starts'].split(','), dtype=np.int64)
+            self.time_chunk_first_label = int(
+                self.header['time_chunk_first_label'])
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def _slice(self, start, stop):
+        return slice(*slice(start, stop).indices(len(self))[:2])
+
+    def trodestime(self, start=None, stop=None):
+        return np.asarray(self.data['trodestime'][self._slice(start, stop)])
+
+    def systime(self, start=None, stop=None):
+        """Unix time in nanoseconds, extrapolated from the header if the file
+        has no `systime` field."""
+        index = self._slice(start, stop)
+        if 'systime' in self.data.dtype.names:
+            return np.asarray(self.data['systime'][index])
+        return create_systime(self.header['clockrate'],
+                              self.data[index],
+                              self.header['system_time_at_creation'],
+                              start_index=index.start)
+
+    def time_chunk_label(self, start=None, stop=None):
+        index = self._slice(start, stop)
+        if not self.is_compact:
+            return np.asarray(self.data['time_chunk_label'][index])
+        first_chunk = np.searchsorted(
+            self.time_chunk_starts, index.start, side='right') - 1
+        last_chunk = np.searchsorted(
+            self.time_chunk_starts, index.stop, side='left')
+        bounds = self.time_chunk_starts[first_chunk:last_chunk + 1].copy()
+        bounds[0] = index.start
+        bounds = np.append(bounds[bounds < index.stop], index.stop)
+        labels = np.arange(first_chunk, first_chunk + bounds.shape[0] - 1,
+                           dtype=np.int64) + self.time_chunk_first_label
+        return np.repeat(labels, np.diff(bounds))
+
+    def adjusted_systime(self, start=None, stop=None):
+        """Unix time in nanoseconds"""
+        index = self._slice(start, stop)
+        if not self.is_compact:
+            return np.asarray(self.data['adjusted_systime'][index])
+        if self.header['adjusted_systime_model'] == 'clockrate':
+            return self.systime(index.start, index.stop)
+        slope = float(self.header['adjusted_systime_slope'])
+        intercept = float(self.header['adjusted_systime_intercept'])
+        trodestime = self.data['trodestime'][index].astype(np.float64)
+        return ((intercept + slope * trodestime) *
+                NANOSECONDS_TO_SECONDS).astype(np.int64)
+
+
+def _timed_fix_timestamp_lag(continuoustime_filename, chunk_size=None,
+                             compact=False):
+    """Runs `fix_timestamp_lag`, returning its duration and any error
+    instead of raising, so one bad file does not stop a batch."""
+    start_time = time.time()
+    try:
+        fix_timestamp_lag(continuoustime_filename, chunk_size=chunk_size,
+                          compact=compact)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return continuoustime_filename, time.time() - start_time, error
+
+
+def fix_timestamp_lag_files(continuoustime_filenames, parallel_instances=1,
+                            chunk_size=None, compact=False):
+    """Runs `fix_timestamp_lag` on several files with a process pool.
+
+    Each file's duration is logged as it finishes. Failures are logged and
+    returned rather than raised, so the remaining files are still processed.
+
+    Parameters
+    ----------
+    continuoustime_filenames : list of str
+        Paths to .continuoustime.dat files
+    parallel_instances : int, optional
+        Number of worker processes.
+    chunk_size : int, optional
+        Passed to `fix_timestamp_lag`.
+    compact : bool, optional
+        Passed to `fix_timestamp_lag`.
+
+    Returns
+    -------
+    failed : dict
+        Filename -> traceback of each file that could not be adjusted
+
+    """
+    fix_file = functools.partial(_timed_fix_timestamp_lag,
+                                 chunk_size=chunk_size, compact=compact)
+    n_processes = min(parallel_instances, len(continuoustime_filenames))
+    failed = {}
+
+    with contextlib.ExitStack() as stack:
+        if n_processes > 1:
+            pool = stack.enter_context(multiprocessing.Pool(n_processes))
+            results = pool.imap_unordered(fix_file, continuoustime_filenames)
+        else:
+            results = map(fix_file, continuoustime_filenames)
+
+        for filename, elapsed, error in results:
+            if error is None:
+                logger.info(f'Adjusted timestamps of {filename} in {elapsed:.1f} s')
+            else:
+                logger.warning(f'Adjusting timestamps of {filename} failed after '
+                               f'{elapsed:.1f} s:\n{error}')
+                failed[filename] = error
+
+    return failed
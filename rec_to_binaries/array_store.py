@@ -0,0 +1,203 @@
+"""Chunked directory stores for the analysis stage.
+
+Each dataset is an n-dimensional array split into chunks, stored under a
+directory with one entry per chunk. Writers of different chunks (e.g.
+different channels or ntrodes) do not share a file handle and can run
+concurrently, and readers only load the chunks they need.
+
+Zarr is used if it is installed. Otherwise arrays are stored as one `.npy`
+file per chunk plus a `manifest.json` with the shape, dtype, chunk shape and
+attributes of the array.
+"""
+
+import itertools
+import json
+import os
+import shutil
+
+import numpy as np
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+class ArrayStoreError(RuntimeError):
+    pass
+
+
+def open_array_store(path, backend=None):
+    """Opens (creating if needed) a chunked array store.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store
+    backend : {None, 'zarr', 'npy'}, optional
+        None picks 'zarr' if it is installed, else 'npy'.
+
+    Returns
+    -------
+    store : ZarrArrayStore or NpyArrayStore
+
+    """
+    if backend is None:
+        backend = 'zarr' if zarr is not None else 'npy'
+    if backend == 'zarr':
+        if zarr is None:
+            raise ArrayStoreError('The zarr backend requires the zarr package.')
+        return ZarrArrayStore(path)
+    if backend == 'npy':
+        return NpyArrayStore(path)
+    raise ValueError("backend must be 'zarr' or 'npy', not {!r}".format(backend))
+
+
+def _chunk_ranges(offset, shape, chunks, array_shape):
+    """Chunk grid indices covered by the region `offset`, `shape`, checking
+    that it starts and ends on chunk boundaries (or the end of the array)."""
+    ranges = []
+    for start, length, chunk, size in zip(offset, shape, chunks, array_shape):
+        stop = start + length
+        if start % chunk or (stop % chunk and stop != size) or stop > size:
+            raise ArrayStoreError(
+                'Write of {} at {} is not aligned to chunks {} of an array of shape {}.'
+                .format(shape, offset, chunks, array_shape))
+        ranges.append(range(start // chunk, -(-stop // chunk)))
+    return ranges
+
+
+class NpyArrayStore:
+    """Directory of arrays stored as `.npy` chunks, see `NpyChunkedArray`."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def create_array(self, name, shape, dtype, chunks, attrs=None):
+        """Creates (replacing any existing) array `name`, a '/' separated
+        path inside the store."""
+        array_path = os.path.join(self.path, *name.split('/'))
+        if os.path.exists(array_path):
+            shutil.rmtree(array_path)
+        os.makedirs(array_path)
+        manifest = {'shape': [int(size) for size in shape],
+                    'dtype': np.dtype(dtype).str,
+                    'chunks': [int(chunk) for chunk in chunks],
+                    'attrs': attrs or {}}
+        with open(os.path.join(array_path, NpyChunkedArray.manifest_filename), 'w') as file:
+            json.dump(manifest, file)
+        return NpyChunkedArray(array_path)
+
+    def open_array(self, name):
+        return NpyChunkedArray(os.path.join(self.path, *name.split('/')))
+
+
+class NpyChunkedArray:
+    """Array stored as one `{i}.{j}...npy` file per chunk, chunk indices
+    along each axis, and a JSON manifest.
+
+    Chunks that were never written read as zeros.
+    """
+
+    manifest_filename = 'manifest.json'
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, self.manifest_filename)) as file:
+            manifest = json.load(file)
+        self.shape = tuple(manifest['shape'])
+        self.dtype = np.dtype(manifest['dtype'])
+        self.chunks = tuple(manifest['chunks'])
+        self.attrs = manifest['attrs']
+
+    def _chunk_filename(self, chunk_index):
+        return os.path.join(self.path, '.'.join(map(str, chunk_index)) + '.npy')
+
+    def write(self, data, offset=None):
+        """Writes `data` at `offset` (all zeros by default). The region must
+        cover whole chunks, except at the end of the array."""
+        data = np.asarray(data, dtype=self.dtype)
+        if offset is None:
+            offset = (0,) * len(self.shape)
+        for chunk_index in itertools.product(
+                *_chunk_ranges(offset, data.shape, self.chunks, self.shape)):
+            region = tuple(
+                slice(index * chunk - start, min((index + 1) * chunk, size) - start)
+                for index, chunk, start, size in zip(chunk_index, self.chunks, offset, self.shape))
+            np.save(self._chunk_filename(chunk_index), np.ascontiguousarray(data[region]))
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (len(self.shape) - len(key))
+        bounds = []
+        squeeze = []
+        for axis, (index, size) in enumerate(zip(key, self.shape)):
+            if isinstance(index, slice):
+                start, stop, step = index.indices(size)
+                if step != 1:
+                    raise ArrayStoreError('Only contiguous slices are supported.')
+                bounds.append((start, max(start, stop)))
+            else:
+                index = int(index) + size if index < 0 else int(index)
+                bounds.append((index, index + 1))
+                squeeze.append(axis)
+
+        out = np.zeros([stop - start for start, stop in bounds], dtype=self.dtype)
+        chunk_ranges = [range(start // chunk, -(-stop // chunk))
+                        for (start, stop), chunk in zip(bounds, self.chunks)]
+        for chunk_index in itertools.product(*chunk_ranges):
+            filename = self._chunk_filename(chunk_index)
+            if not os.path.exists(filename):
+                continue
+            chunk_data = np.load(filename, mmap_mode='r')
+            chunk_region = []
+            out_region = []
+            for index, chunk, (start, stop) in zip(chunk_index, self.chunks, bounds):
+                chunk_start = index * chunk
+                low, high = max(start, chunk_start), min(stop, chunk_start + chunk)
+                chunk_region.append(slice(low - chunk_start, high - chunk_start))
+                out_region.append(slice(low - start, high - start))
+            out[tuple(out_region)] = chunk_data[tuple(chunk_region)]
+        return out.squeeze(axis=tuple(squeeze)) if squeeze else out
+
+
+class ZarrArrayStore:
+    """Zarr group with the same interface as `NpyArrayStore`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.group = zarr.open_group(path, mode='a')
+
+    def create_array(self, name, shape, dtype, chunks, attrs=None):
+        create = getattr(self.group, 'create_array', None) or self.group.create_dataset
+        array = create(name, shape=tuple(shape), dtype=dtype, chunks=tuple(chunks),
+                       overwrite=True)
+        if attrs:
+            array.attrs.update(attrs)
+        return ZarrChunkedArray(array)
+
+    def open_array(self, name):
+        return ZarrChunkedArray(self.group[name])
+
+
+class ZarrChunkedArray:
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = tuple(array.shape)
+        self.dtype = np.dtype(array.dtype)
+        self.chunks = tuple(array.chunks)
+        self.attrs = dict(array.attrs)
+
+    def write(self, data, offset=None):
+        data = np.asarray(data, dtype=self.dtype)
+        if offset is None:
+            offset = (0,) * len(self.shape)
+        _chunk_ranges(offset, data.shape, self.chunks, self.shape)
+        self.array[tuple(slice(start, start + length)
+                         for start, length in zip(offset, data.shape))] = data
+
+    def __getitem__(self, key):
+        return self.array[key]
@@ -1,8 +1,8 @@
-import functools
-import struct
+import os
 
 import numpy as np
 import pandas as pd
+from rec_to_binaries.read_binaries import parse_dtype
 
 
 class TrodesBinaryFormatError(RuntimeError):
@@ -33,9 +33,28 @@ class TrodesBinaryReader:
 
             self.data_start_byte = file.tell()
 
+    def _read_records(self, dtype, mmap=False):
+        """Reads every complete record after the header in one call,
+        truncating a trailing partial record. If `mmap` is True, the records
+        are returned as a read-only np.memmap instead of being loaded.
+        """
+        dtype = np.dtype(dtype)
+        data_size = os.path.getsize(self.path) - self.data_start_byte
+        num_records, remainder = divmod(data_size, dtype.itemsize)
+        if remainder:
+            print(('{}: for file {:} found an incomplete record, '
+                   'truncating before record.').format(
+                       self.__class__.__name__, self.path))
+        if mmap and num_records > 0:
+            return np.memmap(self.path, dtype=dtype, mode='r',
+                             offset=self.data_start_byte,
+                             shape=(num_records,))
+        return np.fromfile(self.path, dtype=dtype, count=num_records,
+                           offset=self.data_start_byte)
+
 
 class TrodesLFPBinaryLoader(TrodesBinaryReader):
-    def __init__(self, path):
+    def __init__(self, path, mmap=False):
         super().__init__(path)
 
         # parse out basic header info
@@ -50,14 +69,11 @@ class TrodesLFPBinaryLoader(TrodesBinaryReader):
         self.low_pass_filter = self.header_params.get('Low_pass_filter')
         self.field_str = self.header_params.get('Fields')
 
-        with open(self.path, 'rb') as file:
-            file.seek(self.data_start_byte)
-            byte_data = file.read()
-            self.data = np.frombuffer(byte_data, dtype=np.dtype('int16'))
+        self.data = self._read_records(np.dtype('int16'), mmap=mmap)
 
 
 class TrodesTimestampBinaryLoader(TrodesBinaryReader):
-    def __init__(self, path):
+    def __init__(self, path, mmap=False):
         super().__init__(path)
 
         # parse out basic header info
@@ -68,14 +84,11 @@ class TrodesTimestampBinaryLoader(TrodesBinaryReader):
         self.time_offset = self.header_params.get('Time_offset')
         self.field_str = self.header_params.get('Fields')
 
-        with open(self.path, 'rb') as file:
-            file.seek(self.data_start_byte)
-            byte_data = file.read()
-            self.data = np.frombuffer(byte_data, dtype=np.dtype('uint32'))
+        self.data = self._read_records(np.dtype('uint32'), mmap=mmap)
 
 
 class TrodesSpikeBinaryLoader(TrodesBinaryReader):
-    def __init__(self, path):
+    def __init__(self, path, mmap=False):
         super().__init__(path)
 
         # parse out basic header info
@@ -95,53 +108,61 @@ class TrodesSpikeBinaryLoader(TrodesBinaryReader):
         self.high_pass_filter = self.header_params.get('highPassFilter')
         self.field_str = self.header_params.get('Fields')
 
-        # size of binary record size, assuming 40 samples per channel, 2 byte per sample, and 4 byte timestamp
-        self.num_samples_per_spike = 40
-        self.spike_rec_size = self.num_channels * self.num_samples_per_spike * 2 + 4
-        self.unpack_format = 'I' + \
-            ('{:d}h'.format(self.num_samples_per_spike)) * self.num_channels
-        self.timestamps = []
-        spikes_np = []
-        with open(self.path, 'rb') as file:
-            file.seek(self.data_start_byte)
-            try:
-                for spike_rec_bytes in iter(functools.partial(file.read, self.spike_rec_size), b''):
-                    spike_rec = struct.unpack(
-                        self.unpack_format, spike_rec_bytes)
-                    self.timestamps.append(spike_rec[0])
-                    spikes_np.append(np.reshape(np.array(spike_rec[1:], dtype='int16'),
-                                                (self.num_channels, self.num_samples_per_spike)))
-            except struct.error:
-                print(('TrodesSpikeBinaryLoader: for file {:} found an incomplete spike record, '
-                       'truncating before record.').format(self.path))
-
-        # convert list np.arrays into pure np.array
-        spikes_np = np.array(spikes_np, dtype='int16')
-
-        # transpose 3D array to fit intuitive pd.Panel notation
-        # items (spike sample) x major_axis (spike timestamps) x minor_axis (channels)
-        try:
-            spikes_np = spikes_np.transpose(2, 0, 1)
-        except ValueError:
-            print(('TrodesSpikeBinaryLoader: for file {:} failed spike transpose, '
-                   'likely no spikes in file?').format(self.path))
-
-        try:
-            # channels and ntrode are 1-indexed (really should be channel name), but samples are 0 index
-            self.spikes = pd.Panel(spikes_np, items=pd.Index(range(self.num_samples_per_spike), name='spike_sample'),
-                                   major_axis=pd.Index(
-                                       self.timestamps, name='timestamp'),
-                                   minor_axis=pd.Index(range(1, self.num_channels + 1), name='channel'))
-        except ValueError:
-            print(('TrodesSpikeBinaryLoader: for file {:} failed panel creation, bad dimensions. '
-                   'No spikes created from file.').format(self.path))
-            self.spikes = pd.Panel(items=pd.Index([], name='spike_sample'),
-                                   major_axis=pd.Index([], name='timestamp'),
-                                   minor_axis=pd.Index([], name='channel'))
+        # each record is a uint32 timestamp followed by one block of waveform
+        # samples per channel, as described by the Fields header
+        if self.field_str is not None:
+            field_dtype = parse_dtype(self.field_str)
+            waveform_size = sum(field_dtype[name].itemsize
+                                for name in field_dtype.names[1:])
+            self.num_samples_per_spike = (
+                waveform_size // (2 * self.num_channels))
+        else:
+            self.num_samples_per_spike = 40
+        self.spike_dtype = np.dtype(
+            [('time', np.uint32),
+             ('waveform', np.int16,
+              (self.num_channels, self.num_samples_per_spike))])
+        self.spike_rec_size = self.spike_dtype.itemsize
+
+        spike_records = self._read_records(self.spike_dtype, mmap=mmap)
+
+        self.timestamps = spike_records['time']
+        # (n_spikes, n_channels, n_samples)
+        self.waveforms = spike_records['waveform']
+
+    @property
+    def spikes(self):
+        """Waveforms as a DataFrame indexed by timestamp with one column per
+        (channel, spike_sample). Channels are 1-indexed, samples 0-indexed.
+        """
+        return spikes_dataframe(self.timestamps, self.waveforms)
+
+
+def spikes_dataframe(timestamps, waveforms, copy=False):
+    """Builds the `TrodesSpikeBinaryLoader.spikes` DataFrame from spike
+    timestamps and (n_spikes, n_channels, n_samples) waveforms. Set `copy`
+    if the arrays are views of memory that will be released.
+    """
+    num_spikes, num_channels, num_samples_per_spike = waveforms.shape
+    columns = pd.MultiIndex.from_product(
+        [range(1, num_channels + 1),
+         range(num_samples_per_spike)],
+        names=['channel', 'spike_sample'])
+    if num_spikes == 0:
+        # ntrode without spikes
+        return pd.DataFrame(
+            np.empty((0, len(columns)), dtype=waveforms.dtype),
+            index=pd.Index(np.asarray(timestamps)[:0], name='timestamp'),
+            columns=columns)
+    return pd.DataFrame(
+        waveforms.reshape((num_spikes, num_channels * num_samples_per_spike)),
+        index=pd.Index(timestamps, name='timestamp', copy=copy),
+        columns=columns,
+        copy=copy)
 
 
 class TrodesPosBinaryLoader(TrodesBinaryReader):
-    def __init__(self, path):
+    def __init__(self, path, mmap=False):
         super().__init__(path)
 
         # parse out basic header info
@@ -150,24 +171,33 @@ class TrodesPosBinaryLoader(TrodesBinaryReader):
         self.clockrate = self.header_params.get('clockrate')
         self.field_str = self.header_params.get('Fields')
 
-        # uint timestamp, 4 uint16 coordinates (x1, y1, x2, y2) for two diodes
-        self.rec_size = 4 + 2 * 4
-        self.unpack_format = 'IHHHH'
-
-        pos_list = []
-
-        with open(self.path, 'rb') as file:
-            file.seek(self.data_start_byte)
-            for pos_rec_bytes in iter(functools.partial(file.read, self.rec_size), b''):
-                pos_rec = struct.unpack(self.unpack_format, pos_rec_bytes)
-                pos_list.append(pos_rec)
-
-        self.pos = pd.DataFrame(
-            pos_list, columns=['timestamp', 'x1', 'y1', 'x2', 'y2']).set_index('timestamp')
+        # default: uint timestamp, 4 uint16 coordinates (x1, y1, x2, y2) for
+        # two diodes
+        if self.field_str is not None:
+            self.pos_dtype = parse_dtype(self.field_str)
+        else:
+            self.pos_dtype = np.dtype([('timestamp', np.uint32),
+                                       ('x1', np.uint16), ('y1', np.uint16),
+                                       ('x2', np.uint16), ('y2', np.uint16)])
+        self.rec_size = self.pos_dtype.itemsize
+
+        self.data = self._read_records(self.pos_dtype, mmap=mmap)
+
+    @property
+    def pos(self):
+        """Position records as a DataFrame indexed by timestamp, with
+        columns x1, y1, x2, y2 (x1, y1 for a single diode) whatever the
+        field names in the file header are."""
+        time_field, *pos_fields = self.data.dtype.names
+        columns = ['{}{}'.format('xy'[field_ind % 2], field_ind // 2 + 1)
+                   for field_ind in range(len(pos_fields))]
+        return pd.DataFrame(
+            {column: self.data[field] for column, field in zip(columns, pos_fields)},
+            index=pd.Index(self.data[time_field], name='timestamp'))
 
 
 class TrodesDIOBinaryLoader(TrodesBinaryReader):
-    def __init__(self, path):
+    def __init__(self, path, mmap=False):
 
         super().__init__(path)
 
@@ -179,17 +209,113 @@ class TrodesDIOBinaryLoader(TrodesBinaryReader):
         self.clockrate = self.header_params.get('Clockrate')
         self.field_str = self.header_params.get('Fields')
 
-        # uint32 timestamp, 1 byte state
-        self.rec_size = 4 + 1
-        self.unpack_format = 'IB'
+        # default: uint32 timestamp, 1 byte state
+        if self.field_str is not None:
+            self.dio_dtype = parse_dtype(self.field_str)
+        else:
+            self.dio_dtype = np.dtype([('time', np.uint32),
+                                       ('state', np.uint8)])
+        self.rec_size = self.dio_dtype.itemsize
+
+        self.data = self._read_records(self.dio_dtype, mmap=mmap)
+
+    @property
+    def dio(self):
+        """State transitions as a boolean DataFrame indexed by timestamp."""
+        time_field, state_field = self.data.dtype.names[:2]
+        return pd.DataFrame(
+            {'state': self.data[state_field].astype(bool)},
+            index=pd.Index(self.data[time_field], name='timestamp'))
+
+
+def read_binary_header(path):
+    """Reads the header of an extracted Trodes binary without touching the
+    payload.
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    header_info : dict
+        Header fields plus the data offset, record dtype and number of
+        complete records in the file.
+
+    """
+    reader = TrodesBinaryReader(path)
+    file_stat = os.stat(path)
+    field_str = reader.header_params.get('Fields')
+    try:
+        record_dtype = parse_dtype(field_str) if field_str is not None else None
+    except ValueError as error:
+        raise TrodesBinaryFormatError('File ({}) has unsupported Fields: {}'.format(path, error))
+    if record_dtype is not None:
+        n_records = ((file_stat.st_size - reader.data_start_byte) //
+                     record_dtype.itemsize)
+    else:
+        n_records = None
+
+    header_info = {'path': str(path),
+                   'file_size': file_stat.st_size,
+                   'mtime': file_stat.st_mtime,
+                   'data_start_byte': reader.data_start_byte,
+                   'dtype': record_dtype,
+                   'n_records': n_records}
+    header_info.update(reader.header_params)
+    return header_info
+
+
+def build_binary_header_index(preprocessing_dir, index_path=None):
+    """Scans the headers of every extracted binary (`*.dat`) under
+    `preprocessing_dir` into a table with one row per file.
+
+    If `index_path` is given, entries of an existing index whose file size
+    and modification time are unchanged are reused instead of reread, and
+    the updated index is written back to `index_path`.
+
+    Parameters
+    ----------
+    preprocessing_dir : str
+    index_path : str, optional
+
+    Returns
+    -------
+    header_index : pandas.DataFrame
+
+    """
+    previous_index = {}
+    if index_path is not None and os.path.exists(index_path):
+        previous_index = {row['path']: row for row in
+                          load_binary_header_index(index_path)
+                          .to_dict('records')}
+
+    rows = []
+    for root, _, filenames in os.walk(preprocessing_dir):
+        for filename in sorted(filenames):
+            if not filename.endswith('.dat'):
+                continue
+            path = os.path.join(root, filename)
+            previous_row = previous_index.get(path)
+            if previous_row is not None:
+                file_stat = os.stat(path)
+                if (previous_row['file_size'] == file_stat.st_size and
+                        previous_row['mtime'] == file_stat.st_mtime):
+                    rows.append(previous_row)
+                    continue
+            try:
+                rows.append(read_binary_header(path))
+            except (TrodesBinaryFormatError, UnicodeDecodeError,
+                    IndexError):
+                print('build_binary_header_index: file {:} is not an '
+                      'extracted Trodes binary, skipping.'.format(path))
 
-        dio_list = []
+    header_index = pd.DataFrame(rows)
+    if index_path is not None:
+        header_index.to_pickle(index_path)
+    return header_index
 
-        with open(self.path, 'rb') as file:
-            file.seek(self.data_start_byte)
-            for dio_rec_bytes in iter(functools.partial(file.read, self.rec_size), b''):
-                dio_rec = struct.unpack(self.unpack_format, dio_rec_bytes)
-                dio_list.append([dio_rec[0], bool(dio_rec[1])])
 
-        self.dio = pd.DataFrame(
-            dio_list, columns=['timestamp', 'state']).set_index('timestamp')
+def load_binary_header_index(index_path):
+    """Loads an index written by `build_binary_header_index`."""
+    return pd.read_pickle(index_path)
@@ -1,12 +1,25 @@
+import contextlib
+import functools
 import glob
+import multiprocessing
 import os
+import threading
+import time
+import traceback
 from logging import getLogger
 
 import rec_to_binaries.trodes_data as td
-from rec_to_binaries.adjust_timestamps import fix_timestamp_lag
+from rec_to_binaries.adjust_timestamps import fix_timestamp_lag_files
 
 logger = getLogger(__name__)
 
+# name of the timestamp adjustment in the export manifests of time jobs
+_ADJUST_TIMESTAMPS = 'adjust_timestamps'
+
+
+class HDF5ConversionError(RuntimeError):
+    pass
+
 
 def extract_trodes_rec_file(data_dir,
                             animal,
@@ -33,7 +46,12 @@ def extract_trodes_rec_file(data_dir,
                             use_folder_date=False,
                             parallel_instances=1,
                             use_day_config=True,
-                            trodes_version=None):
+                            trodes_version=None,
+                            combine_exports=False,
+                            resume=False,
+                            timestamp_chunk_size=None,
+                            compact_timestamps=False,
+                            native_exports=()):
     """Extracting Trodes rec files.
 
     Following the Frank Lab directory structure for raw ephys data, will
@@ -80,21 +98,57 @@ def extract_trodes_rec_file(data_dir,
     extract_mda : bool, optional
     adjust_timestamps_for_mcu_lag : bool, optional
         If True, fixes the correspondence between trodestime
-        and system (wall) time due to MCU lag
+        and system (wall) time due to MCU lag. The files of each time export
+        are adjusted as soon as it finishes, up to `parallel_instances` at
+        once; without `extract_time`, the existing files are adjusted in
+        parallel using `parallel_instances` processes.
     make_mountain_dir : bool, optional
     make_pos_dir : bool, optional
     overwrite : bool, optional
         If true, will overwrite existing files.
     stop_error : bool, optional
         If true, the function will stop on errors. If false it will only
-        give warnings if something fails.
+        give warnings if something fails. With `make_HDF5`, conversions of
+        other days still run after one fails; if any failed, an error
+        summary is logged and, with `stop_error`, HDF5ConversionError is
+        raised at the end.
     use_folder_date : bool, optional
     use_day_config : bool, optional
         Use external configuration file in date folder
         (i.e. `<date>.trodesconf`)
     trodes_version : tuple, len 3
-        Tuple of length 3 defining the version number. If None, will be
-        automatically determined from the trodes version on the path.
+        Tuple of length 3 defining the version number of the export tools. If
+        None, will be automatically determined from the trodes version on
+        the path. The export commands and the default LFP and mda export args
+        of each day follow the major version its rec files were recorded
+        with; this version is used for days whose rec files do not state it.
+    combine_exports : bool, optional
+        If True and using Trodes >= 2, export all requested datatypes of a
+        rec file with a single `trodesexport` call so the rec file is read
+        once instead of once per datatype. Datatypes with mode specific
+        export args (e.g. the LFP filters and output rate) or conflicting
+        export args are still exported separately.
+    resume : bool, optional
+        If True, only re-run exports that have not completed successfully
+        with the same command on unchanged rec files, as recorded in the
+        export manifest each job writes to its output directories. With
+        `adjust_timestamps_for_mcu_lag`, time exports whose timestamp
+        adjustment failed or did not run are re-run too. Stale or failed
+        output is replaced regardless of `overwrite`.
+    timestamp_chunk_size : int, optional
+        If given, adjust timestamps in chunks of this many samples to bound
+        memory use (see `fix_timestamp_lag`).
+    compact_timestamps : bool, optional
+        If True, store the adjusted timestamps in the compact continuoustime
+        layout, with the time chunk boundaries and the regression in the
+        header instead of two extra int64 columns per sample (see
+        `fix_timestamp_lag`).
+    native_exports : tuple, optional
+        Datatypes ('DIO', 'time' and/or 'LFP') to export in this package
+        instead of with the Trodes export tools: DIO and time with
+        `rec_export` (with `combine_exports`, both in one pass over each rec
+        file), LFP with the multi-process filter of `lfp_export`, which
+        reads `lfp_export_args` such as -lfplowpass and -outputrate.
 
     """
 
@@ -107,133 +161,127 @@ def extract_trodes_rec_file(data_dir,
         animal,
         out_dir=out_dir,
         dates=dates,
-        trodes_version=trodes_version[0])
+        default_trodes_version=trodes_version[0])
 
-    extractor = td.ExtractRawTrodesData(animal_info)
+    extractor = td.ExtractRawTrodesData(animal_info,
+                                        trodes_version=trodes_version,
+                                        native_exports=native_exports)
     raw_epochs_unionset = animal_info.get_raw_epochs_unionset()
 
     if len(raw_epochs_unionset) == 0:
         logger.warning('No epochs found!')
     raw_dates = animal_info.get_raw_dates()
 
-    if extract_analog:
-        logger.info('Extracting analog data...')
-        if analog_export_args is None:
-            analog_export_args = ()
+    # All exports are planned up front and run as one job set so that
+    # `parallel_instances` slots stay busy across datatypes. None stands for
+    # the default args of each day's trodes version.
+    export_args_by_dir_ext = {}
 
-        extractor.extract_analog(
-            raw_dates, raw_epochs_unionset, export_args=analog_export_args,
-            overwrite=overwrite, stop_error=stop_error,
-            use_folder_date=use_folder_date,
-            parallel_instances=parallel_instances,
-            use_day_config=use_day_config)
+    if extract_analog:
+        export_args_by_dir_ext['analog'] = analog_export_args
 
     if extract_dio:
-        logger.info('Extracting DIO...')
-        if dio_export_args is None:
-            dio_export_args = ()
-
-        extractor.extract_dio(
-            raw_dates, raw_epochs_unionset, export_args=dio_export_args,
-            overwrite=overwrite, stop_error=stop_error,
-            use_folder_date=use_folder_date,
-            parallel_instances=parallel_instances,
-            use_day_config=use_day_config)
+        export_args_by_dir_ext['DIO'] = dio_export_args
 
     if extract_lfps:
-        logger.info('Extracting LFP...')
-        if lfp_export_args is None:
-            if trodes_version[0] < 2.0:
-                lfp_export_args = ('-highpass', '0',
-                                   '-lowpass', '400',
-                                   '-interp', '0',
-                                   '-userefs', '0',
-                                   '-outputrate', '1500')
-            else:
-                lfp_export_args = ('-lfphighpass', '0',
-                                   '-lfplowpass', '400',
-                                   '-interp', '0',
-                                   '-uselfprefs', '0',
-                                   'sortingmode', '1',
-                                   '-outputrate', '1500')
-        extractor.extract_lfp(
-            raw_dates, raw_epochs_unionset, export_args=lfp_export_args,
-            overwrite=overwrite, stop_error=stop_error,
-            use_folder_date=use_folder_date,
-            parallel_instances=parallel_instances,
-            use_day_config=use_day_config)
+        export_args_by_dir_ext['LFP'] = lfp_export_args
 
     if extract_mda:
-        logger.info('Extracting mda...')
-        if mda_export_args is None:
-            if trodes_version[0] < 2.0:
-                mda_export_args = ('-usespikefilters', '0',
-                                   '-interp', '1',
-                                   '-userefs', '0')
-            else:
-                mda_export_args = ('-usespikefilters', '0',
-                                   '-interp', '1',
-                                   '-userawrefs', '0',
-                                   '-usespikerefs', '0',
-                                   '-sortingmode', '1')
-        extractor.extract_mda(
-            raw_dates, raw_epochs_unionset, export_args=mda_export_args,
-            overwrite=overwrite, stop_error=stop_error,
-            use_folder_date=use_folder_date,
-            parallel_instances=parallel_instances,
-            use_day_config=use_day_config)
+        export_args_by_dir_ext['mda'] = mda_export_args
 
     if extract_spikes:
-        logger.info('Extracting spikes...')
-        if spikes_export_args is None:
-            spikes_export_args = ()
-        extractor.extract_spikes(
-            raw_dates, raw_epochs_unionset, export_args=spikes_export_args,
-            overwrite=overwrite, stop_error=stop_error,
-            use_folder_date=use_folder_date,
-            parallel_instances=parallel_instances,
-            use_day_config=use_day_config)
+        export_args_by_dir_ext['spikes'] = spikes_export_args
 
     if extract_time:
-        logger.info('Extracting time...')
-        if time_export_args is None:
-            time_export_args = ()
-        extractor.extract_time(
-            raw_dates, raw_epochs_unionset, export_args=time_export_args,
-            overwrite=overwrite, stop_error=stop_error,
-            use_folder_date=use_folder_date,
-            parallel_instances=parallel_instances,
-            use_day_config=use_day_config)
+        export_args_by_dir_ext['time'] = time_export_args
 
+    plan_kwargs = dict(overwrite=overwrite, stop_error=stop_error,
+                       use_folder_date=use_folder_date,
+                       use_day_config=use_day_config,
+                       resume=resume)
     if adjust_timestamps_for_mcu_lag:
+        # resume re-runs time exports whose adjustment failed or never ran
+        plan_kwargs['postprocessing'] = {'time': (_ADJUST_TIMESTAMPS,)}
+    all_export_jobs = []
+    for day_trodes_version, version_dates in extractor.group_dates_by_trodes_version(raw_dates):
+        version_export_args = {
+            export_dir_ext: (export_args if export_args is not None
+                             else _default_export_args(export_dir_ext, day_trodes_version))
+            for export_dir_ext, export_args in export_args_by_dir_ext.items()}
+        if combine_exports:
+            logger.info('Planning combined extraction of '
+                        f'{", ".join(version_export_args)} for Trodes {day_trodes_version} '
+                        'recordings...')
+            all_export_jobs.extend(extractor.plan_combined_export(
+                version_export_args, version_dates, raw_epochs_unionset,
+                **plan_kwargs))
+        else:
+            for export_dir_ext, export_args in version_export_args.items():
+                logger.info(f'Planning {export_dir_ext} extraction for Trodes '
+                            f'{day_trodes_version} recordings...')
+                all_export_jobs.extend(extractor.plan_export(
+                    export_dir_ext, version_dates, raw_epochs_unionset,
+                    export_args=export_args, **plan_kwargs))
+
+    # (required export jobs, function) pairs, run once the jobs are done
+    dependents = []
+
+    if make_mountain_dir:
+        dependents.append(
+            ([job for job in all_export_jobs
+              if 'mda' in job.export_dir_exts],
+             functools.partial(
+                 _log_and_call, 'Making mountain directory...',
+                 extractor.prepare_mountain_dir,
+                 raw_dates, raw_epochs_unionset,
+                 use_folder_date=use_folder_date, stop_error=stop_error)))
+
+    if make_pos_dir:
+        dependents.append(
+            ([], functools.partial(
+                _log_and_call, 'Making position directory...',
+                extractor.prepare_pos_dir,
+                raw_dates, raw_epochs_unionset, overwrite=overwrite,
+                use_folder_date=use_folder_date, stop_error=stop_error)))
+
+    if adjust_timestamps_for_mcu_lag and extract_time:
         ''''There is some jitter in the arrival times of packets from the MCU (as
             reflected in the sysclock records in the .rec file. If we assume that
             the Trodes clock is actually regular, and that any episodes of lag are
             fairly sporadic, we can recover the correspondence between trodestime
             and system (wall) time.'''
+        # each time export's files are adjusted as soon as it finishes, at most
+        # `parallel_instances` at once
+        adjust_slots = threading.BoundedSemaphore(max(parallel_instances, 1))
+        for job in all_export_jobs:
+            if 'time' in job.export_dir_exts:
+                dependents.append(
+                    ([job], functools.partial(
+                        _adjust_export_job_timestamps, extractor, job, adjust_slots,
+                        chunk_size=timestamp_chunk_size, compact=compact_timestamps)))
+
+    logger.info(f'Running {len(all_export_jobs)} export jobs...')
+    extractor.run_export_jobs(all_export_jobs,
+                              parallel_instances=parallel_instances,
+                              dependents=dependents)
+
+    if adjust_timestamps_for_mcu_lag and not extract_time:
+        # adjust the files of earlier time exports
         preprocessing_dir = animal_info.get_preprocessing_dir()
         if dates is None:
             filenames = glob.glob(os.path.join(
-            preprocessing_dir, '**', '*.continuoustime.dat'), recursive=True)
+                preprocessing_dir, '**', '*.continuoustime.dat'), recursive=True)
         else:
             filenames = []
             for date in dates:
                 filenames.extend(glob.glob(os.path.join(
-                    preprocessing_dir, date,'**', '*.continuoustime.dat')))
-        for file in filenames:
-            fix_timestamp_lag(file)
-
-    if make_mountain_dir:
-        logger.info('Making mountain directory...')
-        extractor.prepare_mountain_dir(
-            raw_dates, raw_epochs_unionset, use_folder_date=use_folder_date,
-            stop_error=stop_error)
-
-    if make_pos_dir:
-        logger.info('Making position directory...')
-        extractor.prepare_pos_dir(
-            raw_dates, raw_epochs_unionset, overwrite=overwrite,
-            use_folder_date=use_folder_date, stop_error=stop_error)
+                    preprocessing_dir, date, '**', '*.continuoustime.dat'),
+                    recursive=True))
+        logger.info(f'Adjusting timestamps of {len(filenames)} files...')
+        fix_timestamp_lag_files(filenames,
+                                parallel_instances=parallel_instances,
+                                chunk_size=timestamp_chunk_size,
+                                compact=compact_timestamps)
 
     if make_HDF5:
         logger.info('Converting binaries into HDF5 files...')
@@ -241,7 +289,57 @@ def extract_trodes_rec_file(data_dir,
         # extraction
         convert_binaries_to_hdf5(data_dir, animal, out_dir=out_dir,
                                  dates=dates,
-                                 parallel_instances=parallel_instances)
+                                 parallel_instances=parallel_instances,
+                                 stop_error=stop_error)
+
+
+def _default_export_args(export_dir_ext, trodes_version):
+    """Export args of a datatype for recordings of major version
+    `trodes_version` when none are given."""
+    if export_dir_ext == 'LFP':
+        if trodes_version < 2.0:
+            return ('-highpass', '0',
+                    '-lowpass', '400',
+                    '-interp', '0',
+                    '-userefs', '0',
+                    '-outputrate', '1500')
+        return ('-lfphighpass', '0',
+                '-lfplowpass', '400',
+                '-interp', '0',
+                '-uselfprefs', '0',
+                'sortingmode', '1',
+                '-outputrate', '1500')
+    if export_dir_ext == 'mda':
+        if trodes_version < 2.0:
+            return ('-usespikefilters', '0',
+                    '-interp', '1',
+                    '-userefs', '0')
+        return ('-usespikefilters', '0',
+                '-interp', '1',
+                '-userawrefs', '0',
+                '-usespikerefs', '0',
+                '-sortingmode', '1')
+    return ()
+
+
+def _adjust_export_job_timestamps(extractor, export_job, adjust_slots, chunk_size=None,
+                                  compact=False):
+    """Adjusts the continuoustime files of a finished time export and records
+    the outcome in its export manifest."""
+    if export_job.return_code != 0:
+        return
+    time_dir = export_job.out_epoch_dirs[export_job.export_dir_exts.index('time')]
+    filenames = glob.glob(os.path.join(time_dir, '*.continuoustime.dat'))
+    with adjust_slots:
+        logger.info(f'Adjusting timestamps of {len(filenames)} files in {time_dir}...')
+        failed = fix_timestamp_lag_files(filenames, chunk_size=chunk_size,
+                                         compact=compact)
+    extractor.record_postprocessing(export_job, _ADJUST_TIMESTAMPS, not failed)
+
+
+def _log_and_call(message, func, *args, **kwargs):
+    logger.info(message)
+    return func(*args, **kwargs)
 
 
 def convert_binaries_to_hdf5(data_dir, animal, out_dir=None, dates=None,
@@ -249,7 +347,17 @@ def convert_binaries_to_hdf5(data_dir, animal, out_dir=None, dates=None,
                              convert_dio=True,
                              convert_lfp=True,
                              convert_pos=True,
-                             convert_spike=True):
+                             convert_spike=True,
+                             hdf_complib=None,
+                             hdf_complevel=0,
+                             hdf_format='fixed',
+                             hdf_chunk_rows=None,
+                             hdf_lfp_layout='frame',
+                             analysis_backend='hdf5',
+                             writer_threads=1,
+                             epoch_shards=False,
+                             overwrite_shards=False,
+                             stop_error=True):
     animal_info = td.TrodesAnimalInfo(
         data_dir, animal, out_dir=out_dir, dates=dates)
     """Converting preprocessed binaries into HDF5 files.
@@ -268,33 +376,185 @@ def convert_binaries_to_hdf5(data_dir, animal, out_dir=None, dates=None,
     dates : list, optional (default is None)
         Only process select dates (defaults to all available dates if None)
     parallel_instances : int, optional
-        Number of parallel jobs to run.
+        Number of (date, datatype) conversions to run at once, each in its
+        own process. If there is only one conversion, this many processes
+        load spike files instead, with one pool kept for every day.
     convert_spikes : bool, optional
     convert_lfps : bool, optional
     convert_dio : bool, optional
     convert_mda : bool, optional
-    """
+    hdf_complib : str, optional
+        HDF5 compression library, e.g. 'blosc:lz4' or 'blosc:zstd' (see
+        `trodes_data.available_hdf_complibs`). Defaults to 'zlib' if only
+        `hdf_complevel` is given.
+    hdf_complevel : int, optional
+        Compression level 0-9, 0 (default) for no compression.
+    hdf_format : {'fixed', 'table'}, optional
+        pandas storage format of the LFP, spike, position and DIO frames.
+        'table' is chunked and can be read partially, and LFP epochs are
+        written to it chunk by chunk.
+    hdf_chunk_rows : int, optional
+        Rows per HDF5 chunk of the LFP arrays. Chosen by PyTables if None.
+    hdf_lfp_layout : {'frame', 'arrays'}, optional
+        'frame' (default) stores each LFP epoch as a pandas frame, 'arrays'
+        as streamed PyTables arrays that can be sliced by sample and channel
+        (see `TrodesPreprocessingToAnalysis.read_lfp_epoch`). With the
+        defaults ('frame' and `hdf_format='fixed'`) each LFP epoch is built
+        whole in memory before it is written, so peak memory grows with the
+        epoch length. Use `hdf_format='table'` or `hdf_lfp_layout='arrays'`
+        to convert LFP with bounded memory.
+    analysis_backend : {'hdf5', 'zarr', 'npy'}, optional
+        'zarr' or 'npy' write chunked directory stores instead of `.h5`
+        files (see `rec_to_binaries.array_store`).
+    writer_threads : int, optional
+        With a 'zarr' or 'npy' backend, number of threads writing channels,
+        ntrodes or columns concurrently.
+    epoch_shards : bool, optional
+        If True, convert each epoch to its own HDF5 shard (in parallel like
+        the days) and then write each day file as links to its shards, read
+        with the same keys as before. A failed epoch only loses its shard,
+        and shards newer than their binaries are not converted again.
+    overwrite_shards : bool, optional
+        With `epoch_shards`, re-convert every epoch even if its shard is up
+        to date.
+    stop_error : bool, optional
+        If True (default), raise HDF5ConversionError once all conversions
+        have run if any of them failed. If False, failures are only logged
+        and returned. Either way, one failed day does not stop the others.
+
+    Returns
+    -------
+    failed : dict
+        (date, datatype), or (date, datatype, epoch) with `epoch_shards`,
+        -> traceback of each conversion that failed; empty unless
+        `stop_error` is False.
+
+    Raises
+    ------
+    HDF5ConversionError
+        With `stop_error`, if any conversion failed.
 
-    importer = td.TrodesPreprocessingToAnalysis(animal_info)
+    """
 
-    # Convert binaries into hdf5 files
-    if convert_dio:
-        for date in animal_info.preproc_dio_paths['date'].unique():
-            logger.info(f'converting dio for {date} ...')
+    importer = td.TrodesPreprocessingToAnalysis(animal_info,
+                                                complib=hdf_complib,
+                                                complevel=hdf_complevel,
+                                                hdf_format=hdf_format,
+                                                chunk_rows=hdf_chunk_rows,
+                                                backend=analysis_backend,
+                                                writer_threads=writer_threads,
+                                                epoch_shards=epoch_shards,
+                                                lfp_layout=hdf_lfp_layout)
+
+    # Each (date, datatype) is written to its own HDF5 file, or with
+    # epoch_shards each (date, datatype, epoch) to its own shard, so they are
+    # converted independently, largest first so the longest job starts early.
+    conversions = []
+    day_indexes = []
+    for datatype, convert in [('DIO', convert_dio),
+                              ('LFP', convert_lfp),
+                              ('pos', convert_pos),
+                              ('spikes', convert_spike)]:
+        if convert:
+            paths = getattr(animal_info, animal_info.preproc_paths_attrs[datatype])
+            for date in paths['date'].unique():
+                date_paths = paths[paths['date'] == date]
+                if epoch_shards:
+                    day_indexes.append((datatype, date))
+                    for epoch in date_paths['epoch'].unique():
+                        conversions.append(
+                            (_preprocessing_size(date_paths[date_paths['epoch'] == epoch]),
+                             (datatype, date, epoch)))
+                else:
+                    conversions.append((_preprocessing_size(date_paths), (datatype, date)))
+    conversions = [conversion for _, conversion
+                   in sorted(conversions, key=lambda job: job[0], reverse=True)]
+
+    n_processes = min(parallel_instances, len(conversions))
+    failed = {}
+
+    with contextlib.ExitStack() as stack:
+        if n_processes > 1:
+            # a pool worker cannot start its own pool, so spikes are loaded
+            # in-process there
+            pool = stack.enter_context(multiprocessing.Pool(n_processes))
+            results = pool.imap_unordered(
+                functools.partial(_timed_convert, importer,
+                                  overwrite_shards=overwrite_shards),
+                conversions)
+        else:
+            # one spike loading pool for every day
+            spike_pool = None
+            if parallel_instances > 1:
+                spike_pool = multiprocessing.Pool(parallel_instances)
+                stack.callback(spike_pool.join)
+                stack.callback(spike_pool.close)
+            results = map(
+                functools.partial(_timed_convert, importer, spike_pool=spike_pool,
+                                  overwrite_shards=overwrite_shards),
+                conversions)
+
+        for n_done, (conversion, elapsed, error, converted) in enumerate(results, start=1):
+            datatype, date, *epoch = conversion
+            description = f'{datatype} for {date}' + (f' epoch {epoch[0]}' if epoch else '')
+            if error is None and not converted:
+                logger.info(f'[{n_done}/{len(conversions)}] {description} is up to date')
+            elif error is None:
+                logger.info(f'[{n_done}/{len(conversions)}] converted {description} '
+                            f'in {elapsed:.1f} s')
+            else:
+                logger.warning(f'[{n_done}/{len(conversions)}] converting {description} '
+                               f'failed after {elapsed:.1f} s:\n{error}')
+                failed[(date, datatype, *epoch)] = error
+
+    # link whatever shards exist, so one failed epoch does not hide the others
+    for datatype, date in day_indexes:
+        try:
+            linked = importer.build_day_index(datatype, date)
+            logger.info(f'indexed {len(linked)} {datatype} epochs for {date}')
+        except Exception:
+            error = traceback.format_exc()
+            logger.warning(f'indexing {datatype} for {date} failed:\n{error}')
+            failed[(date, datatype)] = error
+
+    if failed:
+        summary = ', '.join('/'.join(map(str, key)) for key in sorted(failed))
+        logger.error(f'HDF5 conversion failed for {len(failed)} of the conversions: {summary}')
+        if stop_error:
+            raise HDF5ConversionError(
+                f'HDF5 conversion failed for {summary}:\n' +
+                '\n'.join(failed[key] for key in sorted(failed)))
+
+    return failed
+
+
+def _preprocessing_size(paths):
+    """Total size in bytes of the files in a preprocessing paths table."""
+    return sum(os.path.getsize(path) for path in paths['path']
+               if os.path.exists(path))
+
+
+def _timed_convert(importer, conversion, spike_pool=None, overwrite_shards=False):
+    """Converts one (datatype, date) to HDF5, or one (datatype, date, epoch)
+    to its shard, returning its duration and any error instead of raising,
+    so one bad day or epoch does not stop the others."""
+    datatype, date, *epoch = conversion
+    start_time = time.time()
+    converted = True
+    try:
+        if epoch:
+            converted = importer.convert_epoch_shard(datatype, date, epoch[0],
+                                                     overwrite=overwrite_shards,
+                                                     pool=spike_pool)
+        elif datatype == 'DIO':
             importer.convert_dio_day(date)
-
-    if convert_lfp:
-        for date in animal_info.preproc_LFP_paths['date'].unique():
-            logger.info(f'converting LFP for {date} ...')
+        elif datatype == 'LFP':
             importer.convert_lfp_day(date)
-
-    if convert_pos:
-        for date in animal_info.preproc_pos_paths['date'].unique():
-            logger.info(f'converting pos for {date} ...')
+        elif datatype == 'pos':
             importer.convert_pos_day(date)
-
-    if convert_spike:
-        for date in animal_info.preproc_spike_paths['date'].unique():
-            logger.info(f'converting spike for {date} ...')
-            importer.convert_spike_day(
-                date, parallel_instances=parallel_instances)
+        elif datatype == 'spikes':
+            importer.convert_spike_day(date, pool=spike_pool)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return conversion, time.time() - start_time, error, converted
@@ -1,25 +1,39 @@
 import numpy as np
-import pandas as pd
 
 
 def infer_systime(data_file):
-    systime = create_systime(data_file['clockrate'],
-                             data_file['data'],
-                             data_file['system_time_at_creation'])
-    n_time = systime.shape[0]
-    trodestime = data_file['data']['trodestime'].copy()
-    time_chunk_label = np.ones(n_time, dtype=np.int)
-    adjusted_systime = systime.copy()
-
-    return pd.DataFrame(
-        {'trodestime': trodestime,
-         'systime': systime,
-         'time_chunk_label': time_chunk_label,
-         'adjusted_systime': adjusted_systime,
-         })
-
-
-def create_systime(clockrate, data, system_time_at_creation):
+    """Builds the adjusted continuoustime data for a file without `systime`,
+    extrapolating it from the header (see `create_systime`).
+
+    Parameters
+    ----------
+    data_file : dict
+        As read by `readTrodesExtractedDataFile`
+
+    Returns
+    -------
+    new_data : numpy.ndarray
+        Structured array with fields trodestime, systime, time_chunk_label
+        and adjusted_systime
+
+    """
+    data = data_file['data']
+    new_data = np.empty(data.shape[0],
+                        dtype=[('trodestime', data.dtype['trodestime']),
+                               ('systime', np.int64),
+                               ('time_chunk_label', np.int64),
+                               ('adjusted_systime', np.int64)])
+    new_data['trodestime'] = data['trodestime']
+    new_data['systime'] = create_systime(data_file['clockrate'],
+                                         data,
+                                         data_file['system_time_at_creation'])
+    new_data['time_chunk_label'] = 1
+    new_data['adjusted_systime'] = new_data['systime']
+
+    return new_data
+
+
+def create_systime(clockrate, data, system_time_at_creation, start_index=0):
     """Creates the system time by extrapolating from the
     'system_time_at_creation' timestamp as a function of the 'clockrate' and
     the 'trodestime' containted in 'data'
@@ -29,31 +43,33 @@ def create_systime(clockrate, data, system_time_at_creation):
     clockrate : int
     data : np.ndarray
     system_time_at_creation : int
+    start_index : int, optional
+        Sample index of the first element of `data`, for computing the
+        system time of a chunk of a file.
 
 
     Returns
     -------
-    systime
+    systime : np.ndarray, int64
+        Unix time in nanoseconds
 
     Notes
     -----
     Assumes 'clockrate' is in Hz and 'system_time_at_creation' is taken to the
-    millisecond
+    millisecond. Computed with integer arithmetic, so the result is exact to
+    the nanosecond (rounded down).
 
     """
-    NANOSECONDS_TO_SECONDS = 1e9
+    NANOSECONDS_TO_MILLISECONDS = 1_000_000
+    NANOSECONDS_TO_SECONDS = 1_000_000_000
 
     clockrate = int(clockrate)
     n_time = data.shape[0]
-    system_time_at_creation = pd.to_datetime(
-        int(system_time_at_creation), unit='ms').value
-    end = (system_time_at_creation +
-           int((n_time - 1) * NANOSECONDS_TO_SECONDS / clockrate))
-
-    systime = pd.date_range(
-        start=system_time_at_creation,
-        end=end,
-        periods=n_time,
-    ).astype(np.int64).to_numpy()
+    system_time_at_creation = (int(system_time_at_creation) *
+                               NANOSECONDS_TO_MILLISECONDS)
+    systime = np.arange(start_index, start_index + n_time, dtype=np.int64)
+    systime *= NANOSECONDS_TO_SECONDS
+    systime //= clockrate
+    systime += system_time_at_creation
 
     return systime
@@ -0,0 +1,357 @@
+"""Exports LFP by filtering and decimating the neural samples in this package.
+
+Samples are streamed in chunks, either from the .rec file(s) of a recording
+(see `ConcatenatedRecFile`) or from the .mda files written by the
+mountainsort export. Each chunk is low-pass filtered with a Butterworth
+filter (second-order sections) and every `decimation`-th sample is kept.
+The filter is either
+
+- zero-phase (forward-backward): chunks are read with `pad` extra samples
+  on each side. By default `pad` is the length over which the filter's
+  impulse response decays (see `filter_pad`), so the result differs from
+  filtering the whole recording at once by far less than one int16 step;
+  a shorter pad leaves edge transients at chunk boundaries, or
+- causal: the filter state is carried from one chunk to the next.
+
+Channels are split into groups that are filtered by a pool of processes,
+each writing its own files, so throughput scales with the number of cores.
+The output has the layout of the Trodes LFP export:
+`<base>.LFP/<base>.LFP_nt<ntrode>ch<channel>.dat` (int16 samples) and
+`<base>.LFP/<base>.timestamps.dat` (uint32 timestamps of the kept samples).
+
+Like `rec_export`, this module can be run as an export command, e.g.
+
+    python -m rec_to_binaries.lfp_export -lfp -rec <file.rec>
+        -outputdirectory <dir> -output <base name> -lfplowpass 400
+        -outputrate 1500
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import numpy as np
+import scipy.signal
+
+from rec_to_binaries.read_binaries import write_trodes_extracted_header
+from rec_to_binaries.rec_file import ConcatenatedRecFile
+
+# microvolts per bit of Intan headstages, used if the header does not say
+DEFAULT_VOLTAGE_SCALING = 0.195
+
+_mda_dtypes = {-2: np.uint8, -3: np.float32, -4: np.int16, -5: np.int32,
+               -6: np.uint16, -7: np.float64, -8: np.uint32}
+
+
+class LFPExportError(RuntimeError):
+    pass
+
+
+class RecLFPSource:
+    """Neural samples of the parts of a recording, by (ntrode id, channel
+    number)."""
+
+    def __init__(self, rec_paths):
+        self.rec_file = ConcatenatedRecFile(rec_paths)
+        header = self.rec_file.header
+        self.original_file = os.path.basename(self.rec_file.paths[0])
+        self.sampling_rate = header.sampling_rate
+        self.num_samples = len(self.rec_file)
+
+        # (ntrode id, 1-based channel) -> hardware channel
+        self.hw_channels = {}
+        self.lfp_channels = []
+        self.voltage_scaling = {}
+        for ntrode in header.ntrodes:
+            ntrode_id = int(ntrode['id'])
+            for channel_number, hw_channel in enumerate(ntrode['hw_channels'], start=1):
+                self.hw_channels[(ntrode_id, channel_number)] = hw_channel
+            self.lfp_channels.append((ntrode_id, int(ntrode.get('LFPChan', 1))))
+            self.voltage_scaling[ntrode_id] = float(
+                ntrode.get('lfpScalingToUv', ntrode.get('spikeScalingToUv', DEFAULT_VOLTAGE_SCALING)))
+        self.channels = list(self.hw_channels)
+
+    def get_timestamps(self, step=1):
+        return self.rec_file.get_timestamps(step=step)
+
+    def read(self, start, stop, channels):
+        return self.rec_file.neural(start, stop, [self.hw_channels[channel] for channel in channels])
+
+
+def read_mda(path):
+    """Memory-maps an .mda file. Arrays are stored first index fastest, so
+    an (channel x time) array is returned as (time x channel)."""
+    with open(path, 'rb') as file:
+        dtype_code, _, num_dims = np.fromfile(file, dtype='<i4', count=3)
+        dims = np.fromfile(file, dtype='<i4', count=num_dims)
+        offset = file.tell()
+    return np.memmap(path, dtype=np.dtype(_mda_dtypes[int(dtype_code)]).newbyteorder('<'),
+                     mode='r', offset=offset, shape=tuple(int(dim) for dim in dims[::-1]))
+
+
+class MdaLFPSource:
+    """Samples of the `<base>.nt<ntrode>.mda` files of a mountainsort export
+    directory, with timestamps from `<base>.timestamps.mda`."""
+
+    def __init__(self, mda_dir, sampling_rate=30000):
+        timestamp_paths = glob.glob(os.path.join(mda_dir, '*.timestamps.mda'))
+        if len(timestamp_paths) != 1:
+            raise LFPExportError('Expected one timestamps.mda file in ({}).'.format(mda_dir))
+        self.original_file = os.path.basename(timestamp_paths[0])[:-len('.timestamps.mda')] + '.rec'
+        self.sampling_rate = sampling_rate
+        self.timestamps = read_mda(timestamp_paths[0])
+        self.num_samples = len(self.timestamps)
+
+        self.ntrode_data = {}
+        for path in glob.glob(os.path.join(mda_dir, '*.mda')):
+            ntrode_match = re.match(r'^.*\.nt(\d+)\.mda$', path)
+            if ntrode_match is not None:
+                self.ntrode_data[int(ntrode_match.groups()[0])] = read_mda(path)
+        self.channels = [(ntrode_id, channel_number)
+                         for ntrode_id, data in sorted(self.ntrode_data.items())
+                         for channel_number in range(1, data.shape[1] + 1)]
+        self.lfp_channels = [(ntrode_id, 1) for ntrode_id in sorted(self.ntrode_data)]
+        self.voltage_scaling = {ntrode_id: DEFAULT_VOLTAGE_SCALING for ntrode_id in self.ntrode_data}
+
+    def get_timestamps(self, step=1):
+        return self.timestamps[::step]
+
+    def read(self, start, stop, channels):
+        return np.stack([self.ntrode_data[ntrode_id][start:stop, channel_number - 1]
+                         for ntrode_id, channel_number in channels], axis=1)
+
+
+def _open_source(source_type, path, sampling_rate=None):
+    if source_type == 'rec':
+        return RecLFPSource(path)
+    return MdaLFPSource(path, sampling_rate=sampling_rate)
+
+
+def lfp_filter(sampling_rate, lowpass=400.0, highpass=0.0, order=4):
+    """Butterworth low-pass (band-pass if `highpass` > 0) filter as
+    second-order sections."""
+    if highpass > 0:
+        return scipy.signal.butter(order, (highpass, lowpass), btype='bandpass',
+                                   output='sos', fs=sampling_rate)
+    return scipy.signal.butter(order, lowpass, btype='lowpass', output='sos', fs=sampling_rate)
+
+
+def filter_pad(sos, tolerance=1e-6):
+    """Number of samples after which the impulse response of the filter
+    `sos` has decayed below `tolerance`, from its slowest pole.
+
+    This grows with 1 / the lowest cutoff: for the order 4 filters at 30
+    kHz, about 400 samples for a 400 Hz low-pass, but about 170000 with a
+    1 Hz high-pass added.
+    """
+    _, poles, _ = scipy.signal.sos2zpk(sos)
+    return int(np.ceil(np.log(tolerance) / np.log(np.max(np.abs(poles)))))
+
+
+def _filter_channels(source_args, channels, out_paths, headers, decimation, sos, zero_phase,
+                     chunk_size, pad):
+    """Filters and decimates a group of channels of one source, writing one
+    file per channel. Run in a pool worker."""
+    start_time = time.time()
+    source = _open_source(*source_args)
+    num_samples = source.num_samples
+    files = []
+    try:
+        for out_path, header in zip(out_paths, headers):
+            file = open(out_path, 'wb')
+            write_trodes_extracted_header(file, header)
+            files.append(file)
+
+        zi = None
+        for start in range(0, num_samples, chunk_size):
+            stop = min(start + chunk_size, num_samples)
+            if zero_phase:
+                read_start, read_stop = max(start - pad, 0), min(stop + pad, num_samples)
+                data = source.read(read_start, read_stop, channels).astype(np.float64)
+                filtered = scipy.signal.sosfiltfilt(sos, data, axis=0)[start - read_start:
+                                                                        stop - read_start]
+            else:
+                data = source.read(start, stop, channels).astype(np.float64)
+                if zi is None:
+                    zi = scipy.signal.sosfilt_zi(sos)[:, :, np.newaxis] * data[0]
+                filtered, zi = scipy.signal.sosfilt(sos, data, axis=0, zi=zi)
+
+            # keep samples on the global grid of multiples of `decimation`
+            kept = filtered[-start % decimation::decimation]
+            kept = np.clip(np.rint(kept), -32768, 32767).astype('<i2')
+            for channel_ind, file in enumerate(files):
+                kept[:, channel_ind].tofile(file)
+    finally:
+        for file in files:
+            file.close()
+    return channels, time.time() - start_time
+
+
+def _lfp_header(source, ntrode_id, channel_number, decimation, first_timestamp, lowpass):
+    return {
+        'Description': 'LFP data for one channel',
+        'Byte_order': 'little endian',
+        'Original_file': source.original_file,
+        'nTrode_ID': ntrode_id,
+        'nTrode_channel': channel_number,
+        'Clock rate': source.sampling_rate,
+        'Voltage_scaling': source.voltage_scaling[ntrode_id],
+        'Decimation': decimation,
+        'First_timestamp': first_timestamp,
+        'Reference': 'off',
+        'Low_pass_filter': lowpass,
+        'Fields': '<voltage int16>',
+    }
+
+
+def export_lfp(out_date_dir, out_base_filename, rec_paths=None, mda_dir=None, lowpass=400.0,
+               highpass=0.0, output_rate=1500, zero_phase=True, filter_order=4,
+               all_channels=False, n_processes=None, chunk_size=2 ** 20, pad=None,
+               sampling_rate=30000):
+    """Filters, decimates and writes the LFP of one recording.
+
+    Parameters
+    ----------
+    out_date_dir : str
+        Output is written to `<out_date_dir>/<out_base_filename>.LFP`,
+        created if needed
+    out_base_filename : str
+    rec_paths : str or list of str, optional
+        Rec file, or parts of one recording in order, to read samples from
+    mda_dir : str, optional
+        Mountainsort export directory to read samples from, if `rec_paths`
+        is not given
+    lowpass : float, optional
+        Low-pass (anti-alias) cutoff in Hz
+    highpass : float, optional
+        High-pass cutoff in Hz, 0 for none
+    output_rate : int, optional
+        Sampling rate of the LFP, must divide the recording's sampling rate
+    zero_phase : bool, optional
+        Filter forward and backward (True) or causally (False)
+    filter_order : int, optional
+    all_channels : bool, optional
+        Export every channel of each ntrode instead of only its LFP channel
+    n_processes : int, optional
+        Number of processes filtering channel groups, defaults to the number
+        of available cores
+    chunk_size : int, optional
+        Number of input samples filtered at once
+    pad : int, optional
+        Samples added on both sides of each chunk for zero-phase filtering.
+        Defaults to `filter_pad` of the filter. A low `highpass` makes it
+        long, so each chunk reads more extra samples; keep `chunk_size`
+        well above it.
+    sampling_rate : int, optional
+        Sampling rate of the mda files (rec files have it in their header)
+
+    Returns
+    -------
+    timings : list of (channels, elapsed seconds)
+
+    """
+    if rec_paths is not None:
+        if isinstance(rec_paths, str):
+            rec_paths = [rec_paths]
+        source_args = ('rec', list(rec_paths))
+    elif mda_dir is not None:
+        source_args = ('mda', mda_dir, sampling_rate)
+    else:
+        raise ValueError('Either rec_paths or mda_dir is required.')
+    source = _open_source(*source_args)
+
+    decimation, remainder = divmod(source.sampling_rate, output_rate)
+    if remainder or decimation < 1:
+        raise LFPExportError('Output rate {} does not divide the sampling rate {}.'.format(
+            output_rate, source.sampling_rate))
+    if lowpass >= output_rate / 2:
+        raise LFPExportError('Low-pass cutoff {} Hz is not below the Nyquist rate of the output, {} Hz.'.
+                             format(lowpass, output_rate / 2))
+    sos = lfp_filter(source.sampling_rate, lowpass=lowpass, highpass=highpass, order=filter_order)
+    if pad is None:
+        pad = filter_pad(sos)
+
+    out_dir = os.path.join(out_date_dir, '{}.LFP'.format(out_base_filename))
+    os.makedirs(out_dir, exist_ok=True)
+
+    timestamps = np.asarray(source.get_timestamps(step=decimation), dtype='<u4')
+    first_timestamp = int(timestamps[0]) if len(timestamps) else 0
+    with open(os.path.join(out_dir, '{}.timestamps.dat'.format(out_base_filename)), 'wb') as file:
+        write_trodes_extracted_header(file, {
+            'Byte_order': 'little endian',
+            'Original_file': source.original_file,
+            'Clock rate': source.sampling_rate,
+            'Decimation': decimation,
+            'Time_offset': 0,
+            'Fields': '<time uint32>',
+        })
+        timestamps.tofile(file)
+
+    channels = source.channels if all_channels else source.lfp_channels
+    if n_processes is None:
+        n_processes = (len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity')
+                       else os.cpu_count())
+    n_processes = max(min(n_processes, len(channels)), 1)
+    tasks = []
+    for channel_group in np.array_split(np.arange(len(channels)), n_processes):
+        group = [channels[ind] for ind in channel_group]
+        tasks.append((
+            source_args, group,
+            [os.path.join(out_dir, '{}.LFP_nt{}ch{}.dat'.format(out_base_filename, *channel))
+             for channel in group],
+            [_lfp_header(source, *channel, decimation, first_timestamp, lowpass)
+             for channel in group],
+            decimation, sos, zero_phase, chunk_size, pad))
+    del source
+
+    if n_processes > 1:
+        with multiprocessing.Pool(n_processes) as pool:
+            return pool.starmap(_filter_channels, tasks)
+    return [_filter_channels(*task) for task in tasks]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m rec_to_binaries.lfp_export', allow_abbrev=False,
+        description='Filter and decimate LFP from a .rec file or mda export.')
+    parser.add_argument('-lfp', action='store_true')
+    parser.add_argument('-rec', action='append')
+    parser.add_argument('-mda', default=None)
+    parser.add_argument('-outputdirectory', default=None)
+    parser.add_argument('-output', default=None)
+    parser.add_argument('-lowpass', '-lfplowpass', dest='lowpass', type=float, default=400.0)
+    parser.add_argument('-highpass', '-lfphighpass', dest='highpass', type=float, default=0.0)
+    parser.add_argument('-outputrate', type=int, default=1500)
+    parser.add_argument('-zerophase', type=int, default=1)
+    parser.add_argument('-filterorder', type=int, default=4)
+    parser.add_argument('-allchannels', type=int, default=0)
+    parser.add_argument('-processes', type=int, default=None)
+    parser.add_argument('-samplingrate', type=int, default=30000)
+    # the channel map always comes from the rec file itself
+    parser.add_argument('-reconfig', default=None)
+    args, unknown_args = parser.parse_known_args(argv)
+    if unknown_args:
+        print('Ignoring unsupported arguments: {}'.format(' '.join(unknown_args)))
+    if not args.rec and args.mda is None:
+        parser.error('one of -rec and -mda is required')
+
+    source_path = args.rec[0] if args.rec else args.mda
+    out_date_dir = args.outputdirectory or os.path.dirname(os.path.abspath(source_path))
+    out_base_filename = args.output or os.path.splitext(os.path.basename(source_path))[0]
+
+    timings = export_lfp(out_date_dir, out_base_filename,
+                         rec_paths=args.rec, mda_dir=args.mda,
+                         lowpass=args.lowpass, highpass=args.highpass,
+                         output_rate=args.outputrate, zero_phase=bool(args.zerophase),
+                         filter_order=args.filterorder, all_channels=bool(args.allchannels),
+                         n_processes=args.processes, sampling_rate=args.samplingrate)
+    for channels, elapsed in timings:
+        print('Filtered {} channels in {:.1f} s'.format(len(channels), elapsed))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,18 @@
+import os
 import re
-import sys
 
 import numpy as np
 
 
-def readTrodesExtractedDataFile(filename):
+def readTrodesExtractedDataFile(filename, mmap=False):
     '''Read extracted trodes binary.
 
     Parameters
     ----------
     filename : str
+    mmap : bool, optional
+        If True, `data` is a read-only np.memmap of the records after the
+        header instead of being read into memory.
 
     Returns
     -------
@@ -31,12 +34,25 @@ def readTrodesExtractedDataFile(filename):
             # End of settings block, signal end of fields
             else:
                 break
-        # Reads rest of file at once, using dtype format generated by parse_dtype()
         try:
-            fieldsText['data'] = np.fromfile(
-                file, dtype=parse_dtype(fieldsText['fields']))
+            dtype = parse_dtype(fieldsText['fields'])
         except KeyError:
-            fieldsText['data'] = np.fromfile(file)
+            dtype = np.dtype(np.float64)
+        if mmap:
+            # Maps the rest of the file, using dtype format generated by
+            # parse_dtype()
+            offset = file.tell()
+            n_records = (os.path.getsize(filename) - offset) // dtype.itemsize
+            if n_records > 0:
+                fieldsText['data'] = np.memmap(
+                    filename, dtype=dtype, mode='r', offset=offset,
+                    shape=(n_records,))
+            else:
+                fieldsText['data'] = np.empty(0, dtype=dtype)
+        else:
+            # Reads rest of file at once, using dtype format generated by
+            # parse_dtype()
+            fieldsText['data'] = np.fromfile(file, dtype=dtype)
         return fieldsText
 
 
@@ -44,6 +60,7 @@ def parse_dtype(fieldstr):
     '''Parses last fields parameter (<time uint32><...>) as a single string
     Assumes it is formatted as <name number * type> or <name type>
     Returns: np.dtype
+    Raises: ValueError if a field type is not a numpy type
     '''
     # Returns np.dtype from field string
     sep = re.split('\s', re.sub(r"\>\<|\>|\<", ' ', fieldstr).strip())
@@ -65,10 +82,12 @@ def parse_dtype(fieldstr):
         try:
             fieldtype = getattr(np, ftype)
         except AttributeError:
-            print(ftype + " is not a valid field type.\n")
-            sys.exit(1)
+            raise ValueError(ftype + " is not a valid field type.")
         else:
-            typearr.append((str(fieldname), fieldtype, repeats))
+            if repeats == 1:
+                typearr.append((str(fieldname), fieldtype))
+            else:
+                typearr.append((str(fieldname), fieldtype, repeats))
 
     return np.dtype(typearr)
 
@@ -84,10 +103,24 @@ def write_trodes_extracted_datafile(filename, data_file):
 
     """
     with open(filename, 'wb') as file:
-        file.write('<Start settings>\n'.encode())
-        for key, value in data_file.items():
-            if key != 'data':
-                line = f'{key}: {value}\n'.encode()
-                file.write(line)
-        file.write('<End settings>\n'.encode())
-        file.write(data_file['data'].tobytes())
+        write_trodes_extracted_header(file, data_file)
+        file.flush()
+        data_file['data'].tofile(file)
+
+
+def write_trodes_extracted_header(file, data_file):
+    """Writes the settings block of `data_file` (every key except `data`)
+    to an open binary file, leaving it positioned at the start of the data.
+
+    Parameters
+    ----------
+    file : file object
+    data_file : dict
+
+    """
+    file.write('<Start settings>\n'.encode())
+    for key, value in data_file.items():
+        if key != 'data':
+            line = f'{key}: {value}\n'.encode()
+            file.write(line)
+    file.write('<End settings>\n'.encode())
@@ -0,0 +1,220 @@
+"""Exports DIO and continuous time directly from .rec files.
+
+Both are small compared to the neural data in each packet, so instead of
+running the Trodes export tools they are decoded here, streaming the
+memory-mapped packets (see `ConcatenatedRecFile`) in large chunks:
+
+- DIO: for every digital channel of the hardware configuration, the state
+  at the first packet and at every packet where it changes, written as
+  `<base>.DIO/<base>.dio_<channel id>.dat` with fields
+  `<time uint32><state uint8>`, as `TrodesDIOBinaryLoader` reads them.
+- time: the trodes timestamp (and system time, if the recording includes
+  it) of every packet, written as `<base>.time/<base>.continuoustime.dat`,
+  as `fix_timestamp_lag` reads it.
+
+Several parts of one recording (`-rec` given more than once) are written as
+one continuous file, like the Trodes tools do. This module can be run as an
+export command with trodesexport-like arguments, e.g.
+
+    python -m rec_to_binaries.rec_export -dio -time -rec <file.rec>
+        -outputdirectory <dir> -output <base name>
+
+so it can be planned and run as an `ExportJob`.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from rec_to_binaries.read_binaries import write_trodes_extracted_header
+from rec_to_binaries.rec_file import ConcatenatedRecFile
+
+DIO_DTYPE = np.dtype([('time', '<u4'), ('state', 'u1')])
+
+
+def _common_header(rec_file, first_timestamp):
+    header = rec_file.header
+    return {
+        'Byte_order': 'little endian',
+        'Original_file': os.path.basename(rec_file.paths[0]),
+        'Clockrate': header.sampling_rate,
+        'Trodes_version': header.global_config.get('trodesVersion', ''),
+        'System_time_at_creation': header.global_config.get('systemTimeAtCreation', 0),
+        'Timestamp_at_creation': header.global_config.get('timestampAtCreation', 0),
+        'First_timestamp': first_timestamp,
+    }
+
+
+def digital_channels(header):
+    """Digital channels of a `RecHeader`.
+
+    Returns
+    -------
+    channels : list of dict
+        With keys `id`, `direction` ('input' or 'output'), `display_order`,
+        `byte` (index into the packet's `device_bytes`) and `bit`.
+
+    """
+    channels = []
+    for device in header.devices:
+        device_channels = [channel for channel in device['channels']
+                           if channel.get('dataType') == 'digital']
+        for display_order, channel in enumerate(device_channels, start=1):
+            channels.append({
+                'id': channel['id'],
+                'direction': 'input' if channel.get('input', '1') == '1' else 'output',
+                'display_order': display_order,
+                'byte': device['byte_offset'] - 1 + int(channel.get('startByte', 0)),
+                'bit': int(channel.get('bit', 0)),
+            })
+    return channels
+
+
+class _DIOWriter:
+    """Writes the state changes of every digital channel, chunk by chunk."""
+
+    def __init__(self, out_dir, out_base_filename, rec_file, first_timestamp):
+        self.channels = digital_channels(rec_file.header)
+        self.bytes = np.array([channel['byte'] for channel in self.channels], dtype=np.intp)
+        self.bits = np.array([channel['bit'] for channel in self.channels], dtype=np.uint8)
+        self.previous_state = None
+        self.files = []
+        common_header = _common_header(rec_file, first_timestamp)
+        for channel in self.channels:
+            file = open(os.path.join(out_dir, '{}.dio_{}.dat'.format(
+                out_base_filename, channel['id'])), 'wb')
+            header = {'Description': 'State change data for one digital channel. '
+                                     'Display_order is 1-based.'}
+            header.update(common_header)
+            header.update({'Direction': channel['direction'],
+                           'ID': channel['id'],
+                           'Display_order': channel['display_order'],
+                           'Fields': '<time uint32><state uint8>'})
+            write_trodes_extracted_header(file, header)
+            self.files.append(file)
+
+    def write(self, packets):
+        if not self.channels or len(packets) == 0:
+            return
+        # (time x channel) states of all channels in one gather
+        states = (packets['device_bytes'][:, self.bytes] >> self.bits) & 1
+        if self.previous_state is None:
+            changed = np.ones_like(states, dtype=bool)
+            changed[1:] = states[1:] != states[:-1]
+        else:
+            changed = states != np.vstack((self.previous_state, states[:-1]))
+        self.previous_state = states[-1:]
+
+        timestamps = packets['timestamp']
+        for channel_ind, file in enumerate(self.files):
+            change_inds = np.flatnonzero(changed[:, channel_ind])
+            if change_inds.size:
+                records = np.empty(change_inds.size, dtype=DIO_DTYPE)
+                records['time'] = timestamps[change_inds]
+                records['state'] = states[change_inds, channel_ind]
+                records.tofile(file)
+
+    def close(self):
+        for file in self.files:
+            file.close()
+
+
+class _ContinuousTimeWriter:
+    """Writes the timestamp (and system time) of every packet."""
+
+    def __init__(self, out_dir, out_base_filename, rec_file, first_timestamp):
+        fields = [('trodestime', '<u4')]
+        if rec_file.header.sys_time_included:
+            fields.append(('systime', '<i8'))
+        self.dtype = np.dtype(fields)
+        self.file = open(os.path.join(out_dir, '{}.continuoustime.dat'.format(
+            out_base_filename)), 'wb')
+        header = {'Description': 'Continuous time data'}
+        header.update(_common_header(rec_file, first_timestamp))
+        header['Fields'] = ''.join('<{} {}>'.format(name, np.dtype(dtype).name)
+                                   for name, dtype in fields)
+        write_trodes_extracted_header(self.file, header)
+
+    def write(self, packets):
+        records = np.empty(len(packets), dtype=self.dtype)
+        records['trodestime'] = packets['timestamp']
+        if 'systime' in self.dtype.names:
+            records['systime'] = packets['systime']
+        records.tofile(self.file)
+
+    def close(self):
+        self.file.close()
+
+
+_writers = {'DIO': _DIOWriter, 'time': _ContinuousTimeWriter}
+
+
+def export_rec(rec_paths, out_date_dir, out_base_filename, export_dir_exts=('DIO', 'time'),
+               chunk_size=2 ** 18):
+    """Exports DIO and/or continuous time of a recording in one pass over
+    its packets.
+
+    Parameters
+    ----------
+    rec_paths : list of str
+        Parts of one recording, in order
+    out_date_dir : str
+        Output is written to `<out_date_dir>/<out_base_filename>.<ext>`,
+        created if needed
+    out_base_filename : str
+    export_dir_exts : tuple of {'DIO', 'time'}, optional
+    chunk_size : int, optional
+        Number of packets decoded at once
+
+    """
+    rec_file = ConcatenatedRecFile(rec_paths)
+    first_timestamp = int(rec_file.part_first_timestamps[0]) if len(rec_file) else 0
+
+    writers = []
+    try:
+        for export_dir_ext in export_dir_exts:
+            out_dir = os.path.join(out_date_dir, '{}.{}'.format(out_base_filename, export_dir_ext))
+            os.makedirs(out_dir, exist_ok=True)
+            writers.append(_writers[export_dir_ext](out_dir, out_base_filename,
+                                                    rec_file, first_timestamp))
+        for _, packets in rec_file.iter_chunks(chunk_size):
+            for writer in writers:
+                writer.write(packets)
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m rec_to_binaries.rec_export', allow_abbrev=False,
+        description='Export DIO and continuous time from .rec files.')
+    parser.add_argument('-dio', action='store_true')
+    parser.add_argument('-time', action='store_true')
+    parser.add_argument('-rec', action='append', required=True)
+    parser.add_argument('-outputdirectory', default=None)
+    parser.add_argument('-output', default=None)
+    parser.add_argument('-chunksize', type=int, default=2 ** 18)
+    # the packet layout always comes from the rec file itself
+    parser.add_argument('-reconfig', default=None)
+    args, unknown_args = parser.parse_known_args(argv)
+    if unknown_args:
+        print('Ignoring unsupported arguments: {}'.format(' '.join(unknown_args)))
+
+    export_dir_exts = tuple(export_dir_ext for export_dir_ext, selected
+                            in (('DIO', args.dio), ('time', args.time)) if selected)
+    if not export_dir_exts:
+        parser.error('at least one of -dio and -time is required')
+    out_date_dir = args.outputdirectory or os.path.dirname(os.path.abspath(args.rec[0]))
+    out_base_filename = args.output or os.path.splitext(os.path.basename(args.rec[0]))[0]
+
+    export_rec(args.rec, out_date_dir, out_base_filename, export_dir_exts=export_dir_exts,
+               chunk_size=args.chunksize)
+    print('Exported {} from {} to {}'.format(', '.join(export_dir_exts), ', '.join(args.rec),
+                                             out_date_dir))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,291 @@
+"""Memory-mapped access to the packets of a Trodes .rec file.
+
+The packet stream after the XML header is mapped as a structured array, so
+any sample range can be read without running the Trodes export tools.
+`ConcatenatedRecFile` presents the parts of a recording split over several
+`.partN.rec` files as one packet stream with the same interface.
+"""
+
+import os
+from logging import getLogger
+
+import numpy as np
+
+from rec_to_binaries.rec_header import read_rec_header
+
+logger = getLogger(__name__)
+
+SYNC_BYTE = 0x55
+
+
+class RecFileError(RuntimeError):
+    pass
+
+
+def packet_dtype(header):
+    """Structured dtype of one packet described by a `RecHeader`.
+
+    Fields are `sync`, `device_bytes` (the bytes of all hardware devices,
+    e.g. DIO), `timestamp`, `systime` (if included) and `neural`, the int16
+    samples indexed by hardware channel.
+    """
+    fields = [('sync', 'u1')]
+    num_device_bytes = header.timestamp_byte - 1
+    if num_device_bytes > 0:
+        fields.append(('device_bytes', 'u1', (num_device_bytes,)))
+    fields.append(('timestamp', '<u4'))
+    if header.sys_time_included:
+        fields.append(('systime', '<i8'))
+    fields.append(('neural', '<i2', (header.num_channels,)))
+    dtype = np.dtype(fields)
+    if dtype.itemsize != header.packet_size:
+        raise RecFileError('Packet dtype of {} bytes does not match the packet size {} of ({}).'.
+                           format(dtype.itemsize, header.packet_size, header.path))
+    return dtype
+
+
+class RecFile:
+    """Packets of one .rec file, memory-mapped.
+
+    Packets are indexed by their position in the file; `index_of_timestamp`
+    and `read_time_range` map trodes timestamps to packets by binary search,
+    since timestamps increase monotonically (with gaps where packets were
+    dropped). Neural samples are indexed by hardware channel (hwChan), see
+    `ntrode_channels` for the channels of each ntrode.
+
+    Parameters
+    ----------
+    path : str
+    header : RecHeader, optional
+        Parsed header, read (from the cache if possible) if not given.
+    cache_path : str, optional
+        See `rec_header.read_rec_header`.
+    """
+
+    def __init__(self, path, header=None, cache_path=None):
+        self.path = path
+        self.header = header if header is not None else read_rec_header(path, cache_path=cache_path)
+        self.dtype = packet_dtype(self.header)
+
+        self.num_packets, trailing_bytes = divmod(
+            os.path.getsize(path) - self.header.header_size, self.dtype.itemsize)
+        if trailing_bytes:
+            logger.warning('File ({}) ends with an incomplete packet of {} bytes, ignoring it.'.
+                           format(path, trailing_bytes))
+        if self.num_packets > 0:
+            self.packets = np.memmap(path, dtype=self.dtype, mode='r',
+                                     offset=self.header.header_size, shape=(self.num_packets,))
+        else:
+            self.packets = np.empty(0, dtype=self.dtype)
+        if self.num_packets and self.packets[0]['sync'] != SYNC_BYTE:
+            raise RecFileError('File ({}) does not start with a sync byte after its header.'.
+                               format(path))
+
+    def __len__(self):
+        return self.num_packets
+
+    def __getitem__(self, key):
+        return self.packets[key]
+
+    @property
+    def sampling_rate(self):
+        return self.header.sampling_rate
+
+    @property
+    def timestamps(self):
+        """Trodes timestamps of all packets (memory-mapped)."""
+        return self.packets['timestamp']
+
+    def get_timestamps(self, start=None, stop=None, step=1):
+        return self.timestamps[start:stop:step]
+
+    def ntrode_channels(self, ntrode_id):
+        """Hardware channels of the ntrode with id `ntrode_id` (str or
+        int), in the order of its channels."""
+        for ntrode in self.header.ntrodes:
+            if ntrode.get('id') == str(ntrode_id):
+                return list(ntrode['hw_channels'])
+        raise KeyError('ntrode {} not in ({}).'.format(ntrode_id, self.path))
+
+    def neural(self, start=None, stop=None, channels=None):
+        """(time x channel) int16 samples of packets [start, stop), for the
+        given hardware channels (all by default)."""
+        data = self.packets['neural'][start:stop]
+        return data if channels is None else data[:, channels]
+
+    def ntrode_neural(self, ntrode_id, start=None, stop=None):
+        return self.neural(start, stop, channels=self.ntrode_channels(ntrode_id))
+
+    def device_bytes(self, device_name, start=None, stop=None):
+        """Raw bytes of device `device_name` (e.g. 'Controller_DIO') for
+        packets [start, stop), shape (time x numBytes)."""
+        for device in self.header.devices:
+            if device['name'] == device_name:
+                first = device['byte_offset'] - 1
+                return self.packets['device_bytes'][start:stop,
+                                                    first:first + int(device['numBytes'])]
+        raise KeyError('Device {} not in ({}).'.format(device_name, self.path))
+
+    def index_of_timestamp(self, timestamp, side='left'):
+        """Index of the first packet with a timestamp >= `timestamp` (or >
+        for side='right'); `len(self)` if there is none."""
+        return int(np.searchsorted(self.timestamps, timestamp, side=side))
+
+    def read_time_range(self, start_timestamp, stop_timestamp):
+        """Packets with start_timestamp <= timestamp < stop_timestamp."""
+        return self.packets[self.index_of_timestamp(start_timestamp):
+                            self.index_of_timestamp(stop_timestamp)]
+
+    def iter_chunks(self, chunk_size, start=0, stop=None):
+        """Yields (index of the first packet, packets) for consecutive
+        chunks of `chunk_size` packets of [start, stop). Chunks are views of
+        the memory map, so only the pages that are used are read."""
+        if stop is None:
+            stop = self.num_packets
+        for chunk_start in range(start, stop, chunk_size):
+            yield chunk_start, self.packets[chunk_start:min(chunk_start + chunk_size, stop)]
+
+
+class ConcatenatedRecFile:
+    """Packets of the parts of one recording as one continuous stream.
+
+    Every part is memory-mapped (see `RecFile`) and packets are indexed
+    globally, part after part. Reads that fall inside one part return views
+    of its map; only reads that cross a part boundary are copied.
+    `iter_chunks` splits chunks at part boundaries so it never copies.
+    Timestamp lookups first pick the part by its first timestamp, so they
+    only touch the part containing the timestamp.
+
+    Parameters
+    ----------
+    rec_paths : list of str
+        Parts in recording order (see `trodes_data.find_rec_part_number`)
+    cache_path : str, optional
+        See `rec_header.read_rec_header`.
+
+    Attributes
+    ----------
+    part_starts : ndarray
+        Global index of the first packet of each part, and the total
+        number of packets last
+    part_first_timestamps, part_last_timestamps : ndarray
+    """
+
+    def __init__(self, rec_paths, cache_path=None):
+        self.paths = list(rec_paths)
+        if not self.paths:
+            raise RecFileError('No rec files given.')
+        parts = [RecFile(path, cache_path=cache_path) for path in self.paths]
+        self.header = parts[0].header
+        self.dtype = parts[0].dtype
+        for part in parts[1:]:
+            if part.dtype != self.dtype or part.header.sampling_rate != self.header.sampling_rate:
+                raise RecFileError('Rec file ({}) has a different packet layout than ({}).'.
+                                   format(part.path, parts[0].path))
+
+        # parts without packets cannot be indexed into
+        self.parts = [part for part in parts if len(part)]
+        self.part_starts = np.cumsum([0] + [len(part) for part in self.parts])
+        self.num_packets = int(self.part_starts[-1])
+        self.part_first_timestamps = np.array([part.timestamps[0] for part in self.parts],
+                                              dtype=np.int64)
+        self.part_last_timestamps = np.array([part.timestamps[-1] for part in self.parts],
+                                             dtype=np.int64)
+        if np.any(self.part_first_timestamps[1:] <= self.part_last_timestamps[:-1]):
+            logger.warning('Parts of recording ({}) overlap in time or are out of order.'.
+                           format(', '.join(self.paths)))
+
+    def __len__(self):
+        return self.num_packets
+
+    @property
+    def sampling_rate(self):
+        return self.header.sampling_rate
+
+    def ntrode_channels(self, ntrode_id):
+        return self.parts[0].ntrode_channels(ntrode_id) if self.parts else []
+
+    def _part_ranges(self, start, stop):
+        """(part, local start, local stop, global start) of each part that
+        overlaps [start, stop)."""
+        start, stop, _ = slice(start, stop).indices(self.num_packets)
+        first_part = max(int(np.searchsorted(self.part_starts, start, side='right')) - 1, 0)
+        for part_ind in range(first_part, len(self.parts)):
+            part_start = int(self.part_starts[part_ind])
+            if part_start >= stop:
+                break
+            local_start = max(start - part_start, 0)
+            local_stop = min(stop - part_start, len(self.parts[part_ind]))
+            if local_stop > local_start:
+                yield self.parts[part_ind], local_start, local_stop, part_start + local_start
+
+    def _read(self, field, start, stop, columns=None):
+        def select(packets):
+            if field is not None:
+                packets = packets[field]
+            return packets if columns is None else packets[:, columns]
+
+        pieces = [select(part.packets[local_start:local_stop])
+                  for part, local_start, local_stop, _ in self._part_ranges(start, stop)]
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces) if pieces else select(np.empty(0, dtype=self.dtype))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                raise RecFileError('Only contiguous slices are supported.')
+            return self._read(None, key.start, key.stop)
+        index = int(key) + self.num_packets if key < 0 else int(key)
+        if not 0 <= index < self.num_packets:
+            raise IndexError('Packet {} out of range for {} packets.'.format(key, self.num_packets))
+        part_ind = int(np.searchsorted(self.part_starts, index, side='right')) - 1
+        return self.parts[part_ind].packets[index - self.part_starts[part_ind]]
+
+    def get_timestamps(self, start=None, stop=None, step=1):
+        """Timestamps of packets start, start + step, ... before stop."""
+        start = slice(start, stop).indices(self.num_packets)[0]
+        pieces = []
+        for part, local_start, local_stop, global_start in self._part_ranges(start, stop):
+            # stay on the grid of start + multiples of step across parts
+            local_start += (start - global_start) % step
+            pieces.append(part.timestamps[local_start:local_stop:step])
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces) if pieces else np.empty(0, dtype='<u4')
+
+    def neural(self, start=None, stop=None, channels=None):
+        return self._read('neural', start, stop, columns=channels)
+
+    def ntrode_neural(self, ntrode_id, start=None, stop=None):
+        return self.neural(start, stop, channels=self.ntrode_channels(ntrode_id))
+
+    def device_bytes(self, device_name, start=None, stop=None):
+        for device in self.header.devices:
+            if device['name'] == device_name:
+                first = device['byte_offset'] - 1
+                return self._read('device_bytes', start, stop,
+                                  columns=slice(first, first + int(device['numBytes'])))
+        raise KeyError('Device {} not in ({}).'.format(device_name, self.paths[0]))
+
+    def index_of_timestamp(self, timestamp, side='left'):
+        """Global index of the first packet with a timestamp >= `timestamp`
+        (or > for side='right'); `len(self)` if there is none."""
+        if not self.parts:
+            return 0
+        part_ind = max(int(np.searchsorted(self.part_first_timestamps, timestamp,
+                                           side='right')) - 1, 0)
+        return int(self.part_starts[part_ind]) + self.parts[part_ind].index_of_timestamp(
+            timestamp, side=side)
+
+    def read_time_range(self, start_timestamp, stop_timestamp):
+        return self[self.index_of_timestamp(start_timestamp):
+                    self.index_of_timestamp(stop_timestamp)]
+
+    def iter_chunks(self, chunk_size, start=0, stop=None):
+        """Yields (global index of the first packet, packets) for chunks of
+        at most `chunk_size` packets of [start, stop). Chunks end at part
+        boundaries, so every chunk is a view of one part's memory map."""
+        for part, local_start, local_stop, global_start in self._part_ranges(start, stop):
+            for chunk_start, packets in part.iter_chunks(chunk_size, local_start, local_stop):
+                yield global_start + chunk_start - local_start, packets
@@ -0,0 +1,189 @@
+"""Parser for the XML configuration embedded at the start of a Trodes .rec
+file.
+
+A .rec file is the workspace XML (`<Configuration> ... </Configuration>`)
+followed directly by the packet stream. Each packet is laid out as
+
+    sync byte (0x55)
+    device bytes, `numBytes` per device of the hardware configuration
+    trodes timestamp, uint32
+    system time, int64 (only if the hardware configuration has
+        sysTimeIncluded set)
+    neural samples, int16 x `numChannels`
+
+Headers are cached by (path, size, mtime) in memory, and optionally in a
+pickle file shared between processes and runs (see `read_rec_header`).
+"""
+
+import os
+import pickle
+import threading
+import xml.etree.ElementTree as ET
+
+HEADER_END_TAG = b'</Configuration>'
+
+_header_cache = {}
+_disk_caches = {}
+_cache_lock = threading.Lock()
+
+
+class RecHeaderError(RuntimeError):
+    pass
+
+
+class RecHeader:
+    """Configuration of one .rec file.
+
+    Attributes
+    ----------
+    path : str
+    header_size : int
+        Byte offset of the first packet
+    global_config : dict
+        Attributes of <GlobalConfiguration>
+    hardware_config : dict
+        Attributes of <HardwareConfiguration>
+    devices : list of dict
+        Attributes of each <Device>, plus `byte_offset` (offset of its bytes
+        in the packet) and `channels` (attributes of its <Channel>s)
+    ntrodes : list of dict
+        Attributes of each <SpikeNTrode>, plus `hw_channels` (the hwChan of
+        each of its channels, in order)
+    trodes_version : tuple of int or None
+    sampling_rate : int
+    num_channels : int
+        Number of neural channels in each packet
+    sys_time_included : bool
+    timestamp_byte : int
+        Offset of the trodes timestamp in the packet
+    packet_size : int
+        Bytes per packet
+    """
+
+    def __init__(self, path, header_bytes):
+        self.path = path
+        self.header_size = len(header_bytes)
+        try:
+            root = ET.fromstring(header_bytes.decode('utf-8', errors='replace'))
+        except ET.ParseError as error:
+            raise RecHeaderError('File ({}) has an invalid XML header: {}'.format(path, error))
+
+        global_config = root.find('GlobalConfiguration')
+        hardware_config = root.find('HardwareConfiguration')
+        if hardware_config is None:
+            raise RecHeaderError('File ({}) header has no HardwareConfiguration.'.format(path))
+        self.global_config = dict(global_config.attrib) if global_config is not None else {}
+        self.hardware_config = dict(hardware_config.attrib)
+
+        # sync byte, then each device's bytes
+        byte_offset = 1
+        self.devices = []
+        for device in hardware_config.findall('Device'):
+            device_info = dict(device.attrib)
+            device_info['byte_offset'] = byte_offset
+            device_info['channels'] = [dict(channel.attrib) for channel in device.findall('Channel')]
+            self.devices.append(device_info)
+            byte_offset += int(device.attrib.get('numBytes', 0))
+
+        self.ntrodes = []
+        spike_config = root.find('SpikeConfiguration')
+        if spike_config is not None:
+            for ntrode in spike_config.findall('SpikeNTrode'):
+                ntrode_info = dict(ntrode.attrib)
+                ntrode_info['hw_channels'] = [int(channel.attrib['hwChan'])
+                                              for channel in ntrode.findall('SpikeChannel')]
+                self.ntrodes.append(ntrode_info)
+
+        version = self.global_config.get('trodesVersion')
+        self.trodes_version = (tuple(int(part) for part in version.split('.')[:3])
+                               if version else None)
+        self.sampling_rate = int(self.hardware_config.get('samplingRate', 30000))
+        self.num_channels = int(self.hardware_config.get('numChannels', 0))
+        self.sys_time_included = self.hardware_config.get('sysTimeIncluded', '0').lower() in ('1', 'true')
+
+        self.timestamp_byte = byte_offset
+        self.packet_size = (byte_offset + 4 + (8 if self.sys_time_included else 0) +
+                            2 * self.num_channels)
+
+    def __repr__(self):
+        return ('RecHeader(path={!r}, trodes_version={}, sampling_rate={}, num_channels={}, '
+                'packet_size={})').format(self.path, self.trodes_version, self.sampling_rate,
+                                          self.num_channels, self.packet_size)
+
+
+def _read_header_bytes(path, block_size=1 << 16):
+    """Bytes of the XML configuration, up to and including the end tag and
+    the newline after it."""
+    with open(path, 'rb') as file:
+        header = b''
+        while True:
+            block = file.read(block_size)
+            if not block:
+                raise RecHeaderError('File ({}) has no {} tag.'.format(path, HEADER_END_TAG.decode()))
+            search_start = max(len(header) - len(HEADER_END_TAG), 0)
+            header += block
+            end = header.find(HEADER_END_TAG, search_start)
+            if end >= 0:
+                end += len(HEADER_END_TAG)
+                if header[end:end + 1] == b'\n':
+                    end += 1
+                return header[:end]
+
+
+def _cache_key(path):
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def _load_disk_cache(cache_path):
+    if cache_path not in _disk_caches:
+        try:
+            with open(cache_path, 'rb') as file:
+                _disk_caches[cache_path] = pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            _disk_caches[cache_path] = {}
+    return _disk_caches[cache_path]
+
+
+def _save_disk_cache(cache_path):
+    temp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    with open(temp_path, 'wb') as file:
+        pickle.dump(_disk_caches[cache_path], file)
+    os.replace(temp_path, cache_path)
+
+
+def read_rec_header(path, cache_path=None):
+    """Parses the configuration of a .rec file, reusing a cached result if
+    the file's size and mtime are unchanged.
+
+    Parameters
+    ----------
+    path : str
+    cache_path : str, optional
+        Pickle file to also keep parsed headers in across processes and runs.
+
+    Returns
+    -------
+    header : RecHeader
+
+    """
+    key = _cache_key(path)
+    with _cache_lock:
+        if key in _header_cache:
+            return _header_cache[key]
+        if cache_path is not None and key in _load_disk_cache(cache_path):
+            header = _header_cache[key] = _disk_caches[cache_path][key]
+            return header
+
+    header = RecHeader(path, _read_header_bytes(path))
+
+    with _cache_lock:
+        _header_cache[key] = header
+        if cache_path is not None:
+            disk_cache = _load_disk_cache(cache_path)
+            # drop entries of older versions of the same file
+            for stale_key in [stale_key for stale_key in disk_cache if stale_key[0] == key[0]]:
+                del disk_cache[stale_key]
+            disk_cache[key] = header
+            _save_disk_cache(cache_path)
+    return header
@@ -1,23 +1,34 @@
+import concurrent.futures
+import contextlib
 import copy
 import functools
 import itertools
+import json
 import multiprocessing
 import os
+import queue
 import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
 from logging import getLogger
+from multiprocessing import resource_tracker, shared_memory
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import tables
+from rec_to_binaries.array_store import open_array_store
 from rec_to_binaries.binary_utils import (TrodesDIOBinaryLoader,
                                           TrodesLFPBinaryLoader,
                                           TrodesPosBinaryLoader,
                                           TrodesSpikeBinaryLoader,
-                                          TrodesTimestampBinaryLoader)
+                                          TrodesTimestampBinaryLoader,
+                                          spikes_dataframe)
+from rec_to_binaries.rec_file import ConcatenatedRecFile, RecFile
+from rec_to_binaries.rec_header import read_rec_header
 
 logger = getLogger(__name__)
 
@@ -218,10 +229,16 @@ class TrodesPosExtractedFileNameParser(TrodesRawFileNameParser):
 class TrodesAnimalInfo:
 
     def __init__(self, base_dir, anim_name, RawFileParser=TrodesRawFileNameParser,
-                 out_dir=None, dates=None, trodes_version=None):
+                 out_dir=None, dates=None, trodes_version=None, rec_header_cache=None,
+                 default_trodes_version=None):
+        # trodes_version: major version of all days instead of reading it from
+        # each day's recordings; default_trodes_version: used if no recording
+        # states its version
         self.RawFileNameParser = RawFileParser
         self.base_dir = base_dir
         self.anim_name = anim_name
+        # optional pickle file keeping parsed rec headers across runs
+        self.rec_header_cache = rec_header_cache
 
         # optionally choose a different output path to save preprocessed data
         if out_dir is not None:
@@ -241,19 +258,46 @@ class TrodesAnimalInfo:
         self.raw_poshwframecount_files = {}
         self.raw_trodescomments_files = {}
 
+        if dates is not None:
+            # if dates given, only work on these selected dates
+            raw_day_paths = {date: day_path for date, day_path in raw_day_paths.items()
+                             if date in dates}
+
+        # Scan each day directory once, all days concurrently
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            day_raw_paths = dict(zip(
+                raw_day_paths.keys(),
+                executor.map(functools.partial(self._get_day_raw_paths,
+                                               RawFileNameParser=self.RawFileNameParser),
+                             raw_day_paths.values())))
+            if trodes_version is None:
+                day_trodes_versions = dict(zip(
+                    raw_day_paths.keys(),
+                    executor.map(functools.partial(self._get_trodes_version,
+                                                   cache_path=rec_header_cache),
+                                 [[rec_path for _, rec_path in day_raw_paths[date]['rec']]
+                                  for date in raw_day_paths])))
+            else:
+                day_trodes_versions = {date: trodes_version for date in raw_day_paths}
+
+        # major trodes version of the recordings of each day (None if a day
+        # has no rec files), and the newest of them for the whole animal
+        self.day_trodes_versions = day_trodes_versions
+        found_versions = sorted(set(version for version in day_trodes_versions.values()
+                                    if version is not None))
+        if len(found_versions) > 1:
+            logger.warning('Recordings of animal {} were made with different Trodes major versions '
+                           '({}), export commands are chosen per day.'.
+                           format(anim_name, ', '.join(map(str, found_versions))))
+        if found_versions:
+            self.trodes_version = found_versions[-1]
+        else:
+            self.trodes_version = trodes_version if trodes_version is not None else default_trodes_version
+
         # Loads and caches all raw data files that exist
         for date, day_path in raw_day_paths.items():
-            if dates is not None:
-                # if dates given, only work on these selected dates
-                if date not in dates:
-                    continue
             self.raw_rec_files[date] = {}
-            day_rec_filenames = self._get_rec_paths(
-                day_path, self.RawFileNameParser)
-            if trodes_version is None:
-                self.trodes_version = self._get_trodes_version(day_path)
-            else:
-                self.trodes_version = trodes_version
+            day_rec_filenames = day_raw_paths[date]['rec']
             for rec_filename_parsed, rec_path in day_rec_filenames:
                 if rec_filename_parsed.date != date:
                     logger.warning(('For rec file ({}) the date field does not match '
@@ -268,8 +312,7 @@ class TrodesAnimalInfo:
                         (rec_filename_parsed, rec_path)]
 
             self.raw_pos_files[date] = {}
-            day_pos_filenames = self._get_video_tracking_paths(
-                day_path, self.RawFileNameParser)
+            day_pos_filenames = day_raw_paths[date]['pos']
             for pos_filename_parsed, pos_path in day_pos_filenames:
                 raw_pos_file_date_epoch = self.raw_pos_files[date].setdefault(
                     pos_filename_parsed.epochtuple, {})
@@ -277,8 +320,7 @@ class TrodesAnimalInfo:
                     pos_filename_parsed, pos_path)
 
             self.raw_h264_files[date] = {}
-            day_h264_filenames = self._get_h264_paths(
-                day_path, self.RawFileNameParser)
+            day_h264_filenames = day_raw_paths[date]['h264']
             for h264_filename_parsed, h264_path in day_h264_filenames:
                 raw_h264_file_date_epoch = self.raw_h264_files[date].setdefault(
                     h264_filename_parsed.epochtuple, {})
@@ -286,8 +328,7 @@ class TrodesAnimalInfo:
                     h264_filename_parsed, h264_path)
 
             self.raw_postime_files[date] = {}
-            day_postime_filenames = self._get_video_timestamp_paths(
-                day_path, self.RawFileNameParser)
+            day_postime_filenames = day_raw_paths[date]['postime']
             for postime_filename_parsed, postime_path in day_postime_filenames:
                 raw_postime_file_date_epoch = self.raw_postime_files[date]. \
                     setdefault(postime_filename_parsed.epochtuple, {})
@@ -295,8 +336,7 @@ class TrodesAnimalInfo:
                     (postime_filename_parsed, postime_path)
 
             self.raw_poshwframecount_files[date] = {}
-            day_poshwframecount_filenames = self._get_video_hwframecount_paths(
-                day_path, self.RawFileNameParser)
+            day_poshwframecount_filenames = day_raw_paths[date]['poshwframecount']
             for poshwframecount_filename_parsed, poshwframecount_path in day_poshwframecount_filenames:
                 raw_poshwframecount_file_date_epoch = self.raw_poshwframecount_files[date]. \
                     setdefault(poshwframecount_filename_parsed.epochtuple, {})
@@ -304,20 +344,19 @@ class TrodesAnimalInfo:
                     (poshwframecount_filename_parsed, poshwframecount_path)
 
             self.raw_trodescomments_files[date] = {}
-            day_trodescomments_filenames = self._get_trodes_comments_paths(
-                day_path, self.RawFileNameParser)
+            day_trodescomments_filenames = day_raw_paths[date]['trodescomments']
             for trodescomments_filename_parsed, trodescomments_path in day_trodescomments_filenames:
                 self.raw_trodescomments_files[date][trodescomments_filename_parsed.epochtuple] = \
                     (trodescomments_filename_parsed, trodescomments_path)
 
-            day_trodesconf_paths = self._get_trodesconf_paths(day_path)
+            day_trodesconf_paths = day_raw_paths[date]['trodesconf']
             for trodesconf_path in day_trodesconf_paths:
                 if re.match('^(.*).trodesconf$', os.path.basename(trodesconf_path)).groups()[0] == date:
                     self.raw_date_trodesconf[date] = trodesconf_path
 
         # Load and store all preprocessing
         preprocessing_date_path_dict = self._get_preprocessing_date_path_dict(
-            self.get_preprocessing_dir())
+            self.get_preprocessing_dir(), dates=dates)
         self.preproc_datatype_dirs = self._get_preprocessing_date_data_path_df(
             preprocessing_date_path_dict)
 
@@ -373,6 +412,18 @@ class TrodesAnimalInfo:
                 ['date', 'epoch', 'label_ext', 'pos_label'],
                 TrodesPosExtractedFileNameParser))
 
+        # (date, epochtuple) -> paths, for each extracted datatype
+        self._preproc_paths_index = {
+            datatype: TrodesAnimalInfo._index_date_epoch(getattr(self, paths_attr))
+            for datatype, paths_attr in self.preproc_paths_attrs.items()}
+
+    # extracted datatype -> attribute holding the table of its paths
+    preproc_paths_attrs = {'LFP': 'preproc_LFP_paths',
+                           'spikes': 'preproc_spike_paths',
+                           'DIO': 'preproc_dio_paths',
+                           'mda': 'preproc_mda_paths',
+                           'pos': 'preproc_pos_paths'}
+
     def __repr__(self):
         return ("TrodesAnimalInfo("
                 f"anim_name={self.__dict__['anim_name']}, "
@@ -398,12 +449,10 @@ class TrodesAnimalInfo:
         """
         partial_extracted_columns = parser_datatype_fields + \
             ['dir_index', 'path']
-        partial_extracted_paths = pd.DataFrame(
-            columns=partial_extracted_columns)
+        extracted_path_rows = []
         for dir_index, directory in directory_entries_df['directory'].items():
             file_list = TrodesAnimalInfo._get_extracted_file_list(
                 directory, ExtractedFileParser=ExtractedFileParser)
-            directory_path_fields = []
             for filename_parser, file_path in file_list:
                 file_path_fields = []
                 for field in parser_datatype_fields:
@@ -413,11 +462,11 @@ class TrodesAnimalInfo:
                 file_path_fields.append(dir_index)
                 file_path_fields.append(file_path)
 
-                directory_path_fields.append(file_path_fields)
-            partial_extracted_paths = (partial_extracted_paths
-                                       .append(pd.DataFrame(directory_path_fields,
-                                                            columns=partial_extracted_columns),
-                                               ignore_index=True))
+                extracted_path_rows.append(file_path_fields)
+        partial_extracted_paths = pd.DataFrame(extracted_path_rows,
+                                               columns=partial_extracted_columns)
+        partial_extracted_paths['dir_index'] = partial_extracted_paths['dir_index'].astype(
+            directory_entries_df.index.dtype)
         datatype_paths_df = (directory_entries_df
                              .drop(labels='directory', axis=1)
                              .merge(right=partial_extracted_paths,
@@ -428,6 +477,25 @@ class TrodesAnimalInfo:
 
         return datatype_paths_df
 
+    @staticmethod
+    def _index_date_epoch(paths_df):
+        return {date_epoch: date_epoch_paths.reset_index(drop=True)
+                for date_epoch, date_epoch_paths in paths_df.groupby(['date', 'epoch'], sort=False)}
+
+    def get_preprocessing_paths(self, datatype, date, epochtuple):
+        """Extracted file paths of one datatype ('LFP', 'spikes', 'DIO', 'mda'
+        or 'pos') for a date and epoch tuple, without scanning the whole table.
+        """
+        try:
+            return self._preproc_paths_index[datatype][(date, epochtuple)]
+        except KeyError:
+            return getattr(self, self.preproc_paths_attrs[datatype]).iloc[0:0]
+
+    def get_preprocessing_epochs(self, datatype, date):
+        """Epoch tuples of a date that have extracted files of a datatype."""
+        return [epoch for (paths_date, epoch) in self._preproc_paths_index[datatype]
+                if paths_date == date]
+
     def get_raw_dates(self):
         return sorted(self.raw_rec_files.keys())
 
@@ -549,13 +617,16 @@ class TrodesAnimalInfo:
     def get_date_trodesconf(self, date):
         return self.raw_date_trodesconf[date]
 
-    def _get_preprocessing_date_path_dict(self, preprocess_path):
-        return self._get_day_dirs(preprocess_path)
+    def _get_preprocessing_date_path_dict(self, preprocess_path, dates=None):
+        date_path_dict = self._get_day_dirs(preprocess_path)
+        if dates is not None:
+            date_path_dict = {date: date_path for date, date_path in date_path_dict.items()
+                              if date in dates}
+        return date_path_dict
 
     @staticmethod
     def _get_preprocessing_date_data_path_df(date_path_dict):
-        full_data_paths = pd.DataFrame(
-            columns=['date', 'epoch', 'label_ext', 'datatype', 'directory'])
+        data_path_rows = []
         for date, date_path in date_path_dict.items():
             date_path_entries = os.scandir(date_path)
             for date_path_entry in date_path_entries:
@@ -563,16 +634,16 @@ class TrodesAnimalInfo:
                     try:
                         entry_name_parser = TrodesRawFileNameParser(
                             date_path_entry.name)
-                        full_data_paths = full_data_paths.append(dict(zip(full_data_paths.columns,
-                                                                          [date,
-                                                                           entry_name_parser.epochtuple,
-                                                                           entry_name_parser.label_ext,
-                                                                           entry_name_parser.ext,
-                                                                           date_path_entry.path])),
-                                                                 ignore_index=True)
+                        data_path_rows.append([date,
+                                               entry_name_parser.epochtuple,
+                                               entry_name_parser.label_ext,
+                                               entry_name_parser.ext,
+                                               date_path_entry.path])
                     except TrodesDataFormatError:
                         logger.warning(('Invalid folder name in preprocessing folder date ({}) folder ({}), ignoring.'.
                                         format(date, date_path_entry.name)))
+        full_data_paths = pd.DataFrame(
+            data_path_rows, columns=['date', 'epoch', 'label_ext', 'datatype', 'directory'])
         # sort and reindex paths
         full_data_paths = full_data_paths.sort_values(
             ['date', 'epoch', 'label_ext', 'datatype']).reset_index(drop=True)
@@ -585,6 +656,8 @@ class TrodesAnimalInfo:
         file_list = []
         for dir_entry in dir_entries:
             if dir_entry.is_file:
+                if dir_entry.name.endswith(ExtractRawTrodesData.export_manifest_ext):
+                    continue
                 try:
                     filename_parser = ExtractedFileParser(dir_entry.name)
                     file_list.append((filename_parser, dir_entry.path))
@@ -629,157 +702,122 @@ class TrodesAnimalInfo:
                 anim_path)))
         return anim_day_paths
 
-    @staticmethod
-    def _get_rec_paths(path, RawFileNameParser=TrodesRawFileNameParser):
-        anim_rec_paths = []
-
-        for path in Path(path).glob('**/*.rec'):
-            try:
-                anim_rec_paths.append(
-                    (TrodesRawFileNameParser(path.name), str(path)))
-            except TrodesDataFormatError:
-                logger.warning(f'Invalid trodes rec filename ({str(path.parent)}),'
-                               ' cannot be parsed, skipping.')
-
-        return anim_rec_paths
+    # (key, pattern) for raw files in the top level of a day directory
+    raw_day_file_patterns = (
+        ('pos', re.compile('^.*\\.videoPositionTracking$')),
+        ('postime', re.compile('^.*\\.videoTimeStamps$')),
+        ('poshwframecount', re.compile('^.*\\.videoTimeStamps\\.(?:cameraHWFrameCount$|cameraHWSync)')),
+        ('trodescomments', re.compile('^.*\\.trodesComments$')),
+    )
 
     @staticmethod
-    def _get_trodes_version(path):
-        rec_files = Path(path).glob('**/*.rec')
-        return np.unique(np.asarray([get_trodes_version(rec_file)[0]
-                                     for rec_file in rec_files]))[0]
+    def _get_day_raw_paths(path, RawFileNameParser=TrodesRawFileNameParser):
+        """Finds all raw files of a day in a single walk of its directory.
 
-    @staticmethod
-    def _get_video_tracking_paths(path, RawFileNameParser=TrodesRawFileNameParser):
-        anim_pos_paths = []
-
-        dir_entries = os.scandir(path)
-
-        for dir_entry in dir_entries:
-            if dir_entry.is_file():
-                if re.match('^.*\.videoPositionTracking$', dir_entry.name):
-                    try:
-                        trodes_filename_parsed = RawFileNameParser(
-                            dir_entry.name)
-                        anim_pos_paths.append(
-                            (trodes_filename_parsed, dir_entry.path))
-                    except TrodesDataFormatError:
-                        logger.warning(('Invalid trodes videoPositionTracking filename ({}), '
-                                        'cannot be parsed, skipping.').
-                                       format(dir_entry.path))
+        .rec and .h264 files are found at any depth, all other files only in
+        the top level of the day directory.
 
-        return anim_pos_paths
-
-    @staticmethod
-    def _get_h264_paths(path, RawFileNameParser=TrodesRawFileNameParser):
-        anim_h264_paths = []
-        for path in Path(path).glob('**/*.h264'):
-            try:
-                anim_h264_paths.append(
-                    (TrodesRawFileNameParser(path.name), str(path)))
-            except TrodesDataFormatError:
-                logger.warning(f'Invalid trodes h264 filename ({str(path.parent)}), '
-                               'cannot be parsed, skipping.')
-
-        return anim_h264_paths
-
-    @staticmethod
-    def _get_video_timestamp_paths(path, RawFileNameParser=TrodesRawFileNameParser):
-        anim_video_times_paths = []
-
-        dir_entries = os.scandir(path)
-
-        for dir_entry in dir_entries:
-            if dir_entry.is_file():
-                if re.match('^.*\.videoTimeStamps$', dir_entry.name):
-                    try:
-                        trodes_filename_parsed = RawFileNameParser(
-                            dir_entry.name)
-                        anim_video_times_paths.append(
-                            (trodes_filename_parsed, dir_entry.path))
-                    except TrodesDataFormatError:
-                        logger.warning(('Invalid trodes videoTimeStamps filename ({}), '
-                                        'cannot be parsed, skipping.').
-                                       format(dir_entry.path))
-
-        return anim_video_times_paths
-
-    @staticmethod
-    def _get_video_hwframecount_paths(path, RawFileNameParser=TrodesRawFileNameParser):
-        anim_video_hwframecount_paths = []
-
-        dir_entries = os.scandir(path)
-
-        for dir_entry in dir_entries:
-            if dir_entry.is_file():
-                if re.match('^.*\.videoTimeStamps\.(?:cameraHWFrameCount$|cameraHWSync)', dir_entry.name):
-                    try:
-                        trodes_filename_parsed = RawFileNameParser(
-                            dir_entry.name)
-                        anim_video_hwframecount_paths.append(
-                            (trodes_filename_parsed, dir_entry.path))
-                    except TrodesDataFormatError:
-                        logger.warning(('Invalid trodes videoTimeStamps.cameraHWFrameCount filename ({}), '
-                                        'cannot be parsed, skipping.').
-                                       format(dir_entry.path))
-
-        return anim_video_hwframecount_paths
-
-    @staticmethod
-    def _get_trodes_comments_paths(path, RawFileNameParser=TrodesRawFileNameParser):
-        trodes_comment_paths = []
-
-        dir_entries = os.scandir(path)
+        Returns:
+            dict with keys 'rec', 'h264', 'pos', 'postime', 'poshwframecount'
+            and 'trodescomments' of lists of (filename parser, path), and
+            'trodesconf' of a list of paths
 
-        for dir_entry in dir_entries:
-            if dir_entry.is_file():
-                if re.match('^.*\.trodesComments$', dir_entry.name):
+        """
+        day_raw_paths = {key: [] for key in ['rec', 'h264', 'pos', 'postime', 'poshwframecount',
+                                             'trodescomments', 'trodesconf']}
+
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            top_level = dir_path == path
+            for file_name in sorted(file_names):
+                file_path = os.path.join(dir_path, file_name)
+                ext = os.path.splitext(file_name)[1]
+                if ext in ('.rec', '.h264'):
                     try:
-                        trodes_filename_parsed = RawFileNameParser(
-                            dir_entry.name)
-                        trodes_comment_paths.append(
-                            (trodes_filename_parsed, dir_entry.path))
+                        day_raw_paths[ext[1:]].append(
+                            (TrodesRawFileNameParser(file_name), file_path))
                     except TrodesDataFormatError:
-                        logger.warning(('Invalid trodes .trodesComments filename ({}), '
-                                        'cannot be parsed, skipping.').
-                                       format(dir_entry.path))
+                        logger.warning(f'Invalid trodes {ext[1:]} filename ({dir_path}), '
+                                       'cannot be parsed, skipping.')
+                    continue
 
-        return trodes_comment_paths
+                if not top_level:
+                    continue
+                if re.match('^.*.trodesconf$', file_name):
+                    day_raw_paths['trodesconf'].append(file_path)
+                    continue
+                for key, pattern in TrodesAnimalInfo.raw_day_file_patterns:
+                    if pattern.match(file_name):
+                        try:
+                            day_raw_paths[key].append(
+                                (RawFileNameParser(file_name), file_path))
+                        except TrodesDataFormatError:
+                            logger.warning(('Invalid trodes {} filename ({}), '
+                                            'cannot be parsed, skipping.').
+                                           format(key, file_path))
+                        break
+
+        return day_raw_paths
+
+    def get_trodes_version(self, date=None):
+        """Major trodes version of the recordings of `date`, or of the whole
+        animal if `date` is None or has no rec files."""
+        day_version = self.day_trodes_versions.get(date)
+        return day_version if day_version is not None else self.trodes_version
+
+    def get_rec_header(self, rec_path):
+        """Parsed (and cached) XML configuration of a rec file, see
+        `rec_header.read_rec_header`."""
+        return read_rec_header(rec_path, cache_path=self.rec_header_cache)
+
+    def open_rec_file(self, rec_path):
+        """Memory-mapped packets of a rec file, see `rec_file.RecFile`."""
+        return RecFile(rec_path, header=self.get_rec_header(rec_path))
+
+    def open_rec_epoch(self, date, epoch):
+        """All parts of the recording of `date` and `epoch` as one
+        memory-mapped packet stream, see `rec_file.ConcatenatedRecFile`."""
+        rec_paths = sorted((rec_path for _, rec_path in self.get_raw_rec_path(date, epoch)),
+                           key=find_rec_part_number)
+        return ConcatenatedRecFile(rec_paths, cache_path=self.rec_header_cache)
 
     @staticmethod
-    def _get_trodesconf_paths(path):
-        trodesconf_paths = []
-
-        dir_entries = os.scandir(path)
+    def _get_trodes_version(rec_paths, cache_path=None):
+        versions = [get_trodes_version(rec_file, cache_path=cache_path) for rec_file in rec_paths]
+        major_versions = sorted(set(version[0] for version in versions if version is not None))
+        return int(major_versions[0]) if major_versions else None
 
-        for dir_entry in dir_entries:
-            if dir_entry.is_file():
-                if re.match('^.*.trodesconf$', dir_entry.name):
-                    trodesconf_paths.append(dir_entry.path)
 
-        return trodesconf_paths
+class TrodesPreprocessingLFPEpoch:
+    """LFP channels of one epoch, memory-mapped.
 
+    The channel and sample counts are taken from the headers and file sizes,
+    so `iter_chunks` can assemble (time x channel) blocks without loading the
+    whole epoch.
+    """
 
-class TrodesPreprocessingLFPEpoch:
     def __init__(self, anim: TrodesAnimalInfo, date, epochtuple):
 
         self.anim = anim
         self.date = date
         self.epochtuple = epochtuple
 
-        LFP_paths = anim.preproc_LFP_paths[(anim.preproc_LFP_paths['date'] == date) &
-                                           (anim.preproc_LFP_paths['epoch'] == epochtuple)]
+        LFP_paths = anim.get_preprocessing_paths('LFP', date, epochtuple)
         self.LFP_data_paths = LFP_paths[LFP_paths['timestamp_file'] == False]
         self.LFP_timestamp_paths = LFP_paths[LFP_paths['timestamp_file'] == True]
 
-        self.lfp = pd.DataFrame()
+        self.channels = []
+        self.lfp_bins = []
         for path_tup in self.LFP_data_paths.itertuples():
             if not np.isnan(path_tup.ntrode) and not np.isnan(path_tup.channel):
-                lfp_bin = TrodesLFPBinaryLoader(path_tup.path)
-                single_col = pd.MultiIndex.from_tuples([(path_tup.ntrode, path_tup.channel)],
-                                                       names=['ntrode', 'channel'])
-                self.lfp = pd.concat([self.lfp, pd.DataFrame(lfp_bin.data, columns=single_col)], axis=1,
-                                     verify_integrity=True)
+                channel = (int(path_tup.ntrode), int(path_tup.channel))
+                if channel in self.channels:
+                    raise TrodesDataFormatError(('Animal ({}), date ({}), epoch ({}) '
+                                                 'has multiple LFP files for ntrode {} '
+                                                 'channel {}.').format(anim.anim_name, date, epochtuple,
+                                                                       *channel))
+                self.channels.append(channel)
+                self.lfp_bins.append(TrodesLFPBinaryLoader(path_tup.path, mmap=True))
             else:
                 logger.warning(('Animal ({}), date ({}), epoch ({}) '
                                 'has a bad preprocessing path entry, ntrode or '
@@ -796,7 +834,7 @@ class TrodesPreprocessingLFPEpoch:
                                 'has multiple original timestamp path entries, '
                                 'using ({}).').format(anim.anim_name, date, epochtuple, orig_timestamp_path))
             orig_timestamp_bin = TrodesTimestampBinaryLoader(
-                orig_timestamp_path)
+                orig_timestamp_path, mmap=True)
             self.orig_timestamps = orig_timestamp_bin.data
         except (IndexError, FileNotFoundError):
             self.orig_timestamps = None
@@ -811,24 +849,63 @@ class TrodesPreprocessingLFPEpoch:
                 logger.warning(('Animal ({}), date ({}), epoch ({}) '
                                 'has multiple adjusted timestamp path entries, '
                                 'using ({}).').format(anim.anim_name, date, epochtuple, adj_timestamp_path))
-            adj_timestamp_bin = TrodesTimestampBinaryLoader(adj_timestamp_path)
+            adj_timestamp_bin = TrodesTimestampBinaryLoader(adj_timestamp_path, mmap=True)
             self.adj_timestamps = adj_timestamp_bin.data
         except (IndexError, FileNotFoundError):
             self.adj_timestamps = None
             logger.warning(('Animal ({}), date ({}), epoch ({}) '
-                            'missing adjusted timestamps file.').format(anim.anim_name, date, epochtuple),
-                           TrodesDataFormatWarning)
+                            'missing adjusted timestamps file.').format(anim.anim_name, date, epochtuple))
 
         # always use original timestamp
-        self.lfp.set_index(keys=self.orig_timestamps, inplace=True)
+        self.num_samples = len(self.orig_timestamps)
+        for channel, lfp_bin in zip(self.channels, self.lfp_bins):
+            if len(lfp_bin.data) != self.num_samples:
+                raise TrodesDataFormatError(('Animal ({}), date ({}), epoch ({}) '
+                                             'ntrode {} channel {} has {} samples, '
+                                             'timestamps have {}.').format(anim.anim_name, date, epochtuple,
+                                                                           *channel, len(lfp_bin.data),
+                                                                           self.num_samples))
+
+    def iter_chunks(self, chunk_size):
+        """Yields (start, block) with `block` an int16 (time x channel) array
+        of samples start to start + len(block). The same buffer is reused for
+        every chunk, so copy it to keep it.
+        """
+        block = np.empty((min(chunk_size, self.num_samples), len(self.channels)),
+                         dtype=np.int16)
+        for start in range(0, self.num_samples, chunk_size):
+            stop = min(start + chunk_size, self.num_samples)
+            out = block[:stop - start]
+            for channel_ind, lfp_bin in enumerate(self.lfp_bins):
+                out[:, channel_ind] = lfp_bin.data[start:stop]
+            yield start, out
+
+    @property
+    def lfp(self):
+        """The whole epoch as a DataFrame indexed by timestamp, with
+        (ntrode, channel) columns."""
+        data = np.empty((self.num_samples, len(self.channels)), dtype=np.int16)
+        for start, block in self.iter_chunks(max(self.num_samples, 1)):
+            data[start:start + len(block)] = block
+        return pd.DataFrame(data,
+                            index=np.asarray(self.orig_timestamps),
+                            columns=pd.MultiIndex.from_tuples(self.channels,
+                                                              names=['ntrode', 'channel']))
 
 
 class TrodesPreprocessingSpikeEpoch:
 
-    def __init__(self, anim: TrodesAnimalInfo, date, epochtuple, time_label, parallel_instances=1):
-        self.spike_paths = anim.preproc_spike_paths[(anim.preproc_spike_paths['date'] == date) &
-                                                    (anim.preproc_spike_paths['epoch'] == epochtuple) &
-                                                    (anim.preproc_spike_paths['time_label'] == time_label)]
+    def __init__(self, anim: TrodesAnimalInfo, date, epochtuple, time_label, parallel_instances=1,
+                 pool=None):
+        """
+        Args:
+            pool: multiprocessing.Pool to load the ntrodes with, e.g. one
+                kept open across epochs. If None, a pool of
+                `parallel_instances` processes is started for this epoch when
+                `parallel_instances` > 1.
+        """
+        spike_paths = anim.get_preprocessing_paths('spikes', date, epochtuple)
+        self.spike_paths = spike_paths[spike_paths['time_label'] == time_label]
         self.anim = anim
         self.date = date
         self.epochtuple = epochtuple
@@ -847,11 +924,103 @@ class TrodesPreprocessingSpikeEpoch:
                                 'has a nan entry that is not a timestamp '
                                 'file, skipping.').format(anim.anim_name, date, epochtuple))
 
-        p = multiprocessing.Pool(parallel_instances)
-        spikes_loaded = p.map(TrodesSpikeBinaryLoader, path_list, chunksize=1)
-        self.spikes = dict(
-            zip(ntrode_list, [loader.spikes for loader in spikes_loaded]))
-        p.close()
+        if pool is None and parallel_instances > 1:
+            pool = multiprocessing.Pool(parallel_instances)
+            try:
+                self.spikes = self._load_spikes_pool(pool, ntrode_list, path_list)
+            finally:
+                pool.close()
+                pool.join()
+        elif pool is not None:
+            self.spikes = self._load_spikes_pool(pool, ntrode_list, path_list)
+        else:
+            self.spikes = {ntrode: TrodesSpikeBinaryLoader(path).spikes
+                           for ntrode, path in zip(ntrode_list, path_list)}
+
+    @staticmethod
+    def _load_spikes_pool(pool, ntrode_list, path_list):
+        # workers hand the records back through shared memory, so only the
+        # block names go through the pool's pipes
+        spikes = {}
+        shared_list = pool.imap(_share_spike_records, path_list)
+        try:
+            for ntrode, shared in zip(ntrode_list, shared_list):
+                records, release = _attach_shared_records(*shared)
+                try:
+                    spikes[ntrode] = spikes_dataframe(records['time'], records['waveform'],
+                                                      copy=True)
+                finally:
+                    del records
+                    release()
+        finally:
+            # after an error, the blocks of the remaining files still have to
+            # be unlinked; nothing is left after a complete run
+            _release_remaining_shared_records(shared_list)
+        return spikes
+
+
+def _share_spike_records(path):
+    """Pool worker: loads a spike file into shared memory and returns (block
+    name, dtype, count) for `_attach_shared_records`. The caller releases
+    the block.
+    """
+    spike_bin = TrodesSpikeBinaryLoader(path, mmap=True)
+    num_spikes = len(spike_bin.timestamps)
+    nbytes = max(num_spikes * spike_bin.spike_dtype.itemsize, 1)
+    block = _create_untracked_shared_memory(nbytes)
+    try:
+        records = np.ndarray((num_spikes,), dtype=spike_bin.spike_dtype, buffer=block.buf)
+        records['time'] = spike_bin.timestamps
+        records['waveform'] = spike_bin.waveforms
+        del records
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+    return block.name, spike_bin.spike_dtype, num_spikes
+
+
+def _create_untracked_shared_memory(nbytes):
+    """Creates a shared memory block that the creating worker's resource
+    tracker will not unlink when the worker exits; the process that attaches
+    to it takes over unlinking it."""
+    try:
+        return shared_memory.SharedMemory(create=True, size=nbytes, track=False)
+    except TypeError:  # Python < 3.13
+        block = shared_memory.SharedMemory(create=True, size=nbytes)
+        if os.name == 'posix':
+            # the tracker registers the POSIX name, which has a leading slash
+            resource_tracker.unregister('/' + block.name, 'shared_memory')
+        return block
+
+
+def _attach_shared_records(name, dtype, num_spikes):
+    """Maps records shared by `_share_spike_records`. Returns the records and
+    a function that unmaps and deletes the block once they are no longer
+    referenced."""
+    block = shared_memory.SharedMemory(name=name)
+    buffer = block.buf
+
+    def release():
+        buffer.release()
+        block.close()
+        block.unlink()
+    return np.ndarray((num_spikes,), dtype=dtype, buffer=buffer), release
+
+
+def _release_remaining_shared_records(shared_list):
+    """Unlinks the blocks of the results left in a `pool.imap` iterator of
+    `_share_spike_records`, waiting for the workers to finish them."""
+    while True:
+        try:
+            shared = next(shared_list)
+        except StopIteration:
+            return
+        except Exception:
+            # the worker failed and has not left a block behind
+            continue
+        _attach_shared_records(*shared)[1]()
 
 
 class TrodesPreprocessingPosEpoch:
@@ -860,8 +1029,7 @@ class TrodesPreprocessingPosEpoch:
         self.date = date
         self.epochtuple = epochtuple
 
-        self.pos_paths = anim.preproc_pos_paths[(anim.preproc_pos_paths['date'] == date) &
-                                                (anim.preproc_pos_paths['epoch'] == epochtuple)]
+        self.pos_paths = anim.get_preprocessing_paths('pos', date, epochtuple)
 
         self.timestamps = {}
         self.pos = {}
@@ -892,8 +1060,7 @@ class TrodesPreprocessingDIOEpoch:
         self.date = date
         self.epochtuple = epochtuple
 
-        self.dio_paths = anim.preproc_dio_paths[(anim.preproc_dio_paths['date'] == date) &
-                                                (anim.preproc_dio_paths['epoch'] == epochtuple)]
+        self.dio_paths = anim.get_preprocessing_paths('DIO', date, epochtuple)
 
         self.dio = {}
         for path_tup in self.dio_paths.itertuples():
@@ -902,50 +1069,261 @@ class TrodesPreprocessingDIOEpoch:
 
                 dio_bin = TrodesDIOBinaryLoader(path_tup.path)
 
-                dio_bin.dio.columns = pd.MultiIndex.from_tuples([(path_tup.direction, int(path_tup.channel))],
-                                                                names=['direction', 'channel'])
+                dio_df = dio_bin.dio
+                dio_df.columns = pd.MultiIndex.from_tuples([(path_tup.direction, int(path_tup.channel))],
+                                                           names=['direction', 'channel'])
 
-                dio_list.append(dio_bin.dio)
+                dio_list.append(dio_df)
 
 
 class TrodesPreprocessingToAnalysis:
-    def __init__(self, anim: TrodesAnimalInfo):
-        self.trodes_anim = anim
 
-    def convert_lfp_day(self, date):
-        self._convert_generic_day(
-            date, self.trodes_anim.preproc_LFP_paths, 'lfp', self._write_lfp_epoch)
+    # datatype: (preprocessing paths attribute, analysis file label,
+    #            group holding the epochs)
+    analysis_datatypes = {'LFP': ('preproc_LFP_paths', 'lfp', 'preprocessing/LFP'),
+                          'spikes': ('preproc_spike_paths', 'spikewaves', 'preprocessing/EventWaveform'),
+                          'pos': ('preproc_pos_paths', 'rawpos', 'preprocessing/Position'),
+                          'DIO': ('preproc_dio_paths', 'dio', 'preprocessing/BehavioralEvents/dio')}
 
-    def _write_lfp_epoch(self, date, epoch, hdf_store):
+    def __init__(self, anim: TrodesAnimalInfo, complib=None, complevel=0, hdf_format='fixed',
+                 chunk_rows=None, backend='hdf5', writer_threads=1, epoch_shards=False,
+                 lfp_layout='frame'):
+        """
+        Args:
+            anim: TrodesAnimalInfo
+            complib: HDF5 compression library, any of `available_hdf_complibs()`
+                (e.g. 'blosc:lz4', 'blosc:zstd', 'zlib'). Defaults to 'zlib'
+                when only `complevel` is given.
+            complevel: compression level 0-9, 0 for no compression
+            hdf_format: 'fixed' or 'table', pandas storage format of the
+                LFP, spike, position and DIO frames. 'table' is chunked and
+                can be read partially (`HDFStore.select` with `start`/`stop`),
+                and LFP epochs are appended to it chunk by chunk instead of
+                being loaded whole.
+            chunk_rows: rows per HDF5 chunk of the LFP arrays
+                (`lfp_layout='arrays'`); chosen by PyTables from the epoch
+                length if None. With an array store backend, rows per chunk
+                of every array.
+            backend: 'hdf5' for one `.h5` file per day and datatype, or
+                'zarr'/'npy' for a chunked directory store (see
+                `rec_to_binaries.array_store`) per day and datatype, named
+                `.zarr`/`.npy` instead of `.h5`. Frames are stored as one
+                array per column plus one for the index.
+            writer_threads: with an array store backend, number of threads
+                writing LFP channels, spike ntrodes or frames concurrently
+            epoch_shards: write each epoch to its own HDF5 shard with
+                `convert_epoch_shard` and link them into the day file with
+                `build_day_index`, instead of the convert_*_day methods
+            lfp_layout: 'frame' to store each LFP epoch as a pandas frame at
+                `preprocessing/LFP/eXX/data`, readable with `pd.read_hdf`, or
+                'arrays' for the PyTables arrays written by
+                `_write_lfp_epoch`, which are always streamed and can be
+                sliced by sample and channel. Both are read by
+                `read_lfp_epoch`. The default 'frame' layout with the 'fixed'
+                format builds each LFP epoch whole in memory before writing
+                it; use `hdf_format='table'` or `lfp_layout='arrays'` to keep
+                memory bounded by `chunk_size` samples.
+        """
+        if backend not in ('hdf5', 'zarr', 'npy'):
+            raise ValueError("backend must be 'hdf5', 'zarr' or 'npy', not {!r}".format(backend))
+        if epoch_shards and backend != 'hdf5':
+            raise ValueError('epoch_shards is only supported with the hdf5 backend.')
+        if hdf_format not in ('fixed', 'table'):
+            raise ValueError("hdf_format must be 'fixed' or 'table', not {!r}".format(hdf_format))
+        if lfp_layout not in ('frame', 'arrays'):
+            raise ValueError("lfp_layout must be 'frame' or 'arrays', not {!r}".format(lfp_layout))
+        if complib is not None and complib not in available_hdf_complibs():
+            raise ValueError('HDF5 compression library {!r} is not available, use one of {}.'
+                             .format(complib, available_hdf_complibs()))
+        self.trodes_anim = anim
+        self.complib = complib
+        self.complevel = complevel
+        self.hdf_format = hdf_format
+        self.chunk_rows = chunk_rows
+        self.backend = backend
+        self.writer_threads = writer_threads
+        self.epoch_shards = epoch_shards
+        self.lfp_layout = lfp_layout
+
+    def convert_lfp_day(self, date, chunk_size=2 ** 16):
+        write_epoch_func = self._write_lfp_epoch if self.backend == 'hdf5' else self._store_lfp_epoch
+        self._convert_generic_day(
+            date, self.trodes_anim.preproc_LFP_paths, 'lfp',
+            functools.partial(write_epoch_func, chunk_size=chunk_size))
+
+    def _store_lfp_epoch(self, date, epoch, store, chunk_size=2 ** 16):
+        """Array store version of `_write_lfp_epoch`, with the arrays of its
+        'arrays' layout.
+        `data` is chunked per channel so each channel is written by its own
+        writer straight from its memory-mapped file."""
         lfp_epoch = TrodesPreprocessingLFPEpoch(self.trodes_anim, date, epoch)
-        hdf_store['preprocessing/LFP/' +
-                  'e{:02d}'.format(epoch[0]) + '/data'] = lfp_epoch.lfp
+        prefix = 'preprocessing/LFP/' + 'e{:02d}'.format(int(epoch[0])) + '/'
+        num_samples = lfp_epoch.num_samples
+        chunk_rows = max(min(self.chunk_rows or chunk_size, num_samples), 1)
+
+        channels = np.asarray(lfp_epoch.channels, dtype=np.int64).reshape(-1, 2)
+        store.create_array(prefix + 'channels', channels.shape, channels.dtype,
+                           (max(len(channels), 1), 2)).write(channels)
+        timestamps = store.create_array(prefix + 'timestamps', (num_samples,),
+                                        lfp_epoch.orig_timestamps.dtype, (chunk_rows,))
+        data = store.create_array(prefix + 'data', (num_samples, len(channels)),
+                                  np.int16, (chunk_rows, 1))
+
+        def write_rows(array, source, column=None):
+            for start in range(0, num_samples, chunk_rows):
+                if column is None:
+                    array.write(source[start:start + chunk_rows], (start,))
+                else:
+                    array.write(source[start:start + chunk_rows, np.newaxis], (start, column))
+
+        writers = [functools.partial(write_rows, timestamps, lfp_epoch.orig_timestamps)]
+        writers += [functools.partial(write_rows, data, lfp_bin.data, column)
+                    for column, lfp_bin in enumerate(lfp_epoch.lfp_bins)]
+        self._run_writers(writers)
+
+    def _write_lfp_epoch(self, date, epoch, hdf_store, chunk_size=2 ** 16):
+        """Writes the epoch to `preprocessing/LFP/eXX`.
 
-    def convert_spike_day(self, date, time_label='', parallel_instances=1):
-        self._convert_generic_day(date, self.trodes_anim.preproc_spike_paths, 'spikewaves',
-                                  functools.partial(self._write_spike_epoch,
-                                                    time_label=time_label, parallel_instances=parallel_instances)
-                                  )
+        With `lfp_layout='frame'`, `eXX/data` is the epoch's DataFrame
+        indexed by timestamp, with (ntrode, channel) columns. The 'table'
+        format is appended `chunk_size` samples at a time, the 'fixed'
+        format is written at once, so the whole epoch is held in memory.
 
-    def _write_spike_epoch(self, date, epoch, hdf_store, time_label, parallel_instances=1):
+        With `lfp_layout='arrays'`, the epoch is streamed `chunk_size`
+        samples at a time into the arrays
+
+        data : int16 (time x channel)
+        timestamps : uint32 (time,)
+        channels : int (channel x 2), ntrode and channel of each data column
+
+        Read either back as a DataFrame with `read_lfp_epoch`.
+        """
+        lfp_epoch = TrodesPreprocessingLFPEpoch(self.trodes_anim, date, epoch)
+        group_path = '/preprocessing/LFP/' + 'e{:02d}'.format(int(epoch[0]))
+
+        # an epoch written before may have either layout
+        h5file = hdf_store.root._v_file
+        if group_path in h5file:
+            h5file.remove_node(group_path, recursive=True)
+
+        if self.lfp_layout == 'frame':
+            key = group_path + '/data'
+            if self.hdf_format == 'fixed':
+                hdf_store.put(key, lfp_epoch.lfp, format='fixed')
+                return
+            columns = pd.MultiIndex.from_tuples(lfp_epoch.channels, names=['ntrode', 'channel'])
+            for start, block in lfp_epoch.iter_chunks(chunk_size):
+                hdf_store.append(key, pd.DataFrame(
+                    block, index=np.asarray(lfp_epoch.orig_timestamps[start:start + len(block)]),
+                    columns=columns), expectedrows=max(lfp_epoch.num_samples, 1))
+            return
+
+        # the store's compression settings only apply to what pandas writes
+        filters = None
+        if self.complevel:
+            filters = tables.Filters(complevel=self.complevel, complib=self.complib or 'zlib')
+        num_channels = len(lfp_epoch.channels)
+        chunkshape = None
+        if self.chunk_rows is not None and num_channels > 0:
+            chunkshape = (self.chunk_rows, num_channels)
+
+        group = h5file.create_group(*group_path.rsplit('/', 1), createparents=True)
+        h5file.create_array(group, 'channels',
+                            np.asarray(lfp_epoch.channels, dtype=np.int64).reshape(-1, 2))
+        timestamps = h5file.create_earray(group, 'timestamps',
+                                          obj=np.empty(0, dtype=lfp_epoch.orig_timestamps.dtype),
+                                          filters=filters,
+                                          expectedrows=lfp_epoch.num_samples)
+        data = h5file.create_earray(group, 'data',
+                                    obj=np.empty((0, num_channels), dtype=np.int16),
+                                    filters=filters, chunkshape=chunkshape,
+                                    expectedrows=lfp_epoch.num_samples)
+        for start, block in lfp_epoch.iter_chunks(chunk_size):
+            data.append(block)
+            timestamps.append(lfp_epoch.orig_timestamps[start:start + len(block)])
+
+    @staticmethod
+    def read_lfp_epoch(hdf_store, epoch):
+        """Reads an LFP epoch written by `_write_lfp_epoch`, in either layout,
+        as a DataFrame indexed by timestamp, with (ntrode, channel) columns."""
+        # nodes are looked up by full path so this also reads through the
+        # links of an epoch shard index (see `build_day_index`)
+        group_path = 'preprocessing/LFP/' + 'e{:02d}'.format(int(epoch))
+        if hdf_store.get_node(group_path + '/channels') is None:
+            return hdf_store.get(group_path + '/data')
+        return pd.DataFrame(hdf_store.get_node(group_path + '/data').read(),
+                            index=hdf_store.get_node(group_path + '/timestamps').read(),
+                            columns=pd.MultiIndex.from_tuples(
+                                [tuple(channel) for channel
+                                 in hdf_store.get_node(group_path + '/channels').read()],
+                                names=['ntrode', 'channel']))
+
+    def convert_spike_day(self, date, time_label='', parallel_instances=1, pool=None):
+        """
+        Args:
+            pool: multiprocessing.Pool to load spike files with, so one pool
+                can serve several days. If None and `parallel_instances` > 1,
+                one pool is used for all epochs of the day.
+        """
+        with contextlib.ExitStack() as stack:
+            if pool is None and parallel_instances > 1 and self.backend == 'hdf5':
+                pool = multiprocessing.Pool(parallel_instances)
+                stack.callback(pool.join)
+                stack.callback(pool.close)
+            write_epoch_func = self._write_spike_epoch if self.backend == 'hdf5' else self._store_spike_epoch
+            self._convert_generic_day(date, self.trodes_anim.preproc_spike_paths, 'spikewaves',
+                                      functools.partial(write_epoch_func,
+                                                        time_label=time_label, pool=pool)
+                                      )
+
+    def _store_spike_epoch(self, date, epoch, store, time_label, pool=None):
+        """Array store version of `_write_spike_epoch`: for each ntrode,
+        `preprocessing/EventWaveform/eXX/tYY/timestamps` and `waveforms`
+        (spike x channel x sample), written from the memory-mapped spike
+        files by concurrent writers. `pool` is not needed here and ignored."""
+        spike_paths = self.trodes_anim.get_preprocessing_paths('spikes', date, epoch)
+        spike_paths = spike_paths[(spike_paths['time_label'] == time_label) &
+                                  ~spike_paths['ntrode'].isnull()]
+        prefix = 'preprocessing/EventWaveform/' + 'e{:02d}'.format(int(epoch[0])) + '/'
+
+        def write_ntrode(ntrode, path):
+            spike_bin = TrodesSpikeBinaryLoader(path, mmap=True)
+            num_spikes = len(spike_bin.timestamps)
+            chunk_rows = max(min(self.chunk_rows or 2 ** 12, num_spikes), 1)
+            ntrode_prefix = prefix + 't{:02d}'.format(int(ntrode)) + '/'
+            timestamps = store.create_array(ntrode_prefix + 'timestamps', (num_spikes,),
+                                            spike_bin.timestamps.dtype, (chunk_rows,))
+            waveforms = store.create_array(ntrode_prefix + 'waveforms', spike_bin.waveforms.shape,
+                                           spike_bin.waveforms.dtype,
+                                           (chunk_rows,) + spike_bin.waveforms.shape[1:])
+            for start in range(0, num_spikes, chunk_rows):
+                timestamps.write(spike_bin.timestamps[start:start + chunk_rows], (start,))
+                waveforms.write(spike_bin.waveforms[start:start + chunk_rows], (start, 0, 0))
+
+        self._run_writers([functools.partial(write_ntrode, path_tup.ntrode, path_tup.path)
+                           for path_tup in spike_paths.itertuples()])
+
+    def _write_spike_epoch(self, date, epoch, hdf_store, time_label, parallel_instances=1, pool=None):
 
         spike_epoch = TrodesPreprocessingSpikeEpoch(self.trodes_anim, date, epoch, time_label,
-                                                    parallel_instances=parallel_instances)
+                                                    parallel_instances=parallel_instances, pool=pool)
         for ntrode, spike_ntrode in spike_epoch.spikes.items():
-            hdf_store.put('preprocessing/EventWaveform/' + 'e{:02d}'.format(int(epoch[0])) +
-                          '/t{:02d}'.format(int(ntrode)) + '/data',
-                          spike_ntrode, expectedrows=len(spike_ntrode))
+            self._put_frame(hdf_store,
+                            'preprocessing/EventWaveform/' + 'e{:02d}'.format(int(epoch[0])) +
+                            '/t{:02d}'.format(int(ntrode)) + '/data',
+                            spike_ntrode)
 
     def convert_pos_day(self, date):
         self._convert_generic_day(
-            date, self.trodes_anim.preproc_dio_paths, 'rawpos', self._write_pos_epoch)
+            date, self.trodes_anim.preproc_pos_paths, 'rawpos', self._write_pos_epoch)
 
     def _write_pos_epoch(self, date, epoch, hdf_store):
         pos_epoch = TrodesPreprocessingPosEpoch(self.trodes_anim, date, epoch)
         for pos_label, pos_data in pos_epoch.pos.items():
-            hdf_store.put('preprocessing/Position/' + 'e{:02d}'.format(int(epoch[0])) +
-                          '/' + pos_label + '/data',
-                          pos_data, expectedrows=len(pos_data))
+            self._put_frame(hdf_store,
+                            'preprocessing/Position/' + 'e{:02d}'.format(int(epoch[0])) +
+                            '/' + pos_label + '/data',
+                            pos_data)
 
     def convert_dio_day(self, date):
         self._convert_generic_day(
@@ -956,11 +1334,50 @@ class TrodesPreprocessingToAnalysis:
         # only take non adjusted dio
         dio_data = dio_epoch.dio['']
         for dio_chan_df in dio_data:
-            hdf_store.put('preprocessing/BehavioralEvents/dio/' + 'e{:02d}'.format(int(epoch[0])) +
-                          '/{:s}_{:02d}'.format(dio_chan_df.columns.get_level_values('direction')[0],
-                                                int(dio_chan_df.columns.get_level_values('channel')[0])) +
-                          '/data',
-                          dio_chan_df)
+            self._put_frame(hdf_store,
+                            'preprocessing/BehavioralEvents/dio/' + 'e{:02d}'.format(int(epoch[0])) +
+                            '/{:s}_{:02d}'.format(dio_chan_df.columns.get_level_values('direction')[0],
+                                                  int(dio_chan_df.columns.get_level_values('channel')[0])) +
+                            '/data',
+                            dio_chan_df.set_axis(['state'], axis=1) if self.backend != 'hdf5' else dio_chan_df)
+
+    def _put_frame(self, store, key, frame):
+        if self.backend != 'hdf5':
+            self._store_frame(store, key, frame)
+            return
+        hdf_store = store
+        if self.hdf_format == 'table':
+            if key in hdf_store:
+                hdf_store.remove(key)
+            # the table's chunk size is chosen from the expected rows
+            hdf_store.append(key, frame, expectedrows=max(len(frame), 1))
+        else:
+            hdf_store.put(key, frame, format='fixed')
+
+    def _store_frame(self, store, key, frame):
+        """Stores a frame as `key/<index name>` plus `key/<column>` arrays."""
+        chunk_rows = max(min(self.chunk_rows or 2 ** 16, len(frame)), 1)
+        columns = {frame.index.name or 'index': frame.index.to_numpy()}
+        columns.update({str(name): frame[name].to_numpy() for name in frame.columns})
+
+        def write_column(name, values):
+            array = store.create_array(key + '/' + name, values.shape, values.dtype,
+                                       (chunk_rows,) + values.shape[1:])
+            for start in range(0, len(values), chunk_rows):
+                array.write(values[start:start + chunk_rows], (start,) + (0,) * (values.ndim - 1))
+
+        self._run_writers([functools.partial(write_column, name, values)
+                           for name, values in columns.items()])
+
+    def _run_writers(self, writers):
+        """Calls each of `writers`, on `writer_threads` threads."""
+        if self.writer_threads <= 1:
+            for writer in writers:
+                writer()
+            return
+        with concurrent.futures.ThreadPoolExecutor(self.writer_threads) as executor:
+            for future in [executor.submit(writer) for writer in writers]:
+                future.result()
 
     def _convert_generic_day(self, date, datatype_path_df, hdf_datatype_extension, write_epoch_func):
 
@@ -968,30 +1385,268 @@ class TrodesPreprocessingToAnalysis:
             raise TrodesDataFormatError('Animal ({}), date ({}) does not have preprocessed {} data'.
                                         format(self.trodes_anim.anim_name, date, hdf_datatype_extension))
 
-        if not os.path.exists(self.trodes_anim.get_analysis_dir()):
-            os.mkdir(self.trodes_anim.get_analysis_dir())
-
-        with pd.HDFStore(os.path.join(self.trodes_anim.get_analysis_dir(),
-                                      TrodesPreprocessingToAnalysis.
-                                      _assemble_analysis_base_name(date, self.trodes_anim.anim_name,
-                                                                   hdf_datatype_extension))
-                         ) as hdf_store:
+        if self.epoch_shards:
+            raise TrodesDataFormatError('Day files cannot be written in epoch shard mode, use '
+                                        'convert_epoch_shard and build_day_index.')
+
+        os.makedirs(self.trodes_anim.get_analysis_dir(), exist_ok=True)
+        epochs = datatype_path_df[datatype_path_df['date']
+                                  == date]['epoch'].unique()
+
+        if self.backend != 'hdf5':
+            store = open_array_store(
+                os.path.join(self.trodes_anim.get_analysis_dir(),
+                             TrodesPreprocessingToAnalysis.
+                             _assemble_analysis_base_name(date, self.trodes_anim.anim_name,
+                                                          hdf_datatype_extension,
+                                                          ext='.' + self.backend)),
+                backend=self.backend)
+            for epoch in epochs:
+                write_epoch_func(date, epoch, store)
+            return
 
-            epochs = datatype_path_df[datatype_path_df['date']
-                                      == date]['epoch'].unique()
+        with self._open_hdf_store(os.path.join(self.trodes_anim.get_analysis_dir(),
+                                               TrodesPreprocessingToAnalysis.
+                                               _assemble_analysis_base_name(date, self.trodes_anim.anim_name,
+                                                                            hdf_datatype_extension))
+                                  ) as hdf_store:
 
             for epoch in epochs:
                 write_epoch_func(date, epoch, hdf_store)
 
+    def _open_hdf_store(self, path, mode='a'):
+        return pd.HDFStore(path, mode=mode,
+                           complevel=self.complevel,
+                           complib=(self.complib or 'zlib') if self.complevel else None)
+
+    def convert_epoch_shard(self, datatype, date, epoch, overwrite=False, time_label='', pool=None):
+        """Converts one epoch to its own shard file,
+        `<date>_<anim>_<datatype>.shards/eNN.h5` in the analysis directory,
+        with the same layout the day file would have for that epoch.
+
+        The shard is written to a temporary file and moved into place, so a
+        failed epoch never leaves a partial shard.
+
+        Args:
+            datatype: 'LFP', 'spikes', 'pos' or 'DIO'
+            epoch: epoch tuple, as in the preprocessing paths tables
+            overwrite: if False, an existing shard newer than all of the
+                epoch's binaries is kept
+            time_label, pool: as for `convert_spike_day`
+
+        Returns:
+            True if the shard was written, False if it was up to date.
+        """
+        paths_attr, datatype_extension, _ = self.analysis_datatypes[datatype]
+        write_epoch_func = {'LFP': self._write_lfp_epoch,
+                            'spikes': functools.partial(self._write_spike_epoch,
+                                                        time_label=time_label, pool=pool),
+                            'pos': self._write_pos_epoch,
+                            'DIO': self._write_dio_epoch}[datatype]
+
+        shard_path = os.path.join(self._epoch_shard_dir(date, datatype_extension),
+                                  'e{:02d}.h5'.format(int(epoch[0])))
+        epoch_paths = self.trodes_anim.get_preprocessing_paths(datatype, date, epoch)
+        if len(epoch_paths) == 0:
+            raise TrodesDataFormatError('Animal ({}), date ({}), epoch ({}) does not have preprocessed {} data'.
+                                        format(self.trodes_anim.anim_name, date, epoch, datatype))
+        if (not overwrite and os.path.exists(shard_path) and
+                os.path.getmtime(shard_path) >= max(os.path.getmtime(path) for path in epoch_paths['path'])):
+            return False
+
+        os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+        temp_path = shard_path + '.tmp'
+        try:
+            with self._open_hdf_store(temp_path, mode='w') as hdf_store:
+                write_epoch_func(date, epoch, hdf_store)
+            os.replace(temp_path, shard_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return True
+
+    def build_day_index(self, datatype, date):
+        """Writes the day file `<date>_<anim>_<datatype>.h5` of a datatype
+        converted with `convert_epoch_shard`, made of HDF5 external links to
+        the epochs in the shards, so it is read with the same keys (e.g.
+        `preprocessing/LFP/e01/data`) as a day file written directly.
+
+        Links are relative to the day file, so the analysis directory can be
+        moved. `HDFStore.keys()` does not list linked objects, but reading
+        them by key works.
+
+        Returns:
+            list of the linked epoch group paths
+        """
+        _, datatype_extension, epoch_group_prefix = self.analysis_datatypes[datatype]
+        shard_dir = self._epoch_shard_dir(date, datatype_extension)
+        day_path = os.path.join(self.trodes_anim.get_analysis_dir(),
+                                self._assemble_analysis_base_name(date, self.trodes_anim.anim_name,
+                                                                  datatype_extension))
+        shard_names = sorted(name for name in os.listdir(shard_dir)
+                             if re.match(r'^e\d+\.h5$', name))
+
+        linked = []
+        temp_path = day_path + '.tmp'
+        try:
+            with tables.open_file(temp_path, 'w') as day_file:
+                for shard_name in shard_names:
+                    epoch_key = shard_name[:-len('.h5')]
+                    group_path = '/' + epoch_group_prefix + '/' + epoch_key
+                    with tables.open_file(os.path.join(shard_dir, shard_name), 'r') as shard_file:
+                        if group_path not in shard_file:
+                            continue
+                    day_file.create_external_link(
+                        '/' + epoch_group_prefix, epoch_key,
+                        os.path.basename(shard_dir) + '/' + shard_name + ':' + group_path,
+                        createparents=True)
+                    linked.append(group_path)
+            os.replace(temp_path, day_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return linked
+
+    def _epoch_shard_dir(self, date, datatype_extension):
+        return os.path.join(self.trodes_anim.get_analysis_dir(),
+                            self._assemble_analysis_base_name(date, self.trodes_anim.anim_name,
+                                                              datatype_extension, ext='.shards'))
+
     @staticmethod
-    def _assemble_analysis_base_name(date, anim_name, datatype):
-        return date + '_' + anim_name + '_' + datatype + '.h5'
+    def _assemble_analysis_base_name(date, anim_name, datatype, ext='.h5'):
+        return date + '_' + anim_name + '_' + datatype + ext
+
+
+def available_hdf_complibs():
+    """HDF5 compression libraries usable in this PyTables installation, in
+    the form accepted by `pd.HDFStore` (e.g. 'zlib', 'blosc:zstd')."""
+    complibs = []
+    for complib in tables.filters.all_complibs:
+        library, _, compressor = complib.partition(':')
+        if tables.which_lib_version(library) is None:
+            continue
+        if compressor and library == 'blosc' and compressor not in tables.blosc_compressor_list():
+            continue
+        if compressor and library == 'blosc2' and compressor not in tables.blosc2_compressor_list():
+            continue
+        complibs.append(complib)
+    return complibs
+
+
+class ExportJob:
+    """A single planned run of a Trodes export command on one rec file set,
+    producing one output directory per exported datatype.
+    """
+
+    def __init__(self, export_cmd, export_call, export_dir_exts, date, epochlist,
+                 anim_name, out_date_dir, out_base_filename, log_filename):
+        self.export_cmd = export_cmd
+        self.export_call = export_call
+        self.export_dir_exts = export_dir_exts
+        self.date = date
+        self.epochlist = epochlist
+        self.anim_name = anim_name
+        self.out_date_dir = out_date_dir
+        self.out_base_filename = out_base_filename
+        self.log_filename = log_filename
+        self.return_code = None
+        # post-processing step -> True/False once it has run, None until then
+        self.postprocessing = {}
+
+    @property
+    def out_epoch_dirs(self):
+        return [os.path.join(self.out_date_dir, f"{self.out_base_filename}.{export_dir_ext}")
+                for export_dir_ext in self.export_dir_exts]
+
+    def __repr__(self):
+        return ("ExportJob("
+                f"export_dir_exts={self.export_dir_exts}, "
+                f"date={self.date}, epochlist={self.epochlist})")
 
 
 class ExtractRawTrodesData:
 
-    def __init__(self, trodes_anim_info: TrodesAnimalInfo):
+    # export_dir_ext: (Trodes < 2 command, Trodes >= 2 command)
+    export_cmds = {
+        'LFP': (['exportLFP'], ['trodesexport', '-lfp']),
+        'mda': (['exportmda'], ['trodesexport', '-mountainsort']),
+        'analog': (['exportanalog'], ['trodesexport', '-analogio']),
+        'DIO': (['exportdio'], ['trodesexport', '-dio']),
+        'phy': (['exportphy'], ['trodesexport', '-spikeband']),
+        'spikes': (['exportspikes'], ['trodesexport', '-spikes']),
+        'time': (['exporttime'], ['exporttime']),
+    }
+
+    # other directory names trodesexport may write a datatype's output to
+    export_dir_aliases = {
+        'mda': ('mountainsort',),
+        'analog': ('analogio',),
+        'phy': ('spikeband',),
+    }
+
+    # datatypes that can be decoded in this package instead (see `rec_export`),
+    # with the same command conventions as trodesexport
+    native_export_cmds = {
+        'DIO': [sys.executable, '-m', 'rec_to_binaries.rec_export', '-dio'],
+        'time': [sys.executable, '-m', 'rec_to_binaries.rec_export', '-time'],
+        'LFP': [sys.executable, '-m', 'rec_to_binaries.lfp_export', '-lfp'],
+    }
+
+    # trodesexport switches that apply the same way to every export mode of a
+    # call, so datatypes setting them to the same value can share the call.
+    # Any other switch (filters, references, interpolation, output rate) is
+    # specific to a mode and keeps its datatype in a call of its own.
+    shared_export_switches = ('-abortbaddata', '-paddingbytes', '-reconfig', '-sortingmode')
+
+    export_manifest_ext = 'export_manifest.json'
+
+    def __init__(self, trodes_anim_info: TrodesAnimalInfo, trodes_version=None,
+                 native_exports=()):
+        """
+        Args:
+            trodes_anim_info (TrodesAnimalInfo):
+            trodes_version (Optional[tuple]): version of the export tools
+            native_exports (Optional[iterable]): datatypes (keys of
+                `native_export_cmds`) to export with `rec_export` instead of
+                the Trodes tools
+        """
         self.trodes_anim_info = trodes_anim_info  # type: TrodesAnimalInfo
+        # full version tuple of the export tools, recorded in export manifests
+        self.trodes_version = trodes_version
+        unknown_exports = set(native_exports) - set(self.native_export_cmds)
+        if unknown_exports:
+            raise ValueError('No native export for {}.'.format(', '.join(sorted(unknown_exports))))
+        self.native_exports = set(native_exports)
+
+    def get_export_cmd(self, export_dir_ext, date=None):
+        if export_dir_ext in self.native_exports:
+            return list(self.native_export_cmds[export_dir_ext])
+        trodes_version = self.trodes_anim_info.get_trodes_version(date)
+        old_cmd, new_cmd = self.export_cmds[export_dir_ext]
+        return list(old_cmd) if trodes_version < 2 else list(new_cmd)
+
+    def _combined_cmd_prefix(self, export_dir_ext, date=None):
+        """Command without its mode switch if the datatype can be exported
+        together with others using the same command, else None."""
+        export_cmd = self.get_export_cmd(export_dir_ext, date)
+        if export_dir_ext in self.native_exports:
+            return tuple(export_cmd[:-1])
+        if (self.trodes_anim_info.get_trodes_version(date) >= 2 and
+                export_cmd[0] == 'trodesexport' and len(export_cmd) == 2):
+            return tuple(export_cmd[:-1])
+        return None
+
+    def group_dates_by_trodes_version(self, dates):
+        """Groups dates by the major trodes version of their recordings.
+
+        Returns:
+            list of (trodes_version, dates list)
+
+        """
+        groups = {}
+        for date in dates:
+            groups.setdefault(self.trodes_anim_info.get_trodes_version(date), []).append(date)
+        return list(groups.items())
 
     def extract_lfp(self, dates, epochs,
                     export_args=('-highpass', '0', '-lowpass', '400', '-interp', '0', '-userefs', '0',
@@ -1007,13 +1662,7 @@ class ExtractRawTrodesData:
         Returns:
 
         """
-        trodes_version = self.trodes_anim_info.trodes_version
-        if trodes_version < 2:
-            export_cmd = ['exportLFP']
-        else:
-            export_cmd = ['trodesexport', '-lfp']
-
-        self._extract_rec_generic(export_cmd=export_cmd, export_dir_ext='LFP',
+        self._extract_rec_generic(export_dir_ext='LFP',
                                   dates=dates, epochs=epochs,
                                   export_args=export_args, **kwargs)
 
@@ -1022,37 +1671,19 @@ class ExtractRawTrodesData:
                                  '-interp', '500', '-userefs', '1'),
                     **kwargs):
 
-        trodes_version = self.trodes_anim_info.trodes_version
-        if trodes_version < 2:
-            export_cmd = ['exportmda']
-        else:
-            export_cmd = ['trodesexport', '-mountainsort']
-
-        self._extract_rec_generic(export_cmd=export_cmd, export_dir_ext='mda',
+        self._extract_rec_generic(export_dir_ext='mda',
                                   dates=dates, epochs=epochs,
                                   export_args=export_args, **kwargs)
 
     def extract_analog(self, dates, epochs, export_args=(), **kwargs):
 
-        trodes_version = self.trodes_anim_info.trodes_version
-        if trodes_version < 2:
-            export_cmd = ['exportanalog']
-        else:
-            export_cmd = ['trodesexport', '-analogio']
-
-        self._extract_rec_generic(export_cmd=export_cmd,
-                                  export_dir_ext='analog', dates=dates,
+        self._extract_rec_generic(export_dir_ext='analog', dates=dates,
                                   epochs=epochs,
                                   export_args=export_args, **kwargs)
 
     def extract_dio(self, dates, epochs, export_args=(), **kwargs):
-        trodes_version = self.trodes_anim_info.trodes_version
-        if trodes_version < 2:
-            export_cmd = ['exportdio']
-        else:
-            export_cmd = ['trodesexport', '-dio']
 
-        self._extract_rec_generic(export_cmd=export_cmd, export_dir_ext='DIO',
+        self._extract_rec_generic(export_dir_ext='DIO',
                                   dates=dates, epochs=epochs,
                                   export_args=export_args, **kwargs)
 
@@ -1060,37 +1691,129 @@ class ExtractRawTrodesData:
                     export_args=('-usespikefilters', '0', '-interp', '1'),
                     **kwargs):
 
-        trodes_version = self.trodes_anim_info.trodes_version
-        if trodes_version < 2:
-            export_cmd = ['exportphy']
-        else:
-            export_cmd = ['trodesexport', '-spikeband']
-
-        self._extract_rec_generic(export_cmd=export_cmd, export_dir_ext='phy',
+        self._extract_rec_generic(export_dir_ext='phy',
                                   dates=dates, epochs=epochs,
                                   export_args=export_args, **kwargs)
 
     def extract_spikes(self, dates, epochs, export_args=(), **kwargs):
 
-        trodes_version = self.trodes_anim_info.trodes_version
-        if trodes_version < 2:
-            export_cmd = ['exportspikes']
-        else:
-            export_cmd = ['trodesexport', '-spikes']
-
-        self._extract_rec_generic(export_cmd=export_cmd,
-                                  export_dir_ext='spikes',
+        self._extract_rec_generic(export_dir_ext='spikes',
                                   dates=dates, epochs=epochs,
                                   export_args=export_args, **kwargs)
 
     def extract_time(self, dates, epochs, export_args=(), **kwargs):
 
-        export_cmd = ['exporttime']
-
-        self._extract_rec_generic(export_cmd=export_cmd, export_dir_ext='time',
+        self._extract_rec_generic(export_dir_ext='time',
                                   dates=dates, epochs=epochs,
                                   export_args=export_args, **kwargs)
 
+    def plan_export(self, export_dir_ext, dates, epochs, export_args=(), **kwargs):
+        """Plans the export jobs for one datatype without running them.
+
+        Args:
+            export_dir_ext (str): key of `export_cmds`, e.g. 'LFP' or 'DIO'
+            dates (list):
+            epochs (list):
+            export_args (Optional[list]):
+            **kwargs: see `_plan_rec_generic`
+
+        Returns:
+            list of ExportJob, to be run with `run_export_jobs`
+
+        """
+        export_jobs = []
+        for _, version_dates in self.group_dates_by_trodes_version(dates):
+            export_jobs.extend(self._plan_rec_generic(
+                export_cmd=self.get_export_cmd(export_dir_ext, version_dates[0]),
+                export_dir_ext=export_dir_ext, dates=version_dates, epochs=epochs,
+                export_args=export_args, **kwargs))
+        return export_jobs
+
+    def plan_combined_export(self, export_args_by_dir_ext, dates, epochs, **kwargs):
+        """Plans a single trodesexport call per rec file set that writes all
+        requested datatypes, so each rec file is only read once.
+
+        Only Trodes >= 2 supports several export modes in one call. Datatypes
+        that use a separate tool (e.g. time), or all datatypes with older Trodes
+        versions, are planned as one job per datatype. Native exports (see
+        `native_exports`) are combined with each other. Datatypes with mode
+        specific arguments (see `shared_export_switches`), or whose arguments set
+        the same switch to different values, are exported in separate calls.
+        Dates are planned per trodes version of their recordings.
+
+        Args:
+            export_args_by_dir_ext (dict): export_dir_ext -> export_args
+            dates (list):
+            epochs (list):
+            **kwargs: see `_plan_rec_generic`
+
+        Returns:
+            list of ExportJob
+
+        """
+        export_jobs = []
+        for _, version_dates in self.group_dates_by_trodes_version(dates):
+            # command prefix -> {export_dir_ext: export_args}
+            combinable_args = {}
+            separate_args = {}
+            for export_dir_ext, export_args in export_args_by_dir_ext.items():
+                cmd_prefix = self._combined_cmd_prefix(export_dir_ext, version_dates[0])
+                if cmd_prefix is not None:
+                    combinable_args.setdefault(cmd_prefix, {})[export_dir_ext] = export_args
+                else:
+                    separate_args[export_dir_ext] = export_args
+
+            for cmd_prefix, prefix_args in combinable_args.items():
+                for export_dir_exts, export_args in self._group_export_args(prefix_args):
+                    export_cmd = list(cmd_prefix) + [
+                        self.get_export_cmd(export_dir_ext, version_dates[0])[-1]
+                        for export_dir_ext in export_dir_exts]
+                    export_jobs.extend(self._plan_rec_generic(
+                        export_cmd=export_cmd, export_dir_ext=export_dir_exts,
+                        dates=version_dates, epochs=epochs, export_args=export_args, **kwargs))
+            for export_dir_ext, export_args in separate_args.items():
+                export_jobs.extend(self.plan_export(export_dir_ext, version_dates, epochs,
+                                                    export_args=export_args, **kwargs))
+
+        return export_jobs
+
+    @classmethod
+    def _group_export_args(cls, export_args_by_dir_ext):
+        """Groups datatypes whose export arguments can be passed to one call.
+
+        Arguments are read as (switch, value) pairs. Datatypes that only set
+        switches of `shared_export_switches` are merged: a datatype joins the
+        first group that does not already set one of its switches to a
+        different value. A datatype with any other switch is exported alone.
+
+        Returns:
+            list of (export_dir_exts tuple, merged export_args list)
+
+        """
+        groups = []
+        for export_dir_ext, export_args in export_args_by_dir_ext.items():
+            export_args = list(export_args)
+            if (len(export_args) % 2 != 0 or
+                    not set(export_args[::2]) <= set(cls.shared_export_switches)):
+                # mode specific or not switch/value pairs, keep on its own
+                groups.append(([export_dir_ext], None, export_args))
+                continue
+            switches = dict(zip(export_args[::2], export_args[1::2]))
+            for group_dir_exts, group_switches, _ in groups:
+                if group_switches is not None and all(
+                        group_switches.get(switch, value) == value
+                        for switch, value in switches.items()):
+                    group_dir_exts.append(export_dir_ext)
+                    group_switches.update(switches)
+                    break
+            else:
+                groups.append(([export_dir_ext], switches, None))
+
+        return [(tuple(group_dir_exts),
+                 list(itertools.chain.from_iterable(group_switches.items()))
+                 if group_switches is not None else group_args)
+                for group_dir_exts, group_switches, group_args in groups]
+
     def prepare_trodescomments(self, dates, epochs, overwrite=False, use_folder_date=False, stop_error=False):
         for dir_date, epoch in itertools.product(dates, epochs):
             try:
@@ -1150,7 +1873,7 @@ class ExtractRawTrodesData:
                     raise TrodesDataFormatError('Rec: Date {} and epoch {} does not exist for animal {}.'.
                                                 format(dir_date, epoch, self.trodes_anim_info.anim_name))
 
-                file_parser = epoch_raw_file[0]
+                file_parser = epoch_raw_file[0][0]
 
                 # create position dir
                 if use_folder_date:
@@ -1287,12 +2010,14 @@ class ExtractRawTrodesData:
                                    .format(sys.exc_info()[2].tb_frame.f_code.co_filename,
                                            sys.exc_info()[2].tb_lineno))
 
-    def _extract_rec_generic(self, export_cmd, export_dir_ext,
+    def _extract_rec_generic(self, export_dir_ext,
                              dates, epochs, export_args=(), overwrite=False, stop_error=False,
-                             use_folder_date=False, parallel_instances=1, use_day_config=True):
-        """
+                             use_folder_date=False, parallel_instances=1, use_day_config=True,
+                             resume=False):
+        """Plans (see `plan_export`, which picks the export command of each
+        day's trodes version) and runs the export of one datatype.
+
         Args:
-            export_cmd (str):
             export_dir_ext (str):
             dates (list):
             epochs (list):
@@ -1302,17 +2027,51 @@ class ExtractRawTrodesData:
                 if trying to extract over an existing folder when overwrite is off.  If False then instead of raising
                 exceptions, warnings are issued.
             parallel_instances (Optional[int]):
+            resume (Optional[bool]): see `_plan_rec_generic`
 
         """
+        export_jobs = self.plan_export(
+            export_dir_ext, dates, epochs, export_args=export_args, overwrite=overwrite,
+            stop_error=stop_error, use_folder_date=use_folder_date,
+            use_day_config=use_day_config, resume=resume)
+        self.run_export_jobs(export_jobs, parallel_instances=parallel_instances)
+
+    def _plan_rec_generic(self, export_cmd, export_dir_ext,
+                          dates, epochs, export_args=(), overwrite=False, stop_error=False,
+                          use_folder_date=False, use_day_config=True, resume=False,
+                          postprocessing=None):
+        """Builds the export call for every date and epoch and prepares its
+        output directories.
+
+        Args: see `_extract_rec_generic`, plus `export_cmd`, the command of
+            all `dates`; `export_dir_ext` may also be a tuple of datatypes
+            written by one combined export command.
+            resume (Optional[bool]): If True, skip jobs whose export manifest shows a
+                successful run with the same command on unchanged rec files, and
+                re-run all others, replacing their existing output.
+            postprocessing (Optional[dict]): export_dir_ext -> names of steps run on
+                its output after the export (see `record_postprocessing`). With
+                `resume`, jobs whose steps have not all succeeded are re-run.
 
-        subprocess_pool = {}
-        terminated_processes = {}
+        Returns:
+            list of ExportJob
 
-        next_cmd_id = 0
+        """
+        export_jobs = []
+        if isinstance(export_dir_ext, str):
+            export_dir_exts = (export_dir_ext,)
+        else:
+            export_dir_exts = tuple(export_dir_ext)
+        job_postprocessing = [name for ext in export_dir_exts
+                              for name in (postprocessing or {}).get(ext, ())]
 
         # create log file for each run of the export command
-        if len(export_cmd) > 1:
-            cmd_type = export_cmd[1].replace('-', '')
+        if export_cmd[:2] == [sys.executable, '-m']:
+            # native export, named after its module
+            cmd_type = '_'.join([export_cmd[2].rpartition('.')[-1]] +
+                                [mode.replace('-', '') for mode in export_cmd[3:]])
+        elif len(export_cmd) > 1:
+            cmd_type = '_'.join(mode.replace('-', '') for mode in export_cmd[1:])
         else:
             cmd_type = export_cmd[0]
 
@@ -1363,19 +2122,6 @@ class ExtractRawTrodesData:
                         label=file_parser.label,
                         label_ext=file_parser.label_ext)
 
-                    out_epoch_dir = os.path.join(
-                        out_date_dir, f"{out_base_filename}.{export_dir_ext}")
-                    if os.path.exists(out_epoch_dir):
-                        if overwrite:
-                            shutil.rmtree(out_epoch_dir)
-                        else:
-                            raise TrodesDataFormatError(
-                                ('skipping rec file {} for extracting, '
-                                 'folder {} already exists and overwrite=False.').
-                                format(file_parser.filename, out_epoch_dir))
-
-                    os.makedirs(out_epoch_dir)
-
                     # check if using external config
                     if use_day_config:
                         try:
@@ -1399,34 +2145,43 @@ class ExtractRawTrodesData:
                     if external_config_filename is not None:
                         export_call += ['-reconfig', external_config_filename]
 
-                    # if pool slots are full, wait for one subprocess to terminate
-                    just_terminated = self._wait_subprocess_pool(
-                        subprocess_pool=subprocess_pool,
-                        wait_pool_size=parallel_instances - 1)
-                    terminated_processes.update(just_terminated)
+                    out_epoch_dirs = [os.path.join(out_date_dir, f"{out_base_filename}.{ext}")
+                                      for ext in export_dir_exts]
+                    if resume and self._export_manifest_matches(
+                            out_epoch_dirs, out_base_filename, export_call, file_paths,
+                            job_postprocessing):
+                        logger.info('Skipping rec file {} for {}, output is up to date.'.
+                                    format(file_parser.filename, ', '.join(export_dir_exts)))
+                        continue
+
+                    for out_epoch_dir in out_epoch_dirs:
+                        if os.path.exists(out_epoch_dir) and not (overwrite or resume):
+                            raise TrodesDataFormatError(
+                                ('skipping rec file {} for extracting, '
+                                 'folder {} already exists and overwrite=False.').
+                                format(file_parser.filename, out_epoch_dir))
+
+                    for out_epoch_dir in out_epoch_dirs:
+                        if os.path.exists(out_epoch_dir):
+                            shutil.rmtree(out_epoch_dir)
+                        os.makedirs(out_epoch_dir)
 
                     out_cmd_log_filename = os.path.join(
-                        out_epoch_dir, out_base_filename + '.' +
+                        out_epoch_dirs[0], out_base_filename + '.' +
                         cmd_type + '.log')
 
-                    out_cmd_log_file = open(out_cmd_log_filename, 'w')
-                    # prepend the call command and argument to the log file
-                    out_cmd_log_file.write(' '.join(export_call))
-                    out_cmd_log_file.write('\n')
-
-                    # create new export command subprocess
-                    print('(ID: {}) Running {} on animal {} date {} epoch {}'.
-                          format(next_cmd_id, export_cmd, file_parser.name_str,
-                                 out_base_date, file_parser.epochlist_str))
-                    print('(ID: {}) Full command: {}'.format(
-                        next_cmd_id, export_call))
-
-                    subprocess_pool[next_cmd_id] = (
-                        subprocess.Popen(export_call,
-                                         stdout=out_cmd_log_file,
-                                         stderr=out_cmd_log_file),
-                        out_cmd_log_filename)
-                    next_cmd_id += 1
+                    export_job = ExportJob(
+                        export_cmd=export_cmd,
+                        export_call=export_call,
+                        export_dir_exts=export_dir_exts,
+                        date=out_base_date,
+                        epochlist=file_parser.epochlist_str,
+                        anim_name=file_parser.name_str,
+                        out_date_dir=out_date_dir,
+                        out_base_filename=out_base_filename,
+                        log_filename=out_cmd_log_filename)
+                    export_job.postprocessing = dict.fromkeys(job_postprocessing)
+                    export_jobs.append(export_job)
 
             except TrodesDataFormatError as err:
                 if stop_error:
@@ -1438,16 +2193,211 @@ class ExtractRawTrodesData:
                                    .format(sys.exc_info()[2].tb_frame.f_code.co_filename,
                                            sys.exc_info()[2].tb_lineno))
 
-        # wait for all commands to finish
-        just_terminated = self._wait_subprocess_pool(
-            subprocess_pool, wait_pool_size=0)
-        terminated_processes.update(just_terminated)
+        return export_jobs
+
+    def run_export_jobs(self, export_jobs, parallel_instances=1, dependents=()):
+        """Runs planned export jobs, keeping up to `parallel_instances`
+        subprocesses running at once regardless of datatype.
+
+        Args:
+            export_jobs (list): ExportJob, launched in order
+            parallel_instances (Optional[int]):
+            dependents (Optional[list]): (required_jobs, func) pairs. `func()` is started
+                on its own thread as soon as every job in `required_jobs` has finished,
+                whether or not it succeeded; with no required jobs it is started before any
+                job, so it runs alongside the exports. The first exception raised by a
+                dependent is re-raised once all jobs and dependents have finished.
+
+        """
+        subprocess_pool = {}
+        terminated_processes = {}
+        # keys of subprocesses that have exited, in order of exit
+        exit_queue = queue.Queue()
+
+        # dependents run on their own threads, so they never hold up launching jobs
+        dependent_executor = concurrent.futures.ThreadPoolExecutor(max(len(dependents), 1))
+        dependent_futures = []
+
+        def start_dependent(func):
+            dependent_futures.append(dependent_executor.submit(func))
+
+        try:
+            pending_dependents = []
+            for required_jobs, func in dependents:
+                required_ids = {id(job) for job in required_jobs}
+                if required_ids:
+                    pending_dependents.append((required_ids, func))
+                else:
+                    start_dependent(func)
+            finished_ids = set()
+
+            for next_cmd_id, job in enumerate(export_jobs):
+                # if pool slots are full, wait for one subprocess to terminate
+                just_terminated = self._wait_subprocess_pool(
+                    subprocess_pool=subprocess_pool,
+                    wait_pool_size=parallel_instances - 1,
+                    exit_queue=exit_queue)
+                terminated_processes.update(just_terminated)
+                pending_dependents = self._run_ready_dependents(
+                    pending_dependents, finished_ids, export_jobs, just_terminated,
+                    start_dependent)
+
+                out_cmd_log_file = open(job.log_filename, 'w')
+                # prepend the call command and argument to the log file
+                out_cmd_log_file.write(' '.join(job.export_call))
+                out_cmd_log_file.write('\n')
+                out_cmd_log_file.flush()
+
+                # create new export command subprocess
+                print('(ID: {}) Running {} on animal {} date {} epoch {}'.
+                      format(next_cmd_id, job.export_cmd, job.anim_name,
+                             job.date, job.epochlist))
+                print('(ID: {}) Full command: {}'.format(
+                    next_cmd_id, job.export_call))
+
+                extract_proc = subprocess.Popen(job.export_call,
+                                                stdout=out_cmd_log_file,
+                                                stderr=out_cmd_log_file)
+                subprocess_pool[next_cmd_id] = (
+                    extract_proc, job.log_filename)
+                self._watch_subprocess(
+                    next_cmd_id, extract_proc, exit_queue)
+
+            # wait for all commands to finish
+            while subprocess_pool:
+                just_terminated = self._wait_subprocess_pool(
+                    subprocess_pool, wait_pool_size=len(subprocess_pool) - 1,
+                    exit_queue=exit_queue)
+                terminated_processes.update(just_terminated)
+                pending_dependents = self._run_ready_dependents(
+                    pending_dependents, finished_ids, export_jobs, just_terminated,
+                    start_dependent)
+            # dependents on jobs that were not part of this run
+            for _, func in pending_dependents:
+                start_dependent(func)
+        finally:
+            dependent_executor.shutdown(wait=True)
+        for future in dependent_futures:
+            future.result()
 
         for cmd_key, (extract_proc, cmd_log_file) in terminated_processes.items():
             if extract_proc.poll() != 0:
                 logger.warning('Running export command ({}) failed with return code {}'.
                                format(extract_proc.args, extract_proc.poll()), TrodesDataFormatWarning)
 
+    def _run_ready_dependents(self, pending_dependents, finished_ids, export_jobs, just_terminated,
+                              start_dependent):
+        for cmd_key, (extract_proc, _) in just_terminated.items():
+            export_jobs[cmd_key].return_code = extract_proc.poll()
+            self._collect_export_outputs(export_jobs[cmd_key])
+            self._write_export_manifest(export_jobs[cmd_key])
+            finished_ids.add(id(export_jobs[cmd_key]))
+
+        still_pending = []
+        for required_ids, func in pending_dependents:
+            if required_ids <= finished_ids:
+                start_dependent(func)
+            else:
+                still_pending.append((required_ids, func))
+        return still_pending
+
+    def _export_manifest(self, export_call, rec_paths, out_epoch_dirs):
+        manifest = {
+            'export_call': list(export_call),
+            'trodes_version': (list(self.trodes_version)
+                               if self.trodes_version is not None else None),
+            'rec_files': [],
+            'output_files': [],
+        }
+        for rec_path in rec_paths:
+            rec_stat = os.stat(rec_path)
+            manifest['rec_files'].append({'path': rec_path,
+                                          'size': rec_stat.st_size,
+                                          'mtime': rec_stat.st_mtime})
+        for out_epoch_dir in out_epoch_dirs:
+            for dir_entry in sorted(os.scandir(out_epoch_dir), key=lambda entry: entry.name):
+                if dir_entry.is_file() and not dir_entry.name.endswith(self.export_manifest_ext):
+                    manifest['output_files'].append({'path': dir_entry.path,
+                                                     'size': dir_entry.stat().st_size})
+        return manifest
+
+    def _write_export_manifest(self, export_job):
+        """Records the command, inputs, outputs, exit code and post-processing
+        status of a finished job in each of its output directories."""
+        rec_paths = [export_job.export_call[ind + 1]
+                     for ind, arg in enumerate(export_job.export_call) if arg == '-rec']
+        manifest = self._export_manifest(export_job.export_call, rec_paths,
+                                         export_job.out_epoch_dirs)
+        manifest['return_code'] = export_job.return_code
+        manifest['postprocessing'] = dict(export_job.postprocessing)
+        for out_epoch_dir in export_job.out_epoch_dirs:
+            manifest_path = os.path.join(
+                out_epoch_dir, export_job.out_base_filename + '.' + self.export_manifest_ext)
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f, indent=1)
+
+    def record_postprocessing(self, export_job, name, succeeded):
+        """Records whether post-processing step `name` (one of the job's planned
+        `postprocessing` steps) succeeded on the output of a finished job, and
+        rewrites its manifests, so resuming re-runs the job if it did not.
+
+        Args:
+            export_job (ExportJob):
+            name (str):
+            succeeded (bool):
+
+        """
+        export_job.postprocessing[name] = bool(succeeded)
+        self._write_export_manifest(export_job)
+
+    def _export_manifest_matches(self, out_epoch_dirs, out_base_filename, export_call, rec_paths,
+                                 postprocessing=()):
+        """True if every output directory has a manifest of a successful run of
+        `export_call` on the same rec files whose `postprocessing` steps all
+        succeeded, and its outputs still exist."""
+        for out_epoch_dir in out_epoch_dirs:
+            manifest_path = os.path.join(
+                out_epoch_dir, out_base_filename + '.' + self.export_manifest_ext)
+            try:
+                with open(manifest_path, 'r') as f:
+                    manifest = json.load(f)
+            except (FileNotFoundError, ValueError):
+                return False
+            if manifest.get('return_code') != 0:
+                return False
+            if not all(manifest.get('postprocessing', {}).get(name) is True
+                       for name in postprocessing):
+                return False
+            try:
+                current = self._export_manifest(export_call, rec_paths, [])
+            except FileNotFoundError:
+                return False
+            for key in ('export_call', 'trodes_version', 'rec_files'):
+                if manifest.get(key) != current[key]:
+                    return False
+            # outputs may be legitimately rewritten afterwards (e.g. timestamp
+            # adjustment), so only their presence is checked
+            for output_file in manifest['output_files']:
+                if not os.path.isfile(output_file['path']):
+                    return False
+        return True
+
+    @staticmethod
+    def _collect_export_outputs(export_job):
+        """Moves output that the export tool wrote to an alias directory
+        (e.g. `.mountainsort`) into the directory named by its datatype.
+        """
+        for export_dir_ext, out_epoch_dir in zip(export_job.export_dir_exts,
+                                                 export_job.out_epoch_dirs):
+            for alias in ExtractRawTrodesData.export_dir_aliases.get(export_dir_ext, ()):
+                alias_dir = os.path.join(export_job.out_date_dir,
+                                         f"{export_job.out_base_filename}.{alias}")
+                if not os.path.isdir(alias_dir):
+                    continue
+                for entry in os.scandir(alias_dir):
+                    shutil.move(entry.path, os.path.join(out_epoch_dir, entry.name))
+                os.rmdir(alias_dir)
+
     @staticmethod
     def _assemble_export_base_name(date, anim_name, epochlist, label, label_ext):
         out_base_filename = date + '_' + anim_name + '_' + epochlist
@@ -1459,39 +2409,36 @@ class ExtractRawTrodesData:
         return out_base_filename
 
     @staticmethod
-    def _wait_subprocess_pool(subprocess_pool, wait_pool_size):
+    def _watch_subprocess(cmd_key, extract_proc, exit_queue):
+        """Puts `cmd_key` on `exit_queue` as soon as `extract_proc` exits,
+        so waiting on the pool blocks on the exit itself instead of polling.
+        """
+        def wait_and_notify():
+            extract_proc.wait()
+            exit_queue.put(cmd_key)
+
+        threading.Thread(target=wait_and_notify, daemon=True).start()
+
+    @staticmethod
+    def _wait_subprocess_pool(subprocess_pool, wait_pool_size, exit_queue):
         terminated_processes = {}
         while len(subprocess_pool) > wait_pool_size:
-            time.sleep(1.0)
-            for cmd_key, (extract_proc, cmd_log_filename) in list(subprocess_pool.items()):
-                return_code = extract_proc.poll()
-                if return_code is not None:
-                    del subprocess_pool[cmd_key]
-                    terminated_processes[cmd_key] = (
-                        extract_proc, cmd_log_filename)
-                    print('(ID: {}) Done running {}'.format(
-                        cmd_key, extract_proc.args))
-                    # print log file
-                    with open(cmd_log_filename, 'r') as f:
-                        for line in f:
-                            print('(ID: {}) '.format(cmd_key) + line, end='')
+            cmd_key = exit_queue.get()
+            extract_proc, cmd_log_filename = subprocess_pool.pop(cmd_key)
+            terminated_processes[cmd_key] = (
+                extract_proc, cmd_log_filename)
+            print('(ID: {}) Done running {}'.format(
+                cmd_key, extract_proc.args))
+            # print log file
+            with open(cmd_log_filename, 'r') as f:
+                for line in f:
+                    print('(ID: {}) '.format(cmd_key) + line, end='')
 
         return terminated_processes
 
 
-def get_trodes_version(rec_file_name):
-    with open(rec_file_name, mode='rb') as file:
-        line = file.readline()
-
-        while line:
-            line = file.readline().decode()
-            if line.startswith(' <GlobalConfiguration'):
-                break
-    version = (line
-               .partition('trodesVersion="')[-1]
-               .partition('"')[0]
-               .split('.'))
-    return int(version[0]), int(version[1]), int(version[2])
+def get_trodes_version(rec_file_name, cache_path=None):
+    return read_rec_header(rec_file_name, cache_path=cache_path).trodes_version
 
 
 def get_trodes_version_from_path():
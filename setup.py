@@ -2,7 +2,7 @@
 
 from setuptools import find_packages, setup
 
-INSTALL_REQUIRES = ['numpy', 'pandas', 'scipy']
+INSTALL_REQUIRES = ['numpy', 'pandas', 'scipy', 'tables']
 TESTS_REQUIRE = ['pytest >= 2.7.1']
 
 setup(
@@ -15,6 +15,6 @@ setup(
     url='https://github.com/LorenFrankLab/rec_to_binaries',
     packages=find_packages(),
     install_requires=INSTALL_REQUIRES,
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     tests_require=TESTS_REQUIRE,
 )
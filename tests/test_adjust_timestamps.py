@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from rec_to_binaries.adjust_timestamps import ContinuousTimeFile, fix_timestamp_lag
+
+SYSTIME_START = 1600000000000000000
+
+
+def _write_continuoustime(path, n_time):
+    data = np.zeros(n_time, dtype=[('trodestime', '<u4'), ('systime', '<i8')])
+    data['trodestime'] = np.arange(n_time) + 100
+    data['systime'] = SYSTIME_START + np.arange(n_time) * 33333
+    with open(path, 'wb') as file:
+        file.write(b'<Start settings>\n'
+                   b'clockrate: 30000\n'
+                   b'system_time_at_creation: 1600000000000\n'
+                   b'Fields: <trodestime uint32><systime int64>\n'
+                   b'<End settings>\n')
+        data.tofile(file)
+    return data
+
+
+@pytest.mark.parametrize('chunk_size, compact', [(None, False), (4, False), (None, True)])
+@pytest.mark.parametrize('n_time', [0, 1])
+def test_fix_timestamp_lag_short_file(tmp_path, chunk_size, compact, n_time):
+    path = str(tmp_path / 'test.continuoustime.dat')
+    data = _write_continuoustime(path, n_time)
+
+    fix_timestamp_lag(path, chunk_size=chunk_size, compact=compact)
+
+    adjusted = ContinuousTimeFile(path)
+    assert len(adjusted) == n_time
+    np.testing.assert_allclose(adjusted.adjusted_systime().astype(np.float64),
+                               data['systime'].astype(np.float64), rtol=0, atol=1e3)
@@ -0,0 +1,27 @@
+from rec_to_binaries.core import _default_export_args
+from rec_to_binaries.trodes_data import ExtractRawTrodesData
+
+
+def _default_args_by_dir_ext(trodes_version):
+    return {export_dir_ext: _default_export_args(export_dir_ext, trodes_version)
+            for export_dir_ext in ('analog', 'DIO', 'LFP', 'mda', 'spikes')}
+
+
+def test_default_lfp_args_not_shared():
+    groups = ExtractRawTrodesData._group_export_args(_default_args_by_dir_ext(2))
+    groups = {export_dir_exts: export_args for export_dir_exts, export_args in groups}
+
+    assert groups[('LFP',)] == list(_default_export_args('LFP', 2))
+    assert groups[('mda',)] == list(_default_export_args('mda', 2))
+    assert groups[('analog', 'DIO', 'spikes')] == []
+
+
+def test_shared_switches_merged():
+    groups = ExtractRawTrodesData._group_export_args({
+        'analog': ['-sortingmode', '1'],
+        'DIO': ['-abortbaddata', '0'],
+        'spikes': ['-sortingmode', '0'],
+    })
+
+    assert groups == [(('analog', 'DIO'), ['-sortingmode', '1', '-abortbaddata', '0']),
+                      (('spikes',), ['-sortingmode', '0'])]